@@ -0,0 +1,173 @@
+import threading
+from collections import deque
+
+
+class AllocationError(Exception):
+    pass
+
+
+class PortAllocator:
+    """
+    Thread-safe Port Reservations of a Cloud
+
+    Ports of a range are tracked in a bitmap, one bit per port.
+    Reservations are atomic, released ports are handed out again.
+    """
+
+    def __init__(self, first=5099, last=5999):
+        self._first = first
+        self._size = last - first + 1
+        self._bitmap = bytearray((self._size + 7) // 8)
+        self._next = 0
+        self._reconciled = False
+        self._lock = threading.Lock()
+
+    def _is_set(self, offset):
+        return self._bitmap[offset >> 3] & (1 << (offset & 7))
+
+    def _set(self, offset):
+        self._bitmap[offset >> 3] |= 1 << (offset & 7)
+
+    def _clear(self, offset):
+        self._bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+
+    def _offset(self, port):
+        offset = port - self._first
+        if not 0 <= offset < self._size:
+            raise AllocationError("Port {} outside of {}-{}".format(port, self._first, self._first + self._size - 1))
+        return offset
+
+    def _find_free(self):
+        """Next free offset, starting after the last reservation"""
+        for start, stop in ((self._next, self._size), (0, self._next)):
+            offset = start
+            while offset < stop:
+                if not offset & 7 and self._bitmap[offset >> 3] == 0xFF:
+                    # Skip a fully reserved byte at once
+                    offset += 8
+                elif not self._is_set(offset):
+                    return offset
+                else:
+                    offset += 1
+        raise AllocationError("No free port in {}-{}".format(self._first, self._first + self._size - 1))
+
+    def reserve(self, port=None):
+        """Reserve the next free port or a specific one"""
+        with self._lock:
+            if port is None:
+                offset = self._find_free()
+            else:
+                offset = self._offset(port)
+                if self._is_set(offset):
+                    raise AllocationError("Port {} is already reserved".format(port))
+            self._set(offset)
+            self._next = (offset + 1) % self._size
+            return self._first + offset
+
+    def release(self, port):
+        """Return a port for reuse"""
+        with self._lock:
+            self._clear(self._offset(port))
+
+    def reconcile(self, in_use, release_missing=False):
+        """Mark ports reported by the driver as reserved, optionally free all others"""
+        with self._lock:
+            self._reconcile(in_use, release_missing)
+
+    def reconcile_once(self, list_in_use):
+        """Reconcile with list_in_use() before the first reservation, concurrent callers wait for it"""
+        if self._reconciled:
+            return
+        with self._lock:
+            if not self._reconciled:
+                self._reconcile(list_in_use())
+
+    def _reconcile(self, in_use, release_missing=False):
+        if release_missing:
+            self._bitmap = bytearray(len(self._bitmap))
+        self._mark(in_use)
+        self._reconciled = True
+
+    def _mark(self, ports):
+        for port in ports:
+            offset = port - self._first
+            if 0 <= offset < self._size:
+                self._set(offset)
+
+    def restore(self, ports):
+        """Reserve ports remembered from an earlier run, the driver is still asked before the first reservation"""
+        with self._lock:
+            self._mark(ports)
+
+    def __contains__(self, port):
+        offset = port - self._first
+        return 0 <= offset < self._size and bool(self._is_set(offset))
+
+    def __len__(self):
+        """Number of reserved ports"""
+        return sum(bin(byte).count('1') for byte in self._bitmap)
+
+
+class FloatingIpPool:
+    """
+    Pre-reserved Unused Floating IPs of a Cloud
+
+    The provider is scanned once, further reservations are served from the pool.
+    New floating IPs are only created when the pool runs dry.
+    """
+
+    def __init__(self, list_ips, create_ip):
+        self._list_ips = list_ips
+        self._create_ip = create_ip
+        self._free = deque()
+        self._reserved = set()
+        self._scanned = False
+        self._lock = threading.Lock()
+
+    def _scan(self, release_missing=False):
+        """Collect all floating IPs not attached to a node"""
+        floating_ips = list(self._list_ips())
+        if release_missing:
+            self._reserved = {ip.ip_address for ip in floating_ips if ip.node_id and ip.ip_address in self._reserved}
+        self._free = deque(ip.ip_address for ip in floating_ips
+                           if not ip.node_id and ip.ip_address not in self._reserved)
+        self._scanned = True
+
+    def reserve(self):
+        """Reserve an unused floating IP"""
+        with self._lock:
+            if not self._scanned:
+                self._scan()
+            address = self._free.popleft() if self._free else self._create_ip().ip_address
+            self._reserved.add(address)
+            return address
+
+    def prefill(self, count):
+        """Make sure count floating IPs are ready to be reserved"""
+        with self._lock:
+            if not self._scanned:
+                self._scan()
+            missing = count - len(self._free)
+        # Created outside the lock, reservations are served meanwhile
+        for _ in range(missing):
+            address = self._create_ip().ip_address
+            with self._lock:
+                self._free.append(address)
+
+    def restore(self, addresses):
+        """Keep floating IPs reserved that were handed out in an earlier run"""
+        with self._lock:
+            self._reserved.update(addresses)
+            self._free = deque(address for address in self._free if address not in self._reserved)
+
+    def release(self, address):
+        """Return a floating IP for reuse"""
+        with self._lock:
+            if address in self._reserved:
+                self._reserved.discard(address)
+                self._free.append(address)
+
+    def reconcile(self, release_missing=False):
+        """Rescan the provider, optionally dropping reservations no longer attached to a node"""
+        with self._lock:
+            self._scan(release_missing)
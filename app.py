@@ -1,56 +1,124 @@
+import logging
+import os
+import threading
+import time
+from multiprocessing.dummy import Pool
+
 import jinja2
 import ruamel.yaml as yaml
 
 import utils
 import scheduler
+from cloud import LABEL_FINGERPRINT
+from log import span
+
+
+class IgnoreMissingAttribute(jinja2.DebugUndefined):
+    """Preserve placeholders, ignore missing objects or attributes"""
+
+    def __getattr__(self, name):
+        return u'{{ %s.%s }}' % (self._undefined_name, name)
 
 
 class Template:
-    """Jinja2 dict/YAML template for app deployment"""
+    """Jinja2 dict/YAML template for app deployment
+
+    The template tree is parsed once and kept in memory. Each string containing
+    a placeholder is compiled once and rendered against the persisted values,
+    so rendering one service instance only touches that service's subtree.
+    Persistent updates are written behind to disk in one batch by flush(),
+    into a state.StateStore if given, otherwise as YAML file.
+    """
 
-    def __init__(self, name, template):
+    _env = jinja2.Environment(undefined=IgnoreMissingAttribute, keep_trailing_newline=True)
+
+    def __init__(self, name, template, path='./deployments/{id}.yaml', store=None):
         self.id = name
-        self._template = template
-        self._path = './deployments/{id}.yaml'.format(id=self.id)
+        self._source = template
+        self._services = {srv['role']: srv for srv in template['services']}
+        self._path = path.format(id=self.id) if path else None
+        self._store = store
+        self._context = {}
+        self._compiled = {}
+        self._rendered = None
+        self._dirty = False
 
-        self.__save_yaml()
         self.update({'app_id': self.id})
 
     def __get__(self, instance, owner):
-        return self._template
+        return self.rendered
 
     def __getitem__(self, item):
-        return self._template[item]
+        return self.rendered[item]
 
     def __repr__(self):
-        return self._template
+        return "<{name}: id={id}>".format(name=__name__, id=self.id)
 
-    def __save_yaml(self, path=None):
+    @property
+    def rendered(self):
+        """Template rendered with all persisted values"""
+        if self._rendered is None:
+            self._rendered = self._render(self._source, self._context)
+        return self._rendered
+
+    def _render(self, node, context):
+        """Render all placeholders within a template subtree"""
+        if isinstance(node, str):
+            if '{{' not in node and '{%' not in node:
+                return node
+            compiled = self._compiled.get(node)
+            if compiled is None:
+                compiled = self._compiled[node] = self._env.from_string(node)
+            # Keep ruamel scalar types (e.g. literal blocks) for dumping
+            return type(node)(compiled.render(context))
+        if isinstance(node, dict):
+            return type(node)((key, self._render(value, context)) for key, value in node.items())
+        if isinstance(node, list):
+            return type(node)(self._render(value, context) for value in node)
+        return node
+
+    def _save_yaml(self, path=None):
         """Persist template to disk as YAML"""
-        with open(path or self._path, 'w') as f:
-            yaml.YAML().dump(self._template, f)
+        path = path or self._path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            yaml.YAML().dump(self.rendered, f)
+
+    def flush(self):
+        """Write pending updates to disk"""
+        if self._dirty and self._store is not None:
+            self._store.save_template(self.id, self.rendered)
+        elif self._dirty and self._path:
+            self._save_yaml()
+        self._dirty = False
 
     def update(self, value=None, persist=True):
         """Update Template"""
         if value is None:
             value = {}
 
-        class IgnoreMissingAttribute(jinja2.DebugUndefined):
-            """Preserve placeholders, ignore missing objects or attributes"""
+        if not persist:
+            return self._render(self._source, dict(self._context, **value))
 
-            def __getattr__(self, name):
-                return u'{{ %s.%s }}' % (self._undefined_name, name)
+        self._context.update(value)
+        self._rendered = None
+        self._dirty = True
+        return self.rendered
 
-        # Load and update the last saved yaml as new template
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader('.'), undefined=IgnoreMissingAttribute)
-        template = env.get_template(self._path)
-        updated_template = yaml.YAML().load(template.render(value))
+    def replicas(self, role):
+        """Desired number of instances of a replicated role"""
+        return self._services[role]['deploy']['replicas']
 
-        if persist:
-            self._template = updated_template
-            self.__save_yaml()
+    def set_replicas(self, role, replicas):
+        """Change the desired number of instances of a replicated role"""
+        self._services[role]['deploy']['replicas'] = replicas
+        self._rendered = None
+        self._dirty = True
 
-        return updated_template
+    def render_service(self, role, value=None):
+        """Render a single service subtree with additional, non-persisted values"""
+        context = dict(self._context, **value) if value else self._context
+        return self._render(self._services[role], context)
 
 
 class App:
@@ -69,13 +137,28 @@ class App:
     #  - Hard Constraints (Hardware, Features) -> Scheduler
     #  - Soft Constraints (Availability, Performance, Price) -> Scheduler
     #
-    def __init__(self, template, sla, clouds):
-        self.id = utils.create_uuid(template['name'])
-        self._template = Template(self.id, template)
+    def __init__(self, template, sla, clouds, concurrency=8, time_budget=1.0, health=None, ready_timeout=None,
+                 id=None, deploy=True, store=None, ledger=None, profiles=None):
+        self.id = id or utils.create_uuid(template['name'])
+        self._store = store
+        self._template = Template(self.id, template, store=store)
         self._sla = sla
         self._clouds = clouds
+        self._concurrency = concurrency
+        self._time_budget = time_budget
+        self._health = health
+        self._ready_timeout = ready_timeout
+        # Capacity shared with other apps deployed at the same time (scheduler.CapacityLedger)
+        self._ledger = ledger
+        # Learned cloud performance, used for planning and updated with time to ready (profiles.Profiles)
+        self._profiles = profiles
         self._services = []
-        self._deploy_services()
+        if deploy:
+            try:
+                self._deploy_services()
+            except Exception:
+                self._abort()
+                raise
 
     # def __del__(self):
     #     """Remove all of the app's service instances"""
@@ -83,10 +166,180 @@ class App:
 
     # TODO: Checks at App-level
     # 0. Are all deployed instances still alive?
-    #    a) Reconstruct Template from running instance information (labels)
-    # 1. Measure Throughput, Response Time
-    # 2. Change Template, if needed
-    # 3. Re-run _deploy_services()
+    #    a) Reconstruct Template from running instance information (labels) -> adopt()
+    # 1. Measure Throughput, Response Time -> autoscaler.Autoscaler
+    # 2. Change Template, if needed -> scale()
+    # 3. Re-run _deploy_services() -> scale()
+
+    @property
+    def services(self):
+        """All deployed service instances"""
+        return list(self._services)
+
+    @property
+    def sla(self):
+        return self._sla
+
+    def adopt(self, instances):
+        """Take over running instances (see inventory.Inventory) without redeploying them"""
+        templates = {srv['role']: srv for srv in self._template['services']}
+        known = {srv.id for srv in self._services}
+        # Global roles first, as replicas render their ip and port
+        instances = sorted((i for i in instances if i.name not in known),
+                           key=lambda i: i.role not in templates or not self._is_global(templates[i.role]))
+
+        for instance in instances:
+            if instance.role not in templates:
+                logging.warning("Instance {} has unknown role '{}', skipped".format(instance.name, instance.role))
+                continue
+            handle = instance.cloud.get_instance(instance.name)
+            if handle is None:
+                logging.warning("Instance {} vanished from {}, skipped".format(instance.name, instance.cloud.id))
+                continue
+            run_config = {'ip': instance.ip, 'port': instance.port, 'id': instance.port}
+            if self._is_global(templates[instance.role]):
+                self._template.update({instance.role: run_config})
+            srv_template = self._template.render_service(instance.role, {instance.role: run_config})
+            self._services.append(Service(srv_template, instance.cloud, run_config, id=instance.name,
+                                          instance=handle, fingerprint=instance.labels.get(LABEL_FINGERPRINT)))
+        if self._store is not None:
+            self._store.add_services(self.id, self._services)
+        self._reserve()
+        self._template.flush()
+
+    def replicas(self, role):
+        """Desired number of instances of a replicated role"""
+        return self._template.replicas(role)
+
+    def _desired_template(self, service):
+        """Rendering a service instance should run with, for its ip and port"""
+        return self._template.render_service(service.role, {service.role: service.run_config})
+
+    def reconcile(self, instances=()):
+        """Converge the running instances to the template, only touching what differs
+
+        Running instances (see inventory.Inventory) are adopted first.
+        Instances whose fingerprint label differs from their desired rendering are replaced,
+        surplus instances are deleted (outdated ones first), missing ones are created.
+        An unchanged template makes no provider calls at all.
+        """
+        self.adopt(instances)
+        changes = {'kept': 0, 'replaced': 0, 'deleted': 0, 'created': 0}
+
+        # Delete surplus first, so nothing is replaced only to be deleted afterwards
+        surplus = []
+        for srv in self._template['services']:
+            deployed = self._get_services_by_role(srv['role'])
+            wanted = 1 if self._is_global(srv) else srv['deploy']['replicas']
+            if len(deployed) > wanted:
+                current = [s.id for s in deployed if s.fingerprint == utils.fingerprint(self._desired_template(s))]
+                surplus.extend(self._scale_in_order(deployed, keep=current)[:len(deployed) - wanted])
+        changes['deleted'] = len(surplus) - len(self._remove_services(surplus))
+
+        # Replace outdated instances wave by wave, dependencies first
+        for wave in scheduler.dependency_waves(self._template['services']):
+            jobs = []
+            for srv in wave:
+                for service in self._get_services_by_role(srv['role']):
+                    desired = self._desired_template(service)
+                    if service.fingerprint != utils.fingerprint(desired):
+                        jobs.append((service, desired))
+            if not jobs:
+                continue
+            with span('replace ' + ','.join(srv['role'] for srv in wave)), \
+                    Pool(min(self._concurrency, len(jobs))) as pool:
+                pool.starmap(Service.restart, jobs)
+            changes['replaced'] += len(jobs)
+            if self._health is not None:
+                self._health.unwatch([service for service, _ in jobs])
+                self._wait_ready([service for service, _ in jobs], wave)
+
+        before = len(self._services)
+        self._deploy_services()
+        changes['created'] = len(self._services) - before
+        changes['kept'] = len(self._services) - changes['created'] - changes['replaced']
+        return changes
+
+    def scale(self, role, replicas, healthy=None):
+        """Scale a replicated role out or in, returns the errors of instances that could not be removed
+
+        Scaling out plans and deploys only the missing instances.
+        Scaling in removes instances not in healthy first (ids, all are healthy if None),
+        the most expensive first, the most recently deployed on a tie.
+        """
+        srv = next(srv for srv in self._template['services'] if srv['role'] == role)
+        if self._is_global(srv):
+            raise ValueError("Role '{}' is global and cannot be scaled".format(role))
+
+        self._template.set_replicas(role, replicas)
+        deployed = self._get_services_by_role(role)
+        errors = {}
+        if len(deployed) < replicas:
+            try:
+                self._deploy_services()
+            finally:
+                # The ledger holds the whole plan, a failed scale-out only keeps what runs
+                self._reserve()
+        elif len(deployed) > replicas:
+            keep = [s.id for s in deployed] if healthy is None else healthy
+            errors = self._remove_services(self._scale_in_order(deployed, keep)[:len(deployed) - replicas])
+        self._template.flush()
+        return errors
+
+    @staticmethod
+    def _scale_in_order(services, keep=()):
+        """Instances not in keep before those in keep, expensive before cheap, new before old"""
+        keep = set(keep)
+        order = sorted(enumerate(services),
+                       key=lambda item: (item[1].id in keep, -item[1].cloud.cost, -item[0]))
+        return [service for _, service in order]
+
+    def _remove_services(self, services):
+        """Destroy service instances in parallel and forget the removed ones, returns errors by service id"""
+        if not services:
+            return {}
+        # No health check restarts an instance while it is removed
+        if self._health is not None:
+            self._health.unwatch(services)
+
+        def destroy(service):
+            try:
+                service.destroy()
+            except Exception as e:
+                logging.error("Removing service {} failed: {}".format(service.id, e))
+                return service, e
+            return service, None
+
+        with span('scale in'), Pool(min(self._concurrency, len(services))) as pool:
+            results = pool.map(destroy, services)
+        removed = {id(service) for service, error in results if error is None}
+        failed = [service for service, error in results if error is not None]
+        self._services = [service for service in self._services if id(service) not in removed]
+        if self._store is not None:
+            self._store.remove_services([service.id for service, error in results if error is None])
+        # Instances that are still there stay under watch
+        if self._health is not None and failed:
+            self._health.watch(failed)
+        self._reserve()
+        return {service.id: error for service, error in results if error is not None}
+
+    def _abort(self):
+        """Undo a failed deployment: remove the started instances, free the reserved capacity, forget the app"""
+        if self._health is not None:
+            self._health.unwatch(self._services)
+        self._roll_back(self._services)
+        self._services = []
+        if self._store is not None:
+            self._store.remove_app(self.id)
+        if self._ledger is not None:
+            self._ledger.release(self.id)
+
+    def _reserve(self):
+        """Reserve the resources of the running instances in the shared capacity ledger"""
+        if self._ledger is not None:
+            self._ledger.update(self.id, self._template['services'],
+                                {srv['role']: [s.cloud for s in self._get_services_by_role(srv['role'])]
+                                 for srv in self._template['services']})
 
     def _get_service_by_role(self, role):
         """Return ONE service of a given role"""
@@ -96,57 +349,215 @@ class App:
         """Return ALL services of a given role"""
         return [srv for srv in self._services if srv.role == role]
 
-    def _deploy_services(self):
-
-        _queued_services = self._template['services']
+    def _is_global(self, srv):
+        """Only one instance of this service shall exist within a cluster"""
+        return srv['deploy']['mode'] == 'global'
+
+    def _is_replicated(self, srv):
+        """Replication requirement satisfied for this role"""
+        return len(self._get_services_by_role(srv['role'])) >= srv['deploy']['replicas']
+
+    def _role_is_deployed(self, srv):
+        """A required number of this role's services already exists"""
+        return self._is_global(srv) and self._get_service_by_role(srv['role']) or \
+            not self._is_global(srv) and self._is_replicated(srv)
+
+    def _dependencies_fulfilled(self, srv):
+        """All required services exist"""
+        is_fulfilled = True
+        for dep in srv['depends_on']:
+            if dep != 'None' and not self._get_service_by_role(dep):
+                is_fulfilled = False
+        return is_fulfilled
+
+    def _missing_instances(self, srv):
+        """Number of instances still to deploy for this role"""
+        if self._role_is_deployed(srv):
+            return 0
+        if self._is_global(srv):
+            return 1
+        return srv['deploy']['replicas'] - len(self._get_services_by_role(srv['role']))
 
-        def _is_global():
-            """Only one instance of this service shall exist within a cluster"""
-            return srv['deploy']['mode'] == 'global'
-
-        def _is_replicated():
-            """Replication requirement satisfied for this role"""
-            return len(self._get_services_by_role(srv['role'])) >= srv['deploy']['replicas']
-
-        def _role_is_deployed():
-            """A required number of this role's services already exists"""
-            return _is_global() and self._get_service_by_role(srv['role']) or not _is_global() and _is_replicated()
-
-        def _dependencies_fulfilled():
-            """All required services exist"""
-            is_fulfilled = True
-            for dep in srv['depends_on']:
-                if dep != 'None' and not self._get_service_by_role(dep):
-                    is_fulfilled = False
-            return is_fulfilled
-
-        while _queued_services:
-            for srv in _queued_services:
-                while not _role_is_deployed() and _dependencies_fulfilled():
-
-                    # Ask scheduler for a suitable cloud
-                    scheduled_cloud = scheduler.place(self._clouds, srv, self._sla)
-                    # TODO Fail if None
-
-                    scheduled_port = scheduled_cloud.request_port()
-                    run_config = {
-                        'ip': scheduled_cloud.request_ip(),
-                        'port': scheduled_port,
-                        'id': scheduled_port
-                    }
-
-                    # We have to update the service template before deploying (--ip and --port)
-                    # Without Consul/ZooKeeper, the included app may depend on this IP/Port information
-                    # A non-global service will be changed again, so there is no need to persist it
-                    updated_app_template = self._template.update({srv['role']: run_config}, persist=_is_global())
-
-                    # Get updated template for this service
-                    srv_template = next((s for s in updated_app_template['services'] if s['role'] == srv['role']), None)
-
-                    self._services.append(Service(srv_template, scheduled_cloud, run_config))
-
-                    if _role_is_deployed():
-                        _queued_services.remove(srv)
+    def _deploy_services(self):
+        """Deploy all missing service instances, one dependency wave at a time"""
+
+        # Plan the whole app at once, already deployed instances stay where they are
+        deployed = {srv['role']: [s.cloud for s in self._get_services_by_role(srv['role'])]
+                    for srv in self._template['services']}
+        with span('schedule'):
+            if self._ledger is not None:
+                plan = self._ledger.plan(self.id, self._template['services'], self._sla,
+                                         time_budget=self._time_budget, fixed=deployed, profiles=self._profiles)
+            else:
+                plan = scheduler.optimize(self._clouds, self._template['services'], self._sla,
+                                          time_budget=self._time_budget, fixed=deployed, profiles=self._profiles)
+        with span('prefetch'):
+            self._prefetch_images(plan)
+
+        for wave in scheduler.dependency_waves(self._template['services']):
+            jobs = []
+            for srv in wave:
+                if not self._dependencies_fulfilled(srv):
+                    raise RuntimeError("Dependencies of role '{}' are not deployed".format(srv['role']))
+
+                # Port allocation and rendering are cheap and stateful,
+                # so they stay sequential. Only the provider calls run in parallel.
+                planned = plan.clouds(srv['role'])[len(deployed[srv['role']]):]
+                for scheduled_cloud in planned[:self._missing_instances(srv)]:
+                    jobs.append(self._prepare_instance(srv, scheduled_cloud))
+
+            if not jobs:
+                continue
+
+            started = time.monotonic()
+            with span('wave ' + ','.join(srv['role'] for srv in wave)):
+                services, running_in = self._start_services(jobs)
+            self._services.extend(services)
+            if self._store is not None:
+                self._store.add_services(self.id, services)
+
+            # Dependent services wait until this wave answers its health checks, not for a fixed delay
+            if self._health is not None:
+                with span('ready ' + ','.join(srv['role'] for srv in wave)):
+                    self._wait_ready(services, wave)
+
+            if self._profiles is not None:
+                self._profiles.record_ready(services, self._ready_times(services, started, running_in))
+
+        self._template.flush()
+
+    def _wait_ready(self, services, wave):
+        """Wait until the instances of a wave answer their health checks, raises after the ready timeout"""
+        # Without a configured timeout, the health check specs tell how long starting may take
+        timeout = self._ready_timeout or self._health.ready_timeout(services)
+        if not self._health.wait_ready(services, timeout):
+            raise RuntimeError("Services {} of wave {} did not become healthy within {:.0f}s".format(
+                [service.id for service in services if not self._health.is_ready(service)],
+                [srv['role'] for srv in wave], timeout))
+
+    def _ready_times(self, services, started, running_in):
+        """Seconds until each instance answered its health check, else until it was running on its own"""
+        seconds = {}
+        for service in services:
+            health = self._health.health(service) if self._health is not None else None
+            if health is not None and health.spec.enabled and health.ready_at is not None:
+                seconds[service.id] = health.ready_at - started
+            elif running_in.get(service.id) is not None:
+                seconds[service.id] = running_in[service.id]
+        # Without either signal (a batch without health checks) nothing is recorded
+        return seconds
+
+    def _start_services(self, jobs):
+        """Deploy the prepared instances of a wave, also returns the seconds each instance took to run
+
+        Clouds with a batch API (deploy_templates) get all their instances in one call,
+        so VMs boot side by side and have no time of their own. Other instances are deployed one per thread.
+        If any instance fails, the wave is rolled back: the instances already running are removed
+        and their allocations released, then the first error is raised.
+        """
+        batches = {}
+        tasks = []
+        for job in jobs:
+            cloud = job[1]
+            if not hasattr(cloud, 'deploy_templates'):
+                tasks.append([job])
+            elif cloud.id in batches:
+                batches[cloud.id].append(job)
+            else:
+                batches[cloud.id] = [job]
+                tasks.append(batches[cloud.id])
+
+        with Pool(min(self._concurrency, len(tasks))) as pool:
+            outcomes = pool.map(self._try_start_batch, tasks)
+        deployed = [result for results, _ in outcomes for result in results]
+        errors = [error for _, error in outcomes if error is not None]
+        if errors:
+            self._roll_back([service for service, _ in deployed])
+            raise errors[0]
+        return [service for service, _ in deployed], {service.id: seconds for service, seconds in deployed}
+
+    def _try_start_batch(self, jobs):
+        try:
+            return self._start_batch(jobs), None
+        except Exception as e:
+            return [], e
+
+    def _roll_back(self, services):
+        """Remove the instances of a failed wave, each on its own, so one failure does not keep the others"""
+        def destroy(service):
+            try:
+                service.destroy()
+            except Exception as e:
+                logging.error("Rolling back service {} failed: {}".format(service.id, e))
+
+        if services:
+            with Pool(min(self._concurrency, len(services))) as pool:
+                pool.map(destroy, services)
+
+    @staticmethod
+    def _start_batch(jobs):
+        cloud = jobs[0][1]
+        if not hasattr(cloud, 'deploy_templates'):
+            # A single instance per task, from the create call until it runs
+            started = time.monotonic()
+            try:
+                service = Service(*jobs[0])
+            except Exception:
+                cloud.release(jobs[0][2])
+                raise
+            return [(service, time.monotonic() - started)]
+
+        ids = [utils.create_uuid(template['role']) for template, _, _ in jobs]
+        with span('deploy batch', cloud=cloud.id):
+            instances = cloud.deploy_templates([(service_id, template, run_config)
+                                                for service_id, (template, _, run_config) in zip(ids, jobs)])
+        return [(Service(template, cloud, run_config, id=service_id, instance=instance,
+                         fingerprint=utils.fingerprint(template)), None)
+                for service_id, (template, _, run_config), instance in zip(ids, jobs, instances)]
+
+    def _prefetch_images(self, plan):
+        """Pull all images of the planned clouds in parallel, before any instance is created"""
+        pulls = {}
+        for srv in self._template['services']:
+            for cloud in plan.clouds(srv['role']):
+                image = srv['provider'][cloud.provider]['image']
+                pulls[(cloud.id, image)] = cloud
+
+        missing = [(cloud, image) for (_, image), cloud in pulls.items() if not cloud.has_image(image)]
+        if not missing:
+            return
+
+        logging.info("Prefetching {} images...".format(len(missing)))
+        with Pool(min(self._concurrency, len(missing))) as pool:
+            done = pool.imap_unordered(lambda pull: (pull, pull[0].prefetch_image(pull[1])), missing)
+            for count, ((cloud, image), _) in enumerate(done, start=1):
+                logging.info("Image {count}/{total} ready: {image} on {cloud}".format(
+                    count=count, total=len(missing), image=image, cloud=cloud.id))
+
+    def _prepare_instance(self, srv, scheduled_cloud):
+        """Allocate one service instance on its scheduled cloud and render its template"""
+        scheduled_port = scheduled_cloud.request_port()
+        try:
+            scheduled_ip = scheduled_cloud.request_ip()
+        except Exception:
+            scheduled_cloud.release({'ip': None, 'port': scheduled_port})
+            raise
+        run_config = {
+            'ip': scheduled_ip,
+            'port': scheduled_port,
+            'id': scheduled_port
+        }
+
+        # We have to update the service template before deploying (--ip and --port)
+        # Without Consul/ZooKeeper, the included app may depend on this IP/Port information
+        # A non-global service will be changed again, so there is no need to persist it
+        if self._is_global(srv):
+            self._template.update({srv['role']: run_config})
+
+        # Render only this service's part of the template
+        srv_template = self._template.render_service(srv['role'], {srv['role']: run_config})
+
+        return srv_template, scheduled_cloud, run_config
 
     def __repr__(self):
         return "<{name}: id={id}>".format(name=__name__, id=self.id)
@@ -155,21 +566,59 @@ class App:
 class Service:
     """A service instance is deployed within a scheduled cloud, according to its template"""
 
-    def __init__(self, template, cloud, run_config):
-        self.id = utils.create_uuid(template['role'])
+    def __init__(self, template, cloud, run_config, id=None, instance=None, fingerprint=None):
+        self.id = id or utils.create_uuid(template['role'])
+        # Removing and restarting (by health.HealthChecker) the same instance must not interleave
+        self._lock = threading.Lock()
+        self._destroyed = False
         self._role = template['role']
         self._cloud = cloud
         self._template = template
         self._run_config = run_config
-        self._instance = cloud.deploy_template(self.id, template, run_config)
-
-    # def __del__(self):
-    #     self._instance.destroy()
+        self._instance = instance
+        # An existing instance is adopted, not deployed again. Its fingerprint label tells what it runs.
+        self.fingerprint = fingerprint
+        if instance is None:
+            with span('deploy ' + self._role, cloud=cloud.id, service=self.id):
+                self._instance = cloud.deploy_template(self.id, template, run_config)
+            self.fingerprint = utils.fingerprint(template)
+
+    def destroy(self):
+        """Remove the instance and release its allocations"""
+        with self._lock:
+            if not self._destroyed:
+                self._cloud.destroy(self._instance, self._run_config)
+                self._destroyed = True
+
+    def restart(self, template=None):
+        """Replace the instance on the same cloud, keeping its ip and port, optionally with a new template"""
+        with self._lock:
+            if self._destroyed:
+                logging.warning("Service {} was removed, not restarted".format(self.id))
+                return
+            if template is not None:
+                self._template = template
+            self._cloud.destroy(self._instance)
+            with span('restart ' + self._role, cloud=self._cloud.id, service=self.id):
+                self._instance = self._cloud.deploy_template(self.id, self._template, self._run_config)
+            self.fingerprint = utils.fingerprint(self._template)
 
     @property
     def role(self):
         return self._role
 
+    @property
+    def template(self):
+        return self._template
+
+    @property
+    def run_config(self):
+        return self._run_config
+
+    @property
+    def cloud(self):
+        return self._cloud
+
     @property
     def port(self):
         # TODO get this dynamically (impossible for docker)
@@ -0,0 +1,153 @@
+import logging
+import math
+import threading
+import time
+
+
+# SLA keys read by the autoscaler (all optional):
+#     throughput:  100      Minimum queries/s of the whole app
+#     latency:     50       Maximum p99 latency in ms
+#     min_replicas: 1       Never scale in below
+#     max_replicas: 10      Never scale out above
+
+
+def benchmark_app(app, query_file='./services/queries/q1.json', entry_role='dispatcher',
+                  concurrency=4, num_queries=200, timeout=10.0, profiles=None):
+    """Measure an app through its entry service, as (queries/s, p99 latency in ms) or None if invalid"""
+    from services.query_hyrise import benchmark
+
+    entry = next((s for s in app.services if s.role == entry_role), None)
+    if entry is None:
+        return None
+    result = benchmark(entry.ip, entry.port, query_file, concurrency, num_queries,
+                       print_result=False, timeout=timeout, prepare=False)
+    if profiles is not None:
+        profiles.record_benchmark(app, result)
+    if not result.valid:
+        return None
+    return result.throughput, result.histogram.percentile(99) * 1e3
+
+
+class Autoscaler:
+    """
+    Throughput-driven Control Loop of a Replicated Role
+
+    Each check measures the app and compares it to the SLA targets.
+    - Missing a target scales out at once, proportional to the shortfall.
+    - Scaling in needs headroom: even without one replica, throughput has to stay
+      above target * headroom for several checks in a row (hysteresis).
+    - Scaling in removes unhealthy replicas (starting, failing their checks) first, then the most expensive.
+      Healthy replicas are all assumed to serve, their load is not measured.
+    - After any change, checks are skipped for a cooldown, so the app can settle.
+    """
+
+    def __init__(self, app, sla, role='replica', measure=None, headroom=1.2, stable_checks=3,
+                 cooldown=120.0, interval=30.0, max_step=4, clock=time.monotonic, profiles=None, health=None):
+        self._app = app
+        self._role = role
+        self._health = health
+        # Measurements also teach profiles.Profiles the replicas' throughput per cloud
+        self._measure = measure or (lambda: benchmark_app(app, profiles=profiles))
+        self._throughput = sla.get('throughput')
+        self._latency = sla.get('latency')
+        self._min_replicas = sla.get('min_replicas', 1)
+        self._max_replicas = sla.get('max_replicas', 10)
+        self._headroom = headroom
+        self._stable_checks = stable_checks
+        self._cooldown = cooldown
+        self._interval = interval
+        self._max_step = max_step
+        self._clock = clock
+        self._relaxed = 0
+        self._cooldown_until = 0.0
+        self._stop = threading.Event()
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def _healthy(self):
+        """Replicas ready and alive by their health checks, None (all) if unchecked"""
+        if self._health is None:
+            return None
+        return {s.id for s in self._app.services
+                if s.role == self._role and self._health.is_ready(s) and self._health.is_alive(s)}
+
+    def _violated(self, throughput, latency):
+        """A target is missed"""
+        return (self._throughput is not None and throughput < self._throughput) or \
+            (self._latency is not None and latency > self._latency)
+
+    def _relaxed_without_one(self, throughput, latency, replicas):
+        """Targets would still be met with headroom, with one replica less"""
+        if replicas <= self._min_replicas or self._throughput is None:
+            return False
+        remaining = throughput * (replicas - 1) / replicas
+        return remaining >= self._throughput * self._headroom and \
+            (self._latency is None or latency * self._headroom <= self._latency)
+
+    def decide(self, throughput, latency, replicas):
+        """Desired number of replicas for a measurement, updating the hysteresis state"""
+        if self._violated(throughput, latency):
+            self._relaxed = 0
+            if throughput and self._throughput:
+                # Throughput grows roughly linear with read replicas
+                needed = math.ceil(replicas * self._throughput / throughput) - replicas
+            else:
+                needed = 1
+            return min(replicas + max(1, min(needed, self._max_step)), self._max_replicas)
+
+        if self._relaxed_without_one(throughput, latency, replicas):
+            self._relaxed += 1
+            if self._relaxed >= self._stable_checks:
+                self._relaxed = 0
+                return replicas - 1
+        else:
+            self._relaxed = 0
+        return replicas
+
+    def check(self):
+        """Measure once and scale if needed, returns the change in replicas"""
+        if self._clock() < self._cooldown_until:
+            return 0
+
+        measurement = self._measure()
+        if measurement is None:
+            logging.warning("Autoscaler: no valid measurement of {}, skipped".format(self._app.id))
+            return 0
+        throughput, latency = measurement
+
+        replicas = self._app.replicas(self._role)
+        desired = self.decide(throughput, latency, replicas)
+        if desired == replicas:
+            return 0
+
+        logging.info("Autoscaler: {role} {old} -> {new} at {throughput:.1f} queries/s, p99 {latency:.1f} ms".format(
+            role=self._role, old=replicas, new=desired, throughput=throughput, latency=latency))
+        errors = self._app.scale(self._role, desired, healthy=self._healthy())
+        if errors:
+            logging.warning("Autoscaler: {} replicas of {} could not be removed: {}".format(
+                len(errors), self._app.id, sorted(errors)))
+        self._cooldown_until = self._clock() + self._cooldown
+        return desired - replicas
+
+    def run(self):
+        """Check periodically until stopped"""
+        while not self._stop.wait(self._interval):
+            try:
+                self.check()
+            except Exception:
+                logging.exception("Autoscaler check of {} failed".format(self._app.id))
+
+    def start(self):
+        """Run the control loop in a background thread"""
+        thread = threading.Thread(target=self.run, name='autoscaler-{}'.format(self._app.id), daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
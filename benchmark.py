@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+#  -*- coding: UTF-8 -*-
+"""
+Offline Broker Benchmarks
+
+Run with: python3 benchmark.py <suite> [--replicas 1 10 100 ...]
+"""
+
+import argparse
+import copy
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+
+import jinja2
+import ruamel.yaml as yaml
+
+import deployment
+import scheduler
+from app import App, Template, IgnoreMissingAttribute
+from cloud import SimulatedCloud
+from state import StateStore
+
+
+def _load_template(replicas, path='./services/hyrise.yaml'):
+    """Load the Hyrise-R service template with a given number of replicas"""
+    with open(path) as stream:
+        template = yaml.YAML().load(stream)
+    for srv in template['services']:
+        if srv['deploy']['mode'] == 'replicated':
+            srv['deploy']['replicas'] = replicas
+    return template
+
+
+def _legacy_update(path, value):
+    """Template.update as it was: new Environment, read, render, reparse and rewrite per call"""
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader('/'), undefined=IgnoreMissingAttribute)
+    updated_template = yaml.YAML().load(env.get_template(path).render(value))
+    with open(path, 'w') as f:
+        yaml.YAML().dump(updated_template, f)
+    return next(s for s in updated_template['services'] if s['role'] == 'replica')
+
+
+def bench_template(replicas_list):
+    """Rendering cost per service instance"""
+    print("{:>8}  {:>14}  {:>14}".format('replicas', 'legacy us/inst', 'engine us/inst'))
+    for replicas in replicas_list:
+        template = _load_template(replicas)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'legacy.yaml')
+            with open(path, 'w') as f:
+                yaml.YAML().dump(copy.deepcopy(template), f)
+            start = time.perf_counter()
+            for i in range(replicas):
+                _legacy_update(path, {'replica': {'ip': '127.0.0.1', 'port': 6000 + i, 'id': i}})
+            legacy = (time.perf_counter() - start) / replicas
+
+        start = time.perf_counter()
+        engine = Template('bench', template, path=None)
+        for i in range(replicas):
+            engine.render_service('replica', {'replica': {'ip': '127.0.0.1', 'port': 6000 + i, 'id': i}})
+        engine.flush()
+        compiled = (time.perf_counter() - start) / replicas
+
+        print("{:>8}  {:>14.1f}  {:>14.1f}".format(replicas, legacy * 1e6, compiled * 1e6))
+
+
+def _offers(num_clouds, seed=0):
+    """Synthetic cloud offers with the attributes the scheduler reads"""
+    rnd = random.Random(seed)
+    return [SimpleNamespace(id='cloud{}'.format(i),
+                            provider=rnd.choice(['docker', 'openstack']),
+                            location=rnd.choice(['de', 'nl', 'us']),
+                            cost=round(rnd.uniform(0.5, 4), 2),
+                            availability=round(rnd.uniform(0.9, 0.999), 3),
+                            performance=round(rnd.uniform(0.5, 2), 2),
+                            capacity={'cpus': rnd.choice([2, 8, 32]), 'memory': rnd.choice(['4G', '16G', '64G'])})
+            for i in range(num_clouds)]
+
+
+def bench_scheduling(replicas_list):
+    """Ranking all service instances across cloud offers"""
+    sla = {'locations': ['de', 'nl'], 'availability': 0.95}
+    print("{:>8}  {:>8}  {:>12}".format('replicas', 'clouds', 'rank ms'))
+    for replicas in replicas_list:
+        template = _load_template(replicas)
+        instances = [srv for srv in template['services']
+                     for _ in range(1 if srv['deploy']['mode'] == 'global' else replicas)]
+        for num_clouds in (10, 100, 500):
+            offers = scheduler.Offers(_offers(num_clouds))
+            start = time.perf_counter()
+            scheduler.rank_indices(offers, instances, sla)
+            elapsed = time.perf_counter() - start
+            print("{:>8}  {:>8}  {:>12.2f}".format(replicas, num_clouds, elapsed * 1e3))
+
+
+def _violations(placement, templates, sla):
+    """Constraints of the SLA a placement does not meet"""
+    violations = []
+    target = sla.get('replica_availability')
+    for srv in templates:
+        if target and srv['deploy']['mode'] != 'global' and placement.availability(srv['role']) < target - 1e-12:
+            violations.append('availability')
+    demands = dict(zip([srv['role'] for srv in templates], scheduler._demands(templates).tolist()))
+    load = {}
+    for srv in templates:
+        for cloud in placement.clouds(srv['role']):
+            used = load.setdefault(cloud.id, [0.0, 0.0])
+            used[0] += demands[srv['role']][0]
+            used[1] += demands[srv['role']][1]
+            if used[1] > scheduler._memory_mb(cloud.capacity['memory']) or used[0] > cloud.capacity['cpus']:
+                violations.append('capacity')
+    return sorted(set(violations))
+
+
+def bench_placement(replicas_list):
+    """Whole-app optimizer against greedy placement per instance"""
+    sla = {'locations': ['de', 'nl'], 'replica_availability': 0.999}
+    print("{:>8}  {:>6}  {:>10}  {:>10}  {:>22}  {:>10}  {:>8}".format(
+        'replicas', 'clouds', 'greedy ms', 'greedy', 'violations', 'optimal ms', 'optimal'))
+    for replicas in replicas_list:
+        template = _load_template(replicas)
+        for num_clouds in (5, 20, 100):
+            offers = _offers(num_clouds)
+            greedy = scheduler.greedy(offers, template['services'], sla)
+            start = time.perf_counter()
+            try:
+                optimized = scheduler.optimize(offers, template['services'], sla, time_budget=2.0)
+                result = "{:.2f}{}".format(optimized.cost, '' if optimized.optimal else '*')
+            except scheduler.SchedulerError:
+                result = 'infeasible'
+            elapsed = time.perf_counter() - start
+            print("{:>8}  {:>6}  {:>10.2f}  {:>10.2f}  {:>22}  {:>10.2f}  {:>8}".format(
+                replicas, num_clouds, greedy.elapsed * 1e3, greedy.cost,
+                ','.join(_violations(greedy, template['services'], sla)) or '-', elapsed * 1e3, result))
+    print("* time budget exhausted, best placement found so far")
+    print("Greedy ignores shared capacity and replica availability, see violations")
+
+
+def _simulated_clouds(num_clouds, latency=0.0, batch=False):
+    """Simulated clouds in one location, without capacity limits"""
+    return [SimulatedCloud({'id': 'sim{}'.format(i),
+                            'availability': 0.99,
+                            'cost': 1 + i % 3,
+                            'location': {'country': 'de'},
+                            'ports': {'first': 10000, 'last': 60000},
+                            'simulation': {'latency': latency, 'batch': batch}})
+            for i in range(num_clouds)]
+
+
+def _deploy(replicas, clouds):
+    """Deploy the Hyrise-R app, state goes to an in-memory store instead of ./deployments"""
+    return App(_load_template(replicas), {}, clouds, store=StateStore(':memory:'))
+
+
+def bench_deploy(replicas_list):
+    """App deployment on simulated clouds, broker overhead and with 5 ms API latency"""
+    print("{:>8}  {:>14}  {:>14}  {:>10}".format('replicas', 'overhead ms', '5ms api ms', 'api calls'))
+    for replicas in replicas_list:
+        start = time.perf_counter()
+        _deploy(replicas, _simulated_clouds(5))
+        overhead = time.perf_counter() - start
+
+        clouds = _simulated_clouds(5, latency=0.005)
+        start = time.perf_counter()
+        _deploy(replicas, clouds)
+        latency = time.perf_counter() - start
+
+        print("{:>8}  {:>14.1f}  {:>14.1f}  {:>10}".format(
+            replicas, overhead * 1e3, latency * 1e3, sum(c.api_calls for c in clouds)))
+
+
+def bench_teardown(replicas_list):
+    """Label-scoped app teardown on simulated clouds with 5 ms API latency"""
+    print("{:>8}  {:>12}  {:>10}".format('replicas', 'teardown ms', 'remaining'))
+    for replicas in replicas_list:
+        clouds = _simulated_clouds(5, latency=0.005)
+        deployed_app = _deploy(replicas, clouds)
+        deployment._clouds[:] = clouds
+        start = time.perf_counter()
+        deployment.destroy_app(deployed_app.id)
+        elapsed = time.perf_counter() - start
+        print("{:>8}  {:>12.1f}  {:>10}".format(replicas, elapsed * 1e3, sum(len(c.instances) for c in clouds)))
+    deployment._clouds[:] = []
+
+
+def bench_multiapp(replicas_list, num_apps=8):
+    """Batch of apps on shared simulated clouds with 5 ms API latency, one at a time and concurrently"""
+    print("{:>8}  {:>14}  {:>14}".format('replicas', 'sequential/min', 'concurrent/min'))
+    # An in-memory store keeps ./deployments clean
+    deployment.open_state(':memory:')
+    deployment._clouds[:] = _simulated_clouds(5, latency=0.005)
+    for replicas in replicas_list:
+        rates = []
+        for concurrency in (1, 4):
+            report = deployment.deploy_apps([(_load_template(replicas), {})] * num_apps, concurrency=concurrency)
+            rates.append(report['apps_per_minute'])
+            # Teardown releases the apps' capacity on the shared clouds for the next batch
+            for deployed_app in report['apps']:
+                deployment.destroy_app(deployed_app.id)
+        print("{:>8}  {:>14.1f}  {:>14.1f}".format(replicas, *rates))
+    deployment._clouds[:] = []
+
+
+SUITES = {
+    'deploy': bench_deploy,
+    'multiapp': bench_multiapp,
+    'placement': bench_placement,
+    'scheduling': bench_scheduling,
+    'teardown': bench_teardown,
+    'template': bench_template,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline Broker Benchmarks')
+    parser.add_argument('suite', choices=sorted(SUITES) + ['all'])
+    parser.add_argument('--replicas', nargs='+', default=[1, 10, 100, 1000], type=int,
+                        help='Replica counts to measure')
+    args = parser.parse_args()
+
+    for name in sorted(SUITES) if args.suite == 'all' else [args.suite]:
+        print("# {}: {}".format(name, SUITES[name].__doc__))
+        SUITES[name](args.replicas)
+
+
+if __name__ == '__main__':
+    main()
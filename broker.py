@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+#  -*- coding: UTF-8 -*-
+"""
+Long-Running Broker with an HTTP Control API
+
+Clouds, drivers, inventory and apps stay in memory between requests,
+so only the first request pays for parsing clouds.yaml and connecting.
+
+Run with: python3 broker.py [--host 127.0.0.1] [--port 8080]
+
+    GET    /apps                       Deployed apps and their instances
+    POST   /apps                       {"id": "hyrise", "sla": {}}  or  {"batch": [["hyrise", {}], ...]}
+    POST   /apps/<app id>/scale        {"role": "replica", "replicas": 3}
+    DELETE /apps/<app id>
+    GET    /inventory[?refresh=1]      Instances on all clouds, refresh asks the clouds first
+    POST   /benchmark                  {"id": <app id>}  Throughput through the app's dispatcher
+    GET    /jobs                       All jobs
+    GET    /jobs/<job id>
+
+Deploy, scale, destroy and benchmark return a job handle (202) at once,
+poll /jobs/<job id> for its status and result.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import deployment
+import utils
+from log import init
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            500: 'Internal Server Error'}
+
+# App templates are files in services/, so their ids must not contain paths
+_TEMPLATE_ID = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Job:
+    """Handle of a Broker Operation Running in the Background"""
+
+    def __init__(self, action, app_id=None):
+        self.id = str(utils.create_uuid(action))
+        self.action = action
+        self.app_id = app_id
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        return {'id': self.id, 'action': self.action, 'app_id': self.app_id, 'status': self.status,
+                'result': self.result, 'error': self.error, 'created': self.created, 'finished': self.finished}
+
+
+def _service_dict(service):
+    return {'id': service.id, 'role': service.role, 'cloud': service.cloud.id, 'ip': service.ip,
+            'port': service.port}
+
+
+def _app_dict(deployed_app):
+    return {'id': deployed_app.id, 'services': [_service_dict(service) for service in deployed_app.services]}
+
+
+def _instance_dict(instance):
+    return {'cloud': instance.cloud.id, 'name': instance.name, 'app_id': instance.app_id, 'role': instance.role,
+            'ip': instance.ip, 'port': instance.port}
+
+
+def _benchmark_dict(result):
+    return {'throughput': result.throughput, 'completed': result.completed, 'errors': result.errors,
+            'timeouts': result.timeouts, 'valid': result.valid, 'latency_ms': result.histogram.summary()}
+
+
+class Broker:
+    """
+    HTTP Control API on top of the deployment module
+
+    Requests are parsed and answered on one event loop. Provider calls block,
+    so operations run in a thread pool and are tracked as jobs.
+    Jobs of the same app run one after another, different apps in parallel.
+    Apps whose SLA sets a throughput or latency target are checked by their
+    autoscaler.Autoscaler, also in turn with the app's jobs.
+    """
+
+    # Finished jobs kept for polling, the oldest are dropped first
+    MAX_JOBS = 1000
+
+    def __init__(self, clouds='clouds.yaml', state='./deployments/state.db', workers=8):
+        self._clouds_path = clouds
+        self._state_path = state
+        self._executor = ThreadPoolExecutor(workers)
+        self._jobs = OrderedDict()
+        self._app_locks = {}
+        self._autoscaled = set()
+        self._server = None
+        self._routes = [
+            ('GET', ('apps',), self.list_apps),
+            ('POST', ('apps',), self.deploy),
+            ('POST', ('apps', None, 'scale'), self.scale),
+            ('DELETE', ('apps', None), self.destroy),
+            ('GET', ('inventory',), self.inventory),
+            ('POST', ('benchmark',), self.benchmark),
+            ('GET', ('jobs',), self.list_jobs),
+            ('GET', ('jobs', None), self.get_job),
+        ]
+
+    def setup(self):
+        """Connect all clouds and take over the apps still running from an earlier broker"""
+        deployment.open_state(self._state_path)
+        deployment._init_clouds(self._clouds_path, connect=True)
+        deployment.restore_apps()
+        logging.info("Broker ready with {} clouds and {} apps".format(
+            len(deployment._clouds), len(deployment._apps)))
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        for restored_app in list(deployment._apps):
+            self._autoscale(restored_app.id)
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logging.info("Broker listening on http://{}:{}".format(host, port))
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for app_id in list(deployment._autoscalers):
+            deployment.stop_autoscaling(app_id)
+        self._executor.shutdown(wait=True)
+        deployment._health.stop()
+
+    # Jobs
+
+    def _submit(self, action, function, *args, app_id=None, serialize=None, then=None):
+        """Run a blocking operation in the background, returns its job handle, then(result) on success"""
+        job = Job(action, app_id)
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.MAX_JOBS:
+            oldest = next(iter(self._jobs.values()))
+            if oldest.status in (PENDING, RUNNING):
+                break
+            self._jobs.popitem(last=False)
+        asyncio.ensure_future(self._run(job, function, args, serialize, then))
+        return job
+
+    def _app_lock(self, app_id):
+        return self._app_locks.setdefault(app_id, asyncio.Lock())
+
+    async def _run(self, job, function, args, serialize, then):
+        lock = self._app_lock(job.app_id) if job.app_id else None
+        if lock is not None:
+            await lock.acquire()
+        try:
+            job.status = RUNNING
+            result = await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+            job.result = serialize(result) if serialize else result
+            job.status = DONE
+            if then is not None:
+                then(result)
+        except Exception as e:
+            logging.error("Job {} failed: {}".format(job.id, e))
+            job.error = repr(e)
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+            if lock is not None:
+                lock.release()
+
+    def _autoscale(self, app_id):
+        """Start periodic autoscaler checks of an app, if its SLA asks for it"""
+        autoscaler = deployment.get_autoscaler(app_id)
+        if autoscaler is not None and app_id not in self._autoscaled:
+            self._autoscaled.add(app_id)
+            asyncio.ensure_future(self._autoscale_loop(app_id, autoscaler))
+
+    async def _autoscale_loop(self, app_id, autoscaler):
+        # Stopped by deployment.destroy_app
+        try:
+            while not autoscaler.stopped:
+                await asyncio.sleep(autoscaler.interval)
+                if autoscaler.stopped:
+                    break
+                async with self._app_lock(app_id):
+                    try:
+                        await asyncio.get_event_loop().run_in_executor(self._executor, autoscaler.check)
+                    except Exception:
+                        logging.exception("Autoscaler check of {} failed".format(app_id))
+        finally:
+            self._autoscaled.discard(app_id)
+
+    # Handlers
+
+    async def list_apps(self, query, body):
+        return 200, [_app_dict(deployed_app) for deployed_app in list(deployment._apps)]
+
+    async def deploy(self, query, body):
+        if 'batch' in body:
+            batch = [(self._template_id(template), sla) for template, sla in body['batch']]
+            job = self._submit('deploy', deployment.deploy_apps, batch, serialize=lambda report: {
+                'apps': [a.id for a in report['apps']],
+                'errors': {str(i): repr(e) for i, e in report['errors'].items()},
+                'elapsed': report['elapsed'],
+                'apps_per_minute': report['apps_per_minute']},
+                then=lambda report: [self._autoscale(a.id) for a in report['apps']])
+        else:
+            template = self._template_id(body.get('id', 'hyrise'))
+            job = self._submit('deploy', deployment.deploy_app, template, body.get('sla'),
+                               serialize=_app_dict, then=lambda deployed_app: self._autoscale(deployed_app.id))
+        return 202, job.to_dict()
+
+    async def scale(self, query, body, app_id):
+        self._find_app(app_id)
+        if 'role' not in body or 'replicas' not in body:
+            raise HttpError(400, "Scaling needs a role and a number of replicas")
+        job = self._submit('scale', deployment.scale_app, app_id, body['role'], int(body['replicas']),
+                           app_id=app_id, serialize=lambda errors: dict(
+                               _app_dict(self._find_app(app_id)),
+                               errors={service_id: repr(error) for service_id, error in errors.items()}))
+        return 202, job.to_dict()
+
+    async def destroy(self, query, body, app_id):
+        job = self._submit('destroy', deployment.destroy_app, app_id, app_id=app_id, serialize=lambda errors: {
+            '{}/{}'.format(*key): repr(error) for key, error in errors.items()})
+        return 202, job.to_dict()
+
+    async def inventory(self, query, body):
+        refresh = query.get('refresh', ['0'])[0] not in ('0', 'false', '')
+        # The first call lists all clouds, later refreshes only fetch changes
+        inventory = await asyncio.get_event_loop().run_in_executor(
+            self._executor, deployment.get_inventory, refresh or deployment._inventory is None)
+        return 200, [_instance_dict(instance) for instance in inventory.instances()]
+
+    async def benchmark(self, query, body):
+        job = self._submit('benchmark', deployment.get_throughput, body.get('id'), serialize=_benchmark_dict)
+        return 202, job.to_dict()
+
+    async def list_jobs(self, query, body):
+        return 200, [job.to_dict() for job in self._jobs.values()]
+
+    async def get_job(self, query, body, job_id):
+        if job_id not in self._jobs:
+            raise HttpError(404, "Unknown job '{}'".format(job_id))
+        return 200, self._jobs[job_id].to_dict()
+
+    @staticmethod
+    def _template_id(template):
+        if not isinstance(template, str) or not _TEMPLATE_ID.match(template):
+            raise HttpError(400, "Invalid app template id {!r}".format(template))
+        return template
+
+    @staticmethod
+    def _find_app(app_id):
+        found = next((a for a in deployment._apps if a.id == app_id), None)
+        if found is None:
+            raise HttpError(404, "Unknown app '{}'".format(app_id))
+        return found
+
+    # HTTP
+
+    async def dispatch(self, method, target, body):
+        """Route a request, returns the status and a JSON-serializable answer"""
+        url = urlsplit(target)
+        parts = tuple(part for part in url.path.split('/') if part)
+        allowed = False
+        for route_method, pattern, handler in self._routes:
+            if len(pattern) != len(parts) or any(p is not None and p != part for p, part in zip(pattern, parts)):
+                continue
+            if route_method != method:
+                allowed = True
+                continue
+            params = [part for p, part in zip(pattern, parts) if p is None]
+            return await handler(parse_qs(url.query), body, *params)
+        if allowed:
+            raise HttpError(405, "{} is not allowed on {}".format(method, url.path))
+        raise HttpError(404, "No route for {}".format(url.path))
+
+    async def _handle_connection(self, reader, writer):
+        """Answer HTTP/1.1 requests on a keep-alive connection"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                raw = await reader.readexactly(length) if length else b''
+
+                try:
+                    body = json.loads(raw.decode()) if raw else {}
+                    status, answer = await self.dispatch(method.upper(), target, body)
+                except HttpError as e:
+                    status, answer = e.status, {'error': str(e)}
+                except (ValueError, KeyError, TypeError) as e:
+                    status, answer = 400, {'error': repr(e)}
+                except Exception as e:
+                    logging.exception("Request {} {} failed".format(method, target))
+                    status, answer = 500, {'error': repr(e)}
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                payload = json.dumps(answer, default=str).encode()
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                             "Connection: {}\r\n\r\n".format(status, _REASONS.get(status, ''), len(payload),
+                                                             'keep-alive' if keep_alive else 'close').encode())
+                writer.write(payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logging.debug("Connection closed: {}".format(e))
+        finally:
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Broker HTTP API')
+    parser.add_argument('--host', default='127.0.0.1', help='Listen address')
+    parser.add_argument('--port', default=8080, type=int, help='Listen port')
+    parser.add_argument('--clouds', default='clouds.yaml', help='Cloud configurations')
+    parser.add_argument('--state', default='./deployments/state.db', help='State store')
+    parser.add_argument('--workers', default=8, type=int, help='Operations running at the same time')
+    args = parser.parse_args()
+
+    init('INFO')
+    broker = Broker(args.clouds, args.state, args.workers)
+    broker.setup()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(broker.serve(args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(broker.close())
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import threading
+import time
+
+
+class ListingCache:
+    """
+    Indexed Provider Listing, Refreshed after a TTL
+
+    Listing images, containers or nodes is a full provider API round trip.
+    We keep the last listing together with a key index (name, path, ...),
+    so lookups are O(1) and the API is asked at most once per TTL.
+    Deploying or destroying invalidates or patches the listing explicitly.
+    """
+
+    def __init__(self, fetch, key, ttl=30):
+        self._fetch = fetch
+        self._key = key
+        self._ttl = ttl
+        self._lock = threading.RLock()
+        self._items = []
+        self._index = {}
+        self._expires = 0
+
+    def _refresh(self):
+        """Fetch the listing and rebuild the index"""
+        items = list(self._fetch())
+        index = {}
+        for item in items:
+            # Keep the first match, as a linear scan would have done
+            index.setdefault(self._key(item), item)
+        self._items = items
+        self._index = index
+        self._expires = time.monotonic() + self._ttl
+
+    def _ensure_fresh(self):
+        # Concurrent callers wait for a single listing instead of issuing their own
+        with self._lock:
+            if time.monotonic() >= self._expires:
+                self._refresh()
+
+    def all(self):
+        """List all Items"""
+        self._ensure_fresh()
+        return list(self._items)
+
+    def get(self, key, default=None):
+        """Get Item by Key"""
+        self._ensure_fresh()
+        return self._index.get(key, default)
+
+    def put(self, item):
+        """Add or Replace an Item without Refreshing"""
+        with self._lock:
+            key = self._key(item)
+            self._items = [i for i in self._items if self._key(i) != key] + [item]
+            self._index[key] = item
+
+    def discard(self, key):
+        """Remove an Item without Refreshing"""
+        with self._lock:
+            if self._index.pop(key, None) is not None:
+                self._items = [i for i in self._items if self._key(i) != key]
+
+    def invalidate(self):
+        """Force a Refresh on next Access"""
+        with self._lock:
+            self._expires = 0
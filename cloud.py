@@ -1,8 +1,15 @@
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime
 from multiprocessing.dummy import Pool
 
-from libcloud.compute.drivers.openstack import OpenStackNodeDriver
-from libcloud.container.drivers.docker import DockerContainerDriver
-
+from allocation import AllocationError, FloatingIpPool, PortAllocator
+from cache import ListingCache
+from gateway import Gateway
+from utils import fingerprint
 from log import traced, ignored
 
 
@@ -10,20 +17,107 @@ from log import traced, ignored
 # Wrapping libcloud in a pythonic, really cloud-agnostic way #
 ##############################################################
 
-class Cloud:
+# Every instance carries the broker's bookkeeping as labels (Docker) or metadata (OpenStack)
+LABEL_APP = 'de.janmattfeld.cloud.app.id'
+LABEL_SERVICE = 'de.janmattfeld.cloud.service.id'
+LABEL_ROLE = 'de.janmattfeld.cloud.role'
+LABEL_IP = 'de.janmattfeld.cloud.ip'
+LABEL_PORT = 'de.janmattfeld.cloud.port'
+LABEL_FINGERPRINT = 'de.janmattfeld.cloud.fingerprint'
+
+
+def instance_labels(name, template, run_config):
+    """Template labels plus broker bookkeeping, as flat string dictionary"""
+    labels = {}
+    for label in template.get('labels', []):
+        labels.update({str(key): str(value) for key, value in label.items()})
+    labels.update({
+        LABEL_SERVICE: name,
+        LABEL_ROLE: template['role'],
+        LABEL_IP: str(run_config['ip']),
+        LABEL_PORT: str(run_config['port']),
+        LABEL_FINGERPRINT: fingerprint(template),
+    })
+    return labels
+
+
+def parse_events(body):
+    """Docker Events from a Newline-Delimited JSON Body"""
+    if isinstance(body, bytes):
+        body = body.decode()
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+class LazyConnection:
+    """
+    Driver Connection, Established on First Use
+
+    Creating a libcloud driver authenticates against the provider,
+    so we defer it until a cloud is actually asked for something.
+    Scheduling only reads the configuration and never connects.
+    All calls pass the cloud's gateway.Gateway (rate limit, coalescing, retries).
+    """
+
+    _driver = None
+    _driver_lock = threading.Lock()
+
+    @property
+    def _conn(self):
+        driver = self._driver
+        if driver is None:
+            with self._driver_lock:
+                if self._driver is None:
+                    self._driver = Gateway(self._connect(), **(self._cfg.get('gateway') or {}))
+                    self._on_connect()
+                driver = self._driver
+        return driver
+
+    @property
+    def connected(self):
+        """Driver is already Established"""
+        return self._driver is not None
+
+    def connect(self):
+        """Establish the Driver Connection now"""
+        return self._conn
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _on_connect(self):
+        """Prepare the Cloud once its Driver is Established"""
+
+
+class Cloud(LazyConnection):
     @traced('text')
     def __init__(self, cfg):
         """Initialize Cloud"""
         self._cfg = cfg
-        self._conn = DockerContainerDriver(key="",
-                                           secret="",
-                                           host=cfg['auth']['host'],
-                                           port=cfg['auth']['port'])
-        self._next_free_port = 5099
+        self._driver_lock = threading.Lock()
         self.id = self._cfg['id']
         self.availability = self._cfg['availability']
         self.cost = self._cfg['cost']
         self.location = self._cfg['location']['country']
+        self.capacity = self._cfg.get('capacity')
+        self.performance = self._cfg.get('performance')
+
+        # Provider listings are cached and indexed, see cache.ListingCache
+        ttl = self._cfg.get('cache_ttl', 30)
+        self._images = ListingCache(lambda: self._conn.list_images(), key=lambda i: i.path, ttl=ttl)
+        self._containers = ListingCache(lambda: self._conn.list_containers(all=True), key=lambda c: c.name, ttl=ttl)
+
+        # All containers share the host network, so ports are reserved per cloud
+        ports = self._cfg.get('ports', {})
+        self._ports = PortAllocator(ports.get('first', 5099), ports.get('last', 5999))
+
+    def _connect(self):
+        """Create the Docker Driver"""
+        from libcloud.container.drivers.docker import DockerContainerDriver
+
+        return DockerContainerDriver(key="",
+                                     secret="",
+                                     host=self._cfg['auth']['host'],
+                                     port=self._cfg['auth']['port'])
 
     def clean_test_setup(self):
         """Remove all deployed Containers"""
@@ -36,61 +130,180 @@ class Cloud:
 
     def request_port(self):
         """Get the Next Free Port"""
-        # TODO Get dynamically from Driver
-        reserved_port = self._next_free_port
-        self._next_free_port = reserved_port + 1
-        return reserved_port
+        # Parallel waves share the allocator, running containers are only looked up once
+        self._ports.reconcile_once(self._ports_in_use)
+        return self._ports.reserve()
+
+    def release(self, run_config):
+        """Release the Port of a Removed Service Instance"""
+        with ignored(AllocationError):
+            self._ports.release(run_config['port'])
+
+    def restore_allocations(self, allocations):
+        """Reserve Ports of an Earlier Run ({kind: [value, ...]}, see state.StateStore)"""
+        # All containers share the host ip, so only ports are restored
+        self._ports.restore(int(port) for port in allocations.get('port', ()))
+
+    def reconcile(self):
+        """Reserve Ports of Running Containers"""
+        self._ports.reconcile(self._ports_in_use())
+
+    def _ports_in_use(self):
+        return [int(c['Labels'][LABEL_PORT]) for c in self._labeled_containers(LABEL_PORT)]
 
     @property
     def provider(self):
         """Get Cloud Provider ID"""
-        return self._conn.type
+        return 'docker'
 
     @property
     def images(self):
         """List Images"""
-        return self._conn.list_images()
+        return self._images.all()
 
     @property
     def containers(self):
         """List Containers"""
-        return self._conn.list_containers(all=True)
+        return self._containers.all()
 
     def deploy_template(self, name, template, run_config):
         """Deploy Service Instance from Template"""
         return self.deploy(
             name,
             image=template['provider']['docker']['image'],
-            command=' '.join(template['provider']['docker']['command']))
+            command=' '.join(template['provider']['docker']['command']),
+            labels=instance_labels(name, template, run_config))
 
     def deploy(self, name, image, command=None, labels=None, remove_existing=True):
         """Deploy Service Instance"""
         existing_container = self._get_container(name)
+        if existing_container and labels and LABEL_FINGERPRINT in labels:
+            # An identical container is kept, instead of being recreated
+            existing = self._labeled_containers(ids=[existing_container.id])
+            if existing and (existing[0].get('Labels') or {}).get(LABEL_FINGERPRINT) == labels[LABEL_FINGERPRINT]:
+                return existing_container
         if remove_existing and existing_container:
-            existing_container.destroy()
+            self._force_remove(existing_container.id)
+            self._containers.discard(name)
         return self._deploy_container(name, image, command, labels)
 
     @traced()
     def _deploy_container(self, name, image, command=None, labels=None):
         """Deploy Container"""
-        return self._conn.deploy_container(name,
-                                           image=self._get_image(image),
-                                           command=command,
-                                           network_mode='host')
+        container = self._conn.deploy_container(name,
+                                                image=self._get_image(image),
+                                                command=command,
+                                                network_mode='host',
+                                                labels=labels)
+        self._containers.put(container)
+        return container
+
+    def destroy(self, container, run_config=None):
+        """Remove Service Instance and Release its Port"""
+        self._force_remove(container.id)
+        self._containers.discard(container.name)
+        if run_config:
+            self.release(run_config)
+
+    def has_image(self, path):
+        """Image already on the Docker host (cached index)"""
+        return self._images.get(path) is not None
+
+    def prefetch_image(self, path):
+        """Pull Image unless present"""
+        return self._get_image(path)
 
     def _get_image(self, path):
         """Get Image by Path"""
-        existing_image = next((i for i in self.images if i.path == path), None)
+        existing_image = self._images.get(path)
         return existing_image or self._install_image(path)
 
     @traced()
     def _install_image(self, path):
         """Install Image"""
-        return self._conn.install_image(path)
+        image = self._conn.install_image(path)
+        self._images.put(image)
+        return image
 
     def _get_container(self, name):
         """Get Container by Name"""
-        return next((c for c in self.containers if c.name == name), None)
+        return self._containers.get(name)
+
+    def get_instance(self, name):
+        """Get Container by Name, e.g. to adopt it after a restart"""
+        return self._get_container(name)
+
+    def list_instances(self):
+        """List all App Instances as (Name, Labels), see inventory.Inventory"""
+        return [(c['Names'][0].lstrip('/'), c['Labels']) for c in self._labeled_containers(LABEL_APP)]
+
+    def changed_instances(self, since):
+        """App Instances changed since a Unix timestamp, as ([(Name, Labels)], [Removed Names])"""
+        # The event log tells which containers changed, only those are listed again
+        # Events are newline-delimited JSON, which the driver's JSON response parsing rejects, so we read it raw
+        response = self._conn.connection.request(
+            '/v{version}/events'.format(version=self._conn.version),
+            params={'since': int(since), 'until': int(time.time()),
+                    'filters': json.dumps({'type': ['container'], 'label': [LABEL_APP]})},
+            raw=True)
+        events = parse_events(response.body)
+
+        removed = {e['Actor']['Attributes']['name'] for e in events if e.get('Action') == 'destroy'}
+        changed_ids = {e['Actor']['ID'] for e in events if e.get('Action') != 'destroy'}
+        changed = self._labeled_containers(LABEL_APP, ids=changed_ids) if changed_ids else []
+        changed = [(c['Names'][0].lstrip('/'), c['Labels']) for c in changed]
+        if changed_ids or removed:
+            self._containers.invalidate()
+        # A name may be destroyed and recreated within the same interval
+        return changed, sorted(removed - {name for name, _ in changed})
+
+    def _labeled_containers(self, label=None, ids=None):
+        """List Raw Container Data incl. Labels, filtered by Label (key or key=value)"""
+        # libcloud does not expose container labels, so we ask the Docker API directly
+        filters = {}
+        if label:
+            filters['label'] = [label]
+        if ids:
+            filters['id'] = sorted(ids)
+        params = {'all': 1}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        return self._conn.connection.request(
+            '/v{version}/containers/json'.format(version=self._conn.version), params=params).object
+
+    def destroy_app(self, app_id):
+        """Force-Remove all Containers of an App, returns Errors by Container Name"""
+        return self._remove_containers(self._labeled_containers('{}={}'.format(LABEL_APP, app_id)))
+
+    def _remove_containers(self, containers):
+        """Force-Remove Raw Containers in Parallel, one API Call each"""
+
+        def remove(container):
+            name = container['Names'][0].lstrip('/')
+            try:
+                self._force_remove(container['Id'])
+            except Exception as e:
+                return name, e
+            self._containers.discard(name)
+            port = (container.get('Labels') or {}).get(LABEL_PORT)
+            if port:
+                self.release({'port': int(port)})
+            return name, None
+
+        if not containers:
+            return {}
+        # We use dummy.Pool for a simpler threading interface,
+        # as we wait for net i/o instead of a calculation.
+        with Pool(min(self._cfg.get('teardown_concurrency', 16), len(containers))) as pool:
+            return {name: error for name, error in pool.map(remove, containers) if error}
+
+    def _force_remove(self, container_id):
+        """Remove a Container, even if Running"""
+        # libcloud's destroy_container does not force, Docker refuses running containers with 409.
+        # Force kills a running container, so there is no separate stop.
+        self._conn.connection.request(
+            '/v{version}/containers/{id}'.format(version=self._conn.version, id=container_id),
+            params={'force': 1}, method='DELETE')
 
     @traced('name')
     def _container_log(self, container):
@@ -99,15 +312,13 @@ class Cloud:
 
     @traced()
     def _destroy_all_containers(self, stopped=True):
-        """Stop and Remove all Containers"""
-        # We use dummy.Pool for a simpler threading interface,
-        # as we wait for net i/o instead of a calculation,
-        # which would actually need multiprocessing.
-        with Pool(8) as pool:
-            with ignored(Exception):
-                pool.map(lambda c: c.stop(), self.containers)
-            with ignored(Exception):
-                pool.map(lambda c: c.destroy(), self.containers)
+        """Force-Remove all Containers"""
+        errors = self._remove_containers(self._labeled_containers())
+        for name, error in errors.items():
+            logging.error("Removing container {} failed: {}".format(name, error))
+        self._containers.invalidate()
+        self._ports.reconcile([], release_missing=True)
+        return errors
 
     def __repr__(self):
         return "<{name}: id={id}>".format(name=__name__, id=self.id)
@@ -159,59 +370,64 @@ class DockerCloud:
     """
 
 
-class OpenStackCloud:
+class OpenStackCloud(LazyConnection):
     @traced('text')
     def __init__(self, cfg):
         """Initialize Cloud"""
         self._cfg = cfg
-        self._conn = OpenStackNodeDriver(cfg['auth']['username'],
-                                         cfg['auth']['password'],
-                                         ex_tenant_name=cfg['auth']['tenant_name'],
-                                         ex_force_auth_url=cfg['auth']['url'],
-                                         ex_force_auth_version=cfg['auth']['version'],
-                                         ex_force_service_region=cfg['auth']['region_name'])
-
+        self._driver_lock = threading.Lock()
         self.id = self._cfg['id']
         self.availability = self._cfg['availability']
         self.cost = self._cfg['cost']
         self.location = self._cfg['location']['country']
+        self.capacity = self._cfg.get('capacity')
+        self.performance = self._cfg.get('performance')
+
+    def _connect(self):
+        """Create the OpenStack Driver"""
+        from libcloud.compute.drivers.openstack import OpenStackNodeDriver
 
         # DevStack: DO NOT create Volume when deploying
-        print(self._conn.list_images())
+        auth = self._cfg['auth']
+        return OpenStackNodeDriver(auth['username'],
+                                   auth['password'],
+                                   ex_tenant_name=auth['tenant_name'],
+                                   ex_force_auth_url=auth['url'],
+                                   ex_force_auth_version=auth['version'],
+                                   ex_force_service_region=auth['region_name'])
+
+    @property
+    def provider(self):
+        """Get Cloud Provider ID"""
+        return 'openstack'
 
 
 # TODO: Rename to OpenStack
 #
-class PowerVcCloud:
+class PowerVcCloud(LazyConnection):
     @traced('text')
     def __init__(self, cfg):
         """Initialize Cloud"""
-
-        import libcloud.security
-
-        # The PowerVC certificate is self-signed
-        libcloud.security.VERIFY_SSL_CERT = False
-        libcloud.security.CA_CERTS_PATH = ['powervc.crt']
-
-        # The API endpoint returns host 'powervc', which is unknown to the FSOC DNS
-        # Add to /etc/hosts: 192.168.42.252 powervc
-        # OR use ex_force_base_url: https://192.168.42.252:8774/v2.1
-
         self._cfg = cfg
-        self._conn = OpenStackNodeDriver(cfg['auth']['username'],
-                                         cfg['auth']['password'],
-                                         ex_tenant_name=cfg['auth']['tenant_name'],
-                                         ex_force_auth_url=cfg['auth']['url'],
-                                         # ex_force_base_url=cfg['auth']['base_url'],
-                                         ex_force_auth_version=cfg['auth']['version'],
-                                         ex_force_service_region=cfg['auth']['region_name'])
-
+        self._driver_lock = threading.Lock()
         self.id = self._cfg['id']
         self.availability = self._cfg['availability']
         self.cost = self._cfg['cost']
         self.location = self._cfg['location']['country']
+        self.capacity = self._cfg.get('capacity')
+        self.performance = self._cfg.get('performance')
 
-        from pprint import pprint
+        # Provider listings are cached and indexed, see cache.ListingCache
+        ttl = self._cfg.get('cache_ttl', 30)
+        self._images = ListingCache(lambda: self._conn.list_images(), key=lambda i: i.name, ttl=ttl)
+        self._sizes = ListingCache(lambda: self._conn.list_sizes(), key=lambda s: s.name, ttl=ttl)
+        self._nodes = ListingCache(lambda: self._conn.list_nodes(), key=lambda n: n.name, ttl=ttl)
+        self._networks = ListingCache(lambda: self._conn.ex_list_networks(), key=lambda n: n.name, ttl=ttl)
+
+        self._floating_ips = FloatingIpPool(lambda: self._conn.ex_list_floating_ips(),
+                                            lambda: self._conn.ex_create_floating_ip())
+        # Floating IPs reserved in advance, so booting instances do not wait for their creation
+        self._floating_ip_prefill = self._cfg.get('floating_ips', 0)
 
         name = 'testing2'
         # command = ' '.join(template['provider']['docker']['command']))
@@ -248,7 +464,39 @@ class PowerVcCloud:
 
         # Clean up!
 
-        pprint(self.nodes)
+    def _connect(self):
+        """Create the PowerVC Driver"""
+        import libcloud.security
+        from libcloud.compute.drivers.openstack import OpenStackNodeDriver
+
+        # The PowerVC certificate is self-signed
+        libcloud.security.VERIFY_SSL_CERT = False
+        libcloud.security.CA_CERTS_PATH = ['powervc.crt']
+
+        # The API endpoint returns host 'powervc', which is unknown to the FSOC DNS
+        # Add to /etc/hosts: 192.168.42.252 powervc
+        # OR use ex_force_base_url: https://192.168.42.252:8774/v2.1
+
+        auth = self._cfg['auth']
+        return OpenStackNodeDriver(auth['username'],
+                                   auth['password'],
+                                   ex_tenant_name=auth['tenant_name'],
+                                   ex_force_auth_url=auth['url'],
+                                   # ex_force_base_url=auth['base_url'],
+                                   ex_force_auth_version=auth['version'],
+                                   ex_force_service_region=auth['region_name'])
+
+    def _on_connect(self):
+        """Fill the Floating IP Pool in the Background"""
+        if self._floating_ip_prefill:
+            threading.Thread(target=self._prefill_floating_ips, name='floating-ips-{}'.format(self.id),
+                             daemon=True).start()
+
+    def _prefill_floating_ips(self):
+        try:
+            self._floating_ips.prefill(self._floating_ip_prefill)
+        except Exception as e:
+            logging.warning("Prefilling floating IPs of {} failed: {}".format(self.id, e))
 
     def clean_test_setup(self):
         """Remove all deployed Instances"""
@@ -256,63 +504,119 @@ class PowerVcCloud:
 
     def request_ip(self):
         """Get the Next (Unused) Floating IP"""
-        unused_floating_ip = None
-        for floating_ip in self._conn.ex_list_floating_ips():
-            if not floating_ip.node_id:
-                unused_floating_ip = floating_ip.ip_address
-                break
-        return unused_floating_ip or self._conn.ex_create_floating_ip().ip_address
+        return self._floating_ips.reserve()
 
     def request_port(self):
         """Get the Next Free Port
             In OpenStack there is no limitation here, as each instance is an individual VM."""
         return 8888
 
+    def release(self, run_config):
+        """Release the Floating IP of a Removed Service Instance"""
+        self._floating_ips.release(run_config['ip'])
+
+    def restore_allocations(self, allocations):
+        """Keep Floating IPs of an Earlier Run Reserved ({kind: [value, ...]}, see state.StateStore)"""
+        self._floating_ips.restore(allocations.get('ip', ()))
+
+    def reconcile(self):
+        """Rescan Unused Floating IPs"""
+        self._floating_ips.reconcile()
+
     @property
     def provider(self):
         """Get Cloud Provider ID"""
-        return self._conn.type
+        return 'openstack'
 
     @property
     def images(self):
         """List Images"""
-        return self._conn.list_images()
+        return self._images.all()
 
     @property
     def sizes(self):
         """List Sizes"""
         # PowerVC lists more options here than on the Web Interface
-        return self._conn.list_sizes()
+        return self._sizes.all()
 
     @property
     def nodes(self):
         """List Nodes"""
         # Node data misses the ip address.
         # Check Hardware Management Console (HMT) at 192.168.42.251
-        return self._conn.list_nodes()
+        return self._nodes.all()
 
     @traced()
     def _destroy_all_instances(self, stopped=True):
-        """Stop and Remove all Containers"""
-        # We use dummy.Pool for a simpler threading interface,
-        # as we wait for net i/o instead of a calculation,
-        # which would actually need multiprocessing.
-        with Pool(8) as pool:
-            with ignored(Exception):
-                pool.map(lambda n: n.stop(), self.nodes)
-            with ignored(Exception):
-                pool.map(lambda n: n.destroy(), self.nodes)
+        """Remove all Instances"""
+        self._nodes.invalidate()
+        errors = self._remove_nodes(self.nodes)
+        for name, error in errors.items():
+            logging.error("Removing instance {} failed: {}".format(name, error))
+        self._nodes.invalidate()
+        self._floating_ips.reconcile(release_missing=True)
+        return errors
+
+    def destroy_app(self, app_id):
+        """Remove all Instances of an App, returns Errors by Instance Name"""
+        # Metadata may be stale in the cache, so we list once more
+        self._nodes.invalidate()
+        return self._remove_nodes([node for node in self.nodes
+                                   if node.extra.get('metadata', {}).get(LABEL_APP) == app_id])
+
+    def _remove_nodes(self, nodes):
+        """Delete Nodes in Parallel, one API Call each"""
+
+        def remove(node):
+            try:
+                # Deleting a node does not require stopping it first
+                node.destroy()
+            except Exception as e:
+                return node.name, e
+            self._nodes.discard(node.name)
+            ip = node.extra.get('metadata', {}).get(LABEL_IP)
+            if ip:
+                self.release({'ip': ip})
+            return node.name, None
+
+        if not nodes:
+            return {}
+        with Pool(min(self._cfg.get('teardown_concurrency', 8), len(nodes))) as pool:
+            return {name: error for name, error in pool.map(remove, nodes) if error}
 
     def deploy_template(self, name, template, run_config):
         """Extract Service Instance Data from Template"""
-        return self.deploy(
-            name,
-            image=self._get_image(template['provider']['openstack']['image']),
-            size=self._get_size('m1.large'),
-            command=template['provider']['openstack']['command'],
-            ip=run_config['ip'],
-            labels={},
-        )
+        return self.deploy(name, **self._template_args(name, template, run_config))
+
+    def _template_args(self, name, template, run_config):
+        return dict(image=self._get_image(template['provider']['openstack']['image']),
+                    size=self._get_size('m1.large'),
+                    command=template['provider']['openstack']['command'],
+                    ip=run_config['ip'],
+                    labels=instance_labels(name, template, run_config))
+
+    @traced()
+    def deploy_templates(self, jobs):
+        """Deploy a Wave of Service Instances at once, from (Name, Template, Run Config) Tuples"""
+        # All nodes are created first and boot in parallel,
+        # a single polling loop then attaches floating ips as nodes become active.
+        network = self._get_network('admin_internal_net')
+        requests = [(name, self._template_args(name, template, run_config)) for name, template, run_config in jobs]
+
+        def create(request):
+            name, args = request
+            try:
+                return self._create_instance(name, network=network, **args), None
+            except Exception as e:
+                return None, e
+
+        with Pool(min(self._cfg.get('api_concurrency', 8), len(requests))) as pool:
+            created = pool.map(create, requests)
+        errors = [error for _, error in created if error]
+        if errors:
+            self._discard_instances([node for node, _ in created if node], [args['ip'] for _, args in requests])
+            raise errors[0]
+        return self._await_instances([(node, args['ip']) for (node, _), (_, args) in zip(created, requests)])
 
     def deploy(self, name, image, size,
                command=None, network=None, ip=None, labels=None, remove_existing=False):
@@ -320,6 +624,7 @@ class PowerVcCloud:
         existing_instance = self._get_node(name)
         if remove_existing and existing_instance:
             existing_instance.destroy()
+            self._nodes.discard(name)
         if network is None:
             network = self._get_network('admin_internal_net')
 
@@ -328,30 +633,140 @@ class PowerVcCloud:
     @traced()
     def _deploy_instance(self, name, size, image, network, command=None, ip=None, labels=None):
         """Create Instance"""
-
+        try:
+            new_instance = self._create_instance(name, image, size, network, command, ip, labels)
+        except Exception:
+            self._discard_instances([], [ip])
+            raise
+        return self._await_instances([(new_instance, ip)])[0]
+
+    def _create_instance(self, name, image, size, network, command=None, ip=None, labels=None):
+        """Submit a New Node, without Waiting for it to Boot"""
         # libcloud expects a label dictionary, even if empty
         if labels is None:
             labels = {}
-
         new_instance = self._conn.create_node(name=name, image=image, size=size, networks=[network],
                                               ex_userdata=command, ex_metadata=labels)
-
-        if ip:
-            # A floating ip can only be associated to a running instance,
-            # so we wait for spawning to complete
-            self._conn.wait_until_running([new_instance])
-            self._conn.ex_attach_floating_ip_to_node(new_instance, ip)
-
+        self._nodes.put(new_instance)
         return new_instance
 
+    def _await_instances(self, pending, timeout=None):
+        """Wait for Nodes in one Polling Loop, Attaching each Floating IP once its Node is Active"""
+        # A floating ip can only be associated to a running instance
+        waiting = {node.id: (index, node, ip) for index, (node, ip) in enumerate(pending) if ip}
+        instances = [node for node, _ in pending]
+        timeout = timeout or self._cfg.get('boot_timeout', 600)
+        try:
+            self._poll_instances(waiting, instances, timeout)
+        except Exception:
+            # A wave is deployed completely or not at all, nothing of it is left behind
+            self._discard_instances(instances, [ip for _, ip in pending])
+            raise
+        return instances
+
+    def _poll_instances(self, waiting, instances, timeout):
+        from libcloud.compute.types import NodeState
+
+        failed = []
+        deadline = time.monotonic() + timeout
+        delay = self._cfg.get('poll_interval', 2.0)
+
+        while waiting:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Instances not running within {}s: {}".format(
+                    timeout, sorted(node.name for _, node, _ in waiting.values())))
+            time.sleep(delay)
+            # Backoff, most nodes of a wave boot at about the same time
+            delay = min(delay * 1.5, 15.0)
+
+            # One listing per poll, no matter how many nodes are booting
+            for node in self._conn.list_nodes():
+                if node.id not in waiting:
+                    continue
+                index, _, ip = waiting[node.id]
+                if node.state == NodeState.RUNNING:
+                    self._conn.ex_attach_floating_ip_to_node(node, ip)
+                elif node.state in (NodeState.ERROR, NodeState.TERMINATED):
+                    failed.append(node.name)
+                else:
+                    continue
+                del waiting[node.id]
+                instances[index] = node
+                self._nodes.put(node)
+
+        if failed:
+            raise RuntimeError("Instances failed to boot: {}".format(sorted(failed)))
+
+    def _discard_instances(self, nodes, ips):
+        """Remove the Nodes of a Failed Deployment and Release the Floating IPs Reserved for it"""
+        def remove(node):
+            try:
+                self._conn.destroy_node(node)
+            except Exception as e:
+                logging.error("Removing instance {} failed: {}".format(node.name, e))
+            self._nodes.discard(node.name)
+
+        if nodes:
+            with Pool(min(self._cfg.get('teardown_concurrency', 8), len(nodes))) as pool:
+                pool.map(remove, nodes)
+        # Deleting a node disassociates its floating ip, the pool hands it out again
+        for ip in ips:
+            if ip:
+                self.release({'ip': ip})
+
+    def destroy(self, node, run_config=None):
+        """Remove Service Instance and Release its Floating IP"""
+        node.destroy()
+        self._nodes.discard(node.name)
+        if run_config:
+            self.release(run_config)
+
     def _get_node(self, name):
         """Get Node by Name"""
         # root:power8
-        return next((n for n in self.nodes if n.name == name), None)
+        return self._nodes.get(name)
+
+    def get_instance(self, name):
+        """Get Node by Name, e.g. to adopt it after a restart"""
+        return self._get_node(name)
+
+    def list_instances(self):
+        """List all App Instances as (Name, Metadata), see inventory.Inventory"""
+        self._nodes.invalidate()
+        return [(node.name, node.extra.get('metadata', {})) for node in self.nodes
+                if LABEL_APP in node.extra.get('metadata', {})]
+
+    def changed_instances(self, since):
+        """App Instances changed since a Unix timestamp, as ([(Name, Metadata)], [Removed Names])"""
+        from libcloud.compute.types import NodeState
+
+        # Nova lists changed and deleted servers only, libcloud has no parameter for it
+        changes_since = datetime.utcfromtimestamp(since).strftime('%Y-%m-%dT%H:%M:%SZ')
+        nodes = self._conn._to_nodes(self._conn.connection.request(
+            '/servers/detail', params={'changes-since': changes_since}).object)
+        nodes = [node for node in nodes if LABEL_APP in node.extra.get('metadata', {})]
+        for node in nodes:
+            if node.state == NodeState.TERMINATED:
+                self._nodes.discard(node.name)
+            else:
+                self._nodes.put(node)
+        return ([(node.name, node.extra['metadata']) for node in nodes if node.state != NodeState.TERMINATED],
+                [node.name for node in nodes if node.state == NodeState.TERMINATED])
+
+    def has_image(self, name):
+        """Image available in the image service (cached index)"""
+        return self._images.get(name) is not None
+
+    def prefetch_image(self, name):
+        """Check Image, it has to be uploaded to the image service beforehand"""
+        image = self._get_image(name)
+        if image is None:
+            logging.warning("Image '{}' is missing on {}".format(name, self.id))
+        return image
 
     def _get_image(self, name):
         """Get Image by Name"""
-        existing_image = next((i for i in self.images if i.name == name), None)
+        existing_image = self._images.get(name)
         return existing_image  # or self._install_image(path)
 
     @traced('name')
@@ -360,17 +775,258 @@ class PowerVcCloud:
         return self._conn.ex_get_console_output(node)
 
     @property
-    def _networks(self):
+    def networks(self):
         """List Networks"""
-        return self._conn.ex_list_networks()
+        return self._networks.all()
 
     def _get_network(self, name):
         """Get Network by Name"""
-        return next((n for n in self._networks if n.name == name), None)
+        return self._networks.get(name)
     #
     # def _get_ip(self, ip_str):
     #     return self._conn.ex_get_floating_ip(ip_str)
 
     def _get_size(self, name=None, core_count=None, core_mhz=None, ram_mb=None, disk_mb=None):
         """Get Size by Name or TODO: Resources"""
-        return next((s for s in self.sizes if s.name == name), None)
+        return self._sizes.get(name)
+
+
+class SimulatedFailure(Exception):
+    pass
+
+
+class SimulatedInstance:
+    """Instance of a SimulatedCloud, shaped like a libcloud container or node"""
+
+    def __init__(self, cloud, name, image, labels):
+        self.id = '{}/{}'.format(cloud.id, name)
+        self.name = name
+        self.image = image
+        self.labels = labels
+        self.state = 'running'
+        self.extra = {'metadata': labels}
+        self._cloud = cloud
+
+    def destroy(self):
+        self._cloud.destroy(self)
+        return True
+
+    def __repr__(self):
+        return "<SimulatedInstance: name={}>".format(self.name)
+
+
+class SimulatedCloud:
+    """
+    In-Memory Cloud for Offline Tests and Benchmarks
+
+    Follows the interface of Cloud, and of PowerVcCloud's batch deployment if enabled,
+    without talking to any provider. Configure it in clouds.yaml with provider: simulated.
+
+        simulation:
+          latency: 0.01       Seconds per API call
+          boot_time: 0        Seconds until an instance runs
+          failure_rate: 0     Probability of a failing API call
+          max_instances:      Instances the cloud accepts, unlimited if empty
+          seed: 0             Reproducible failures
+          emulates: docker    Provider section of the service templates to deploy
+          batch: False        Boot the instances of a wave side by side, as PowerVcCloud
+    """
+
+    def __init__(self, cfg):
+        """Initialize Cloud"""
+        self._cfg = cfg
+        self.id = self._cfg['id']
+        self.availability = self._cfg['availability']
+        self.cost = self._cfg['cost']
+        self.location = self._cfg['location']['country']
+        self.capacity = self._cfg.get('capacity')
+        self.performance = self._cfg.get('performance')
+
+        simulation = self._cfg.get('simulation') or {}
+        self._latency = simulation.get('latency', 0.0)
+        self._boot_time = simulation.get('boot_time', 0.0)
+        self._failure_rate = simulation.get('failure_rate', 0.0)
+        self._max_instances = simulation.get('max_instances')
+        self._emulates = simulation.get('emulates', 'docker')
+        self._random = random.Random(simulation.get('seed', 0))
+        if simulation.get('batch'):
+            self.deploy_templates = self._deploy_batch
+
+        self._lock = threading.Lock()
+        self._instances = {}
+        self._image_paths = set()
+        self._events = []
+        self.api_calls = 0
+
+        ports = self._cfg.get('ports', {})
+        self._ports = PortAllocator(ports.get('first', 5099), ports.get('last', 5999))
+
+    def _api(self, operation):
+        """Account for one provider API call: latency and random failures"""
+        with self._lock:
+            self.api_calls += 1
+            failed = self._random.random() < self._failure_rate
+        if self._latency:
+            time.sleep(self._latency)
+        if failed:
+            raise SimulatedFailure("Simulated {} failure on {}".format(operation, self.id))
+
+    # Nothing listens on simulated instances, they are healthy once deployed
+    health_checks = False
+
+    def connect(self):
+        """Nothing to connect to"""
+        return self
+
+    @property
+    def provider(self):
+        """Get Cloud Provider ID"""
+        return self._emulates
+
+    def clean_test_setup(self):
+        """Remove all deployed Instances"""
+        with self._lock:
+            instances = list(self._instances.values())
+        return self._remove_instances(instances)
+
+    def request_ip(self):
+        """Get the Next Free IP, the same for all instances"""
+        return '127.0.0.1'
+
+    def request_port(self):
+        """Get the Next Free Port"""
+        return self._ports.reserve()
+
+    def release(self, run_config):
+        """Release the Port of a Removed Service Instance"""
+        with ignored(AllocationError):
+            self._ports.release(run_config['port'])
+
+    def restore_allocations(self, allocations):
+        """Reserve Ports of an Earlier Run ({kind: [value, ...]}, see state.StateStore)"""
+        self._ports.restore(int(port) for port in allocations.get('port', ()))
+
+    def reconcile(self):
+        """Reserve Ports of Running Instances"""
+        self._ports.reconcile(int(i.labels[LABEL_PORT]) for i in self.instances if LABEL_PORT in i.labels)
+
+    @property
+    def images(self):
+        """List Images"""
+        return sorted(self._image_paths)
+
+    @property
+    def instances(self):
+        """List Instances"""
+        with self._lock:
+            return list(self._instances.values())
+
+    def has_image(self, path):
+        """Image already pulled"""
+        return path in self._image_paths
+
+    def prefetch_image(self, path):
+        """Pull Image unless present"""
+        if path not in self._image_paths:
+            self._api('pull')
+            time.sleep(self._boot_time)
+            with self._lock:
+                self._image_paths.add(path)
+        return path
+
+    def deploy_template(self, name, template, run_config):
+        """Deploy Service Instance from Template"""
+        return self.deploy(name,
+                           image=template['provider'][self._emulates]['image'],
+                           labels=instance_labels(name, template, run_config))
+
+    def deploy(self, name, image, command=None, labels=None, remove_existing=True, boot=True):
+        """Deploy Service Instance"""
+        labels = labels or {}
+        existing = self.get_instance(name)
+        if existing and LABEL_FINGERPRINT in labels and existing.labels.get(LABEL_FINGERPRINT) == labels[LABEL_FINGERPRINT]:
+            return existing
+        if existing and remove_existing:
+            self._remove(existing)
+
+        self._api('create')
+        self.prefetch_image(image)
+        with self._lock:
+            if self._max_instances is not None and len(self._instances) >= self._max_instances:
+                raise SimulatedFailure("Capacity of {} exhausted".format(self.id))
+            instance = self._instances[name] = SimulatedInstance(self, name, image, labels)
+            self._events.append((time.time(), name, False))
+        if boot:
+            time.sleep(self._boot_time)
+        return instance
+
+    def _deploy_batch(self, jobs):
+        """Deploy a Wave of Service Instances, booting side by side"""
+        instances = []
+        try:
+            for name, template, run_config in jobs:
+                instances.append(self.deploy(name,
+                                             image=template['provider'][self._emulates]['image'],
+                                             labels=instance_labels(name, template, run_config),
+                                             boot=False))
+        except SimulatedFailure:
+            # As PowerVcCloud, a failed wave leaves nothing behind
+            self._remove_instances(instances)
+            for _, _, run_config in jobs[len(instances):]:
+                self.release(run_config)
+            raise
+        time.sleep(self._boot_time)
+        return instances
+
+    def destroy(self, instance, run_config=None):
+        """Remove Service Instance and Release its Port"""
+        self._remove(instance)
+        if run_config:
+            self.release(run_config)
+
+    def _remove(self, instance):
+        self._api('destroy')
+        with self._lock:
+            if self._instances.get(instance.name) is instance:
+                del self._instances[instance.name]
+                self._events.append((time.time(), instance.name, True))
+
+    def destroy_app(self, app_id):
+        """Remove all Instances of an App, returns Errors by Instance Name"""
+        return self._remove_instances([i for i in self.instances if i.labels.get(LABEL_APP) == app_id])
+
+    def _remove_instances(self, instances):
+        def remove(instance):
+            try:
+                self._remove(instance)
+            except SimulatedFailure as e:
+                return instance.name, e
+            if LABEL_PORT in instance.labels:
+                self.release({'port': int(instance.labels[LABEL_PORT])})
+            return instance.name, None
+
+        if not instances:
+            return {}
+        with Pool(min(self._cfg.get('teardown_concurrency', 16), len(instances))) as pool:
+            return {name: error for name, error in pool.map(remove, instances) if error}
+
+    def get_instance(self, name):
+        """Get Instance by Name"""
+        with self._lock:
+            return self._instances.get(name)
+
+    def list_instances(self):
+        """List all App Instances as (Name, Labels), see inventory.Inventory"""
+        self._api('list')
+        return [(i.name, i.labels) for i in self.instances if LABEL_APP in i.labels]
+
+    def changed_instances(self, since):
+        """App Instances changed since a Unix timestamp, as ([(Name, Labels)], [Removed Names])"""
+        self._api('events')
+        with self._lock:
+            names = {name for timestamp, name, _ in self._events if timestamp >= since}
+            changed = [(name, self._instances[name].labels) for name in names if name in self._instances]
+        return changed, sorted(names - {name for name, _ in changed})
+
+    def __repr__(self):
+        return "<{name}: id={id}>".format(name=__name__, id=self.id)
@@ -1,22 +1,44 @@
 #!/usr/bin/env python3
 #  -*- coding: UTF-8 -*-
 
-import ruamel.yaml as yaml
+import copy
+import logging
+import os
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.dummy import Pool
 
-from cloud import Cloud, AmazonCloud, OpenStackCloud, PowerVcCloud
-from log import traced, init
+import ruamel.yaml as yaml
 
-init('DEBUG')
+import app
+from autoscaler import Autoscaler
+from health import HealthChecker
+from inventory import Inventory
+from profiles import Profiles
+from scheduler import CapacityLedger
+from state import StateStore
+from cloud import Cloud, AmazonCloud, OpenStackCloud, PowerVcCloud, SimulatedCloud
+from log import traced, init, record_spans, export_spans
 
 CLOUD_PROVIDER_MAP = {
     'docker': Cloud,
     'ec2': AmazonCloud,
     'openstack': OpenStackCloud,
-    'powervc': PowerVcCloud
+    'powervc': PowerVcCloud,
+    'simulated': SimulatedCloud,
 }
 
 _clouds = []
 _apps = []
+_health = HealthChecker()
+_inventory = None
+_store = None
+_ledger = None
+_profiles = None
+_autoscalers = {}
+# Apps are deployed from several threads at once
+_apps_lock = threading.Lock()
 
 
 # TODO Design functions independently, without side-effects
@@ -28,11 +50,46 @@ def _get_cloud_config(path='clouds.yaml'):
         return yaml.YAML().load(stream)
 
 
+def _create_cloud(cfg, connect=False):
+    """Create a Single Cloud, optionally Connecting its Driver"""
+    cloud = CLOUD_PROVIDER_MAP[cfg['provider']](cfg)
+    if connect and hasattr(cloud, 'connect'):
+        cloud.connect()
+    return cloud
+
+
 @traced()
-def _init_clouds(filter='all'):
+def _init_clouds(path='clouds.yaml', connect=False, timeout=10):
     """Create Clouds from Config"""
-    for cfg in _get_cloud_config('clouds.yaml'):
-        _clouds.append(CLOUD_PROVIDER_MAP[cfg['provider']](cfg))
+    # Clouds connect lazily on first use. When connecting upfront,
+    # all provider handshakes run in parallel, each with its own timeout.
+    # A cloud that fails or times out is skipped, the others stay usable.
+    configs = list(_get_cloud_config(path))
+    pool = Pool(max(len(configs), 1))
+    started = time.monotonic()
+    pending = [(cfg, pool.apply_async(_create_cloud, (cfg, connect))) for cfg in configs]
+    for cfg, result in pending:
+        # Deadlines count from the start, a hanging cloud does not delay the ones after it
+        deadline = started + cfg.get('timeout', timeout)
+        try:
+            _clouds.append(result.get(max(0, deadline - time.monotonic())))
+        except TimeoutError:
+            logging.error("Cloud {} did not respond within {}s, skipped".format(cfg['id'], cfg.get('timeout', timeout)))
+        except Exception as e:
+            logging.error("Cloud {} failed to initialize, skipped: {}".format(cfg['id'], e))
+    # Do not wait for hanging handshakes, their threads are daemons
+    pool.close()
+    _restore_allocations(_clouds)
+    return _clouds
+
+
+def _restore_allocations(clouds):
+    """Reserve the Ports and IPs Recorded in the State Store Again"""
+    if _store is None:
+        return
+    for cloud in clouds:
+        if hasattr(cloud, 'restore_allocations'):
+            cloud.restore_allocations({kind: _store.allocations(cloud.id, kind) for kind in ('ip', 'port')})
 
 
 @traced()
@@ -47,39 +104,220 @@ def _get_service_definition(path='./services/hyrise.yaml'):
 # Port Configuration is undocumented in libcloud
 # auto remove (--rm) is unsupported, keep track of containers and remove manually
 
-import app
-
 
 @traced()
-def deploy_app(id='hyrise'):
+def deploy_app(id='hyrise', sla=None):
     """Deploy App"""
     # Get the app definition including a general description and architecture
     template = _get_service_definition('./services/{}.yaml'.format(id))
-    sla = {}
-    _apps.append(app.App(template, sla, _clouds))
+    sla = sla or {}
+    deployed_app = app.App(template, sla, _clouds, health=_health, store=_store, ledger=_get_ledger(),
+                           profiles=get_profiles())
+    with _apps_lock:
+        _apps.append(deployed_app)
+    return deployed_app
+
+
+def _get_ledger():
+    """Capacity reserved by all Apps on the Shared Clouds"""
+    global _ledger
+    if _ledger is None:
+        _ledger = CapacityLedger(_clouds)
+    return _ledger
 
 
-def destroy_app(id='hyrise'):
+def get_profiles():
+    """Learned Cloud Performance, kept in the State Store if open"""
+    global _profiles
+    if _profiles is None:
+        _profiles = Profiles(_store)
+    return _profiles
+
+
+@traced()
+def deploy_apps(batch, concurrency=4, per_app_concurrency=4):
+    """Deploy a Batch of (Template, SLA) Pairs at once on the Shared Clouds"""
+    # Each app plans against the capacity the others already reserved (one at a time),
+    # then deploys with its own bounded thread pool, so one large app cannot starve the others.
+    # Templates are given as dictionary or as service id, e.g. ('hyrise', {}).
+    ledger = _get_ledger()
+    profiles = get_profiles()
+
+    def deploy(job):
+        template, sla = job
+        if isinstance(template, str):
+            template = _get_service_definition('./services/{}.yaml'.format(template))
+        try:
+            # Apps change their template on scaling, so they must not share it
+            return app.App(copy.deepcopy(template), sla or {}, _clouds, concurrency=per_app_concurrency,
+                           health=_health, store=_store, ledger=ledger, profiles=profiles)
+        except Exception as e:
+            logging.error("Deployment of {} failed: {}".format(template.get('name'), e))
+            return e
+
+    batch = list(batch)
+    if not batch:
+        return {'apps': [], 'errors': {}, 'elapsed': 0.0, 'apps_per_minute': 0.0}
+    start = time.perf_counter()
+    with Pool(min(concurrency, len(batch))) as pool:
+        results = pool.map(deploy, batch)
+    elapsed = time.perf_counter() - start
+
+    deployed = [result for result in results if isinstance(result, app.App)]
+    with _apps_lock:
+        _apps.extend(deployed)
+    apps_per_minute = len(deployed) / elapsed * 60 if elapsed else 0.0
+    logging.info("Deployed {}/{} apps in {:.1f}s ({:.1f} apps/minute)".format(
+        len(deployed), len(batch), elapsed, apps_per_minute))
+    return {'apps': deployed,
+            'errors': {i: result for i, result in enumerate(results) if not isinstance(result, app.App)},
+            'elapsed': elapsed,
+            'apps_per_minute': apps_per_minute}
+
+
+@traced()
+def destroy_app(id):
     """Remove all Instances of an Application"""
-    # TODO: Find all instances of specific app
-    _clouds[0].clean_test_setup()
+    # Instances are found by their app id label, on all clouds at the same time
+    stop_autoscaling(id)
+    with _apps_lock:
+        removed_apps = [a for a in _apps if a.id == id]
+        for removed_app in removed_apps:
+            _apps.remove(removed_app)
+    for removed_app in removed_apps:
+        _health.unwatch(removed_app.services)
+    if _ledger is not None:
+        _ledger.release(id)
+    if _store is not None:
+        _store.remove_app(id)
+
+    clouds = [cloud for cloud in _clouds if hasattr(cloud, 'destroy_app')]
+    if not clouds:
+        return {}
+    with Pool(len(clouds)) as pool:
+        results = pool.map(lambda cloud: (cloud, cloud.destroy_app(id)), clouds)
+
+    errors = {}
+    for cloud, cloud_errors in results:
+        for name, error in cloud_errors.items():
+            logging.error("Removing {} on {} failed: {}".format(name, cloud.id, error))
+            errors[(cloud.id, name)] = error
+    return errors
 
 
-def get_inventory():
+def get_inventory(refresh=True):
     """Get Instances in all Clouds"""
-    pass
+    global _inventory
+    if _inventory is None:
+        _inventory = Inventory(_clouds)
+    if refresh:
+        _inventory.refresh()
+    return _inventory
 
 
-def get_throughput():
+@traced()
+def restore_apps():
+    """Rebuild Apps from Running Instances after a Broker Restart"""
+    inventory = get_inventory()
+    known = {a.id for a in _apps}
+    for app_id in inventory.apps():
+        if app_id in known:
+            continue
+        path = './deployments/{}.yaml'.format(app_id)
+        template = _store.load_template(app_id) if _store is not None else None
+        if template is None and os.path.exists(path):
+            template = _get_service_definition(path)
+        if template is None:
+            logging.warning("No template for running app {}, skipped".format(app_id))
+            continue
+        restored_app = app.App(template, {}, _clouds, health=_health, id=app_id, deploy=False, store=_store,
+                               ledger=_get_ledger(), profiles=get_profiles())
+        restored_app.adopt(inventory.instances(app_id=app_id))
+        with _apps_lock:
+            _apps.append(restored_app)
+    return _apps
+
+
+def get_throughput(id=None):
+    """Benchmark an App through its Dispatcher and Learn its Clouds' Throughput"""
     from services.query_hyrise import benchmark
-    dispatcher_ip = '127.0.0.1'
-    dispatcher_port = 5099
-    return benchmark(dispatcher_ip, dispatcher_port, './services/queries/q1.json', num_threads=4, num_queries=4)
+    measured_app = next((a for a in _apps if a.id == id), None) if id else None
+    dispatcher = next((s for s in measured_app.services if s.role == 'dispatcher'), None) if measured_app else None
+    dispatcher_ip = dispatcher.ip if dispatcher else '127.0.0.1'
+    dispatcher_port = dispatcher.port if dispatcher else 5099
+    result = benchmark(dispatcher_ip, dispatcher_port, './services/queries/q1.json', num_threads=4, num_queries=4)
+    if measured_app is not None:
+        get_profiles().record_benchmark(measured_app, result)
+    return result
+
+
+@traced()
+def scale_app(id, role, replicas):
+    """Change the Number of Instances of an App's Role, returns Errors of Instances not Removed"""
+    existing_app = next(a for a in _apps if a.id == id)
+    return existing_app.scale(role, replicas)
+
+
+def get_autoscaler(id):
+    """Autoscaler of an App, None if its SLA has no Throughput or Latency Target"""
+    if id not in _autoscalers:
+        existing_app = next(a for a in _apps if a.id == id)
+        if existing_app.sla.get('throughput') is None and existing_app.sla.get('latency') is None:
+            return None
+        _autoscalers[id] = Autoscaler(existing_app, existing_app.sla, health=_health, profiles=get_profiles())
+    return _autoscalers[id]
+
+
+@traced()
+def start_autoscaling(id):
+    """Scale an App's Replicas to its SLA in a Background Thread"""
+    autoscaler = get_autoscaler(id)
+    if autoscaler is not None:
+        autoscaler.start()
+    return autoscaler
+
+
+def stop_autoscaling(id):
+    """Stop Scaling an App"""
+    autoscaler = _autoscalers.pop(id, None)
+    if autoscaler is not None:
+        autoscaler.stop()
+
+
+@traced()
+def reconcile_app(id):
+    """Converge an App to its Template, only Changing Differing Instances"""
+    existing_app = next(a for a in _apps if a.id == id)
+    return existing_app.reconcile(get_inventory().instances(app_id=id))
+
+
+@traced()
+def open_state(path='./deployments/state.db'):
+    """Open the State Store, importing Templates of earlier YAML Deployments"""
+    global _store, _profiles
+    _store = StateStore(path)
+    if path != ':memory:':
+        _store.migrate_yaml(os.path.dirname(path))
+    _profiles = Profiles(_store)
+    _restore_allocations(_clouds)
+    return _store
+
+
+def main():
+    init('DEBUG')
+    open_state()
+    record_spans()
+    _init_clouds(connect=True)
+    # Each dependency wave is deployed once the previous one answers its health checks
+    deployed_app = deploy_app('hyrise')
+    # Only runs if the SLA sets a throughput or latency target
+    start_autoscaling(deployed_app.id)
+    get_throughput(deployed_app.id)
+    destroy_app(deployed_app.id)
+    _health.stop()
+    # Open in chrome://tracing to see where deployment time goes
+    export_spans('trace.json', format='chrome')
 
 
-_init_clouds()
-deploy_app('hyrise')
-# We have to wait a bit for the containers to respond before destroying them again
-# So let's do the benchmark
-get_throughput()
-destroy_app('hyrise')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import logging
+import random
+import threading
+import time
+
+# Settings per cloud in clouds.yaml (all optional):
+#
+#     gateway:
+#       rate: 10        API calls per second, unlimited if empty
+#       burst: 20       Calls allowed at once after a quiet period, defaults to rate
+#       retries: 4      Retries of a throttled call
+#       backoff: 0.5    Seconds before the first retry, doubled for each further one
+
+# Driver methods without side effects, identical concurrent calls are coalesced
+READ_PREFIXES = ('list_', 'ex_list_', 'get_', 'ex_get_')
+
+# A rejected call (429) never reached the provider, an unavailable one (503) may have.
+# So only reads are retried after 503, a repeated create or attach could apply twice.
+THROTTLED_CODES = (429,)
+READ_RETRY_CODES = (429, 503)
+
+
+def is_throttled(error, codes=THROTTLED_CODES):
+    """Provider rejected a call because of its rate limit (or is unavailable, with codes=READ_RETRY_CODES)"""
+    return getattr(error, 'code', None) in codes or \
+        getattr(error, 'http_code', None) in codes or \
+        type(error).__name__ == 'RateLimitReachedError'
+
+
+class TokenBucket:
+    """Thread-safe Rate Limit, allowing bursts up to the bucket size"""
+
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._size = float(burst or rate)
+        self._tokens = self._size
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting until one is available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._size, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            # Reserve the token now, concurrent callers queue up behind it
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class _Flight:
+    """A call in progress, whose result is shared by all identical callers"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Gateway:
+    """
+    Rate-Limited, Coalescing Proxy of a libcloud Driver
+
+    Every public driver method passes a per-cloud token bucket.
+    Identical read calls in flight at the same time (single-flight) are sent once,
+    all callers get the same result object, so they must not modify it.
+    Throttled calls are retried with jittered exponential backoff, reads also while the provider is unavailable.
+    Nodes and containers returned by the driver are bound to the gateway,
+    so their own methods (destroy, reboot, ...) pass it as well.
+    """
+
+    def __init__(self, driver, rate=None, burst=None, retries=4, backoff=0.5):
+        self._driver = driver
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self._retries = retries
+        self._backoff = backoff
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.connection = _ConnectionGateway(self, driver.connection) if hasattr(driver, 'connection') else None
+
+    def __getattr__(self, name):
+        attribute = getattr(self._driver, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            read = name.startswith(READ_PREFIXES)
+            key = (name, args, tuple(sorted(kwargs.items()))) if read else None
+            return self._bind(self.call(name, attribute, args, kwargs, key, read))
+
+        return call
+
+    def _bind(self, result):
+        """Let returned driver objects call back through the gateway instead of the bare driver"""
+        for item in result if isinstance(result, list) else [result]:
+            if getattr(item, 'driver', None) is self._driver:
+                item.driver = self
+        return result
+
+    def call(self, name, function, args=(), kwargs=None, key=None, read=False):
+        """Call through rate limit and retries, sharing the result with identical calls (same key) in flight"""
+        kwargs = kwargs or {}
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+        if key is None:
+            return self._call(name, function, args, kwargs, read)
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._call(name, function, args, kwargs, read)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _call(self, name, function, args, kwargs, read=False):
+        codes = READ_RETRY_CODES if read else THROTTLED_CODES
+        for attempt in range(self._retries + 1):
+            if self._bucket:
+                self._bucket.acquire()
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if not is_throttled(e, codes) or attempt == self._retries:
+                    raise
+                # Equal jitter: half the backoff fixed, half random, so throttled threads spread out
+                delay = self._backoff * 2 ** attempt
+                delay = max(getattr(e, 'retry_after', 0) or 0, delay / 2 + random.uniform(0, delay / 2))
+                logging.warning("{} throttled, retry {}/{} in {:.2f}s".format(name, attempt + 1, self._retries, delay))
+                time.sleep(delay)
+
+
+class _ConnectionGateway:
+    """Raw driver requests through the same gateway, GET requests are reads (coalesced, retried after 503)"""
+
+    def __init__(self, gateway, connection):
+        self._gateway = gateway
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def request(self, action, params=None, data=None, headers=None, method='GET', **kwargs):
+        key = None
+        read = method == 'GET'
+        if read and data is None and headers is None and not kwargs:
+            key = ('request', action, tuple(sorted((params or {}).items())))
+        return self._gateway.call('request', self._connection.request, (action,),
+                                  dict(kwargs, params=params, data=data, headers=headers, method=method), key, read)
@@ -0,0 +1,321 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+
+# Health checks follow the healthcheck and restart_policy keys of a service template:
+#
+#     healthcheck:
+#       test: ["CMD", "curl", "-f", "http://localhost"]    HTTP GET on the instance's ip/port,
+#       interval: 1m30s                                    any other test opens a TCP connection.
+#       timeout: 10s                                       ["NONE"] disables the check.
+#       retries: 3
+#       start_interval: 1s     Probe interval until the first success (readiness)
+#       start_period: 4m30s    Failures before the first success count only afterwards,
+#                              defaults to interval * retries
+#     restart_policy:
+#       condition: on-failure  none | on-failure | any
+#       delay: 5s
+#       max_attempts: 3        Within window, then the instance is given up
+#       window: 120s
+
+STARTING = 'starting'
+HEALTHY = 'healthy'
+UNHEALTHY = 'unhealthy'
+RESTARTING = 'restarting'
+FAILED = 'failed'
+
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(h|ms|m|s|us|ns)')
+_UNITS = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 1e-3, 'us': 1e-6, 'ns': 1e-9}
+
+
+def parse_duration(value, default=0.0):
+    """Seconds of a Docker Compose duration like 1m30s, plain numbers are seconds"""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    parts = _DURATION.findall(str(value))
+    if not parts:
+        raise ValueError("Invalid duration '{}'".format(value))
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+class HealthSpec:
+    """Probe Settings of one Service Template"""
+
+    def __init__(self, healthcheck=None, restart_policy=None):
+        healthcheck = healthcheck or {}
+        restart_policy = restart_policy or {}
+        test = [str(arg) for arg in healthcheck.get('test', [])]
+
+        self.enabled = bool(test) and test[0] != 'NONE'
+        self.path = None
+        urls = [arg for arg in test if arg.startswith('http://')]
+        if urls:
+            parts = urlsplit(urls[0])
+            self.path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        self.interval = parse_duration(healthcheck.get('interval'), 30.0)
+        self.timeout = parse_duration(healthcheck.get('timeout'), 30.0)
+        self.retries = int(healthcheck.get('retries', 3))
+        self.start_interval = min(parse_duration(healthcheck.get('start_interval'), 1.0), self.interval)
+        self.start_period = parse_duration(healthcheck.get('start_period'), self.interval * self.retries)
+
+        self.condition = restart_policy.get('condition', 'none')
+        self.restart_delay = parse_duration(restart_policy.get('delay'), 5.0)
+        self.max_attempts = restart_policy.get('max_attempts')
+        self.window = parse_duration(restart_policy.get('window'), 0.0)
+
+    @classmethod
+    def from_template(cls, template):
+        return cls(template.get('healthcheck'), template.get('restart_policy'))
+
+    @property
+    def ready_timeout(self):
+        """Seconds after which an instance that never answered is failing, not starting"""
+        if not self.enabled:
+            return 0.0
+        # Failures count after the start period, retries of them mark it unhealthy, plus one probe in flight
+        return self.start_period + self.interval * self.retries + self.timeout
+
+
+class Health:
+    """Health State of one Service Instance"""
+
+    def __init__(self, service, spec):
+        self.service = service
+        self.spec = spec
+        self.status = STARTING if spec.enabled else HEALTHY
+        self.started = time.monotonic()
+        self.failures = 0
+        self.restarts = deque()
+        self.last_check = None
+        self.last_error = None
+        self.ready_at = None
+        # Ready is set on the first success, settled also when given up
+        self.ready = asyncio.Event()
+        self.settled = asyncio.Event()
+        if not spec.enabled:
+            self.ready_at = self.started
+            self.ready.set()
+            self.settled.set()
+
+    @property
+    def is_ready(self):
+        """Responded successfully at least once since its (re)start"""
+        return self.ready.is_set()
+
+    @property
+    def is_alive(self):
+        """Not given up and less consecutive failures than allowed retries"""
+        return self.status in (STARTING, HEALTHY)
+
+    def can_restart(self, now):
+        """Restart policy allows another attempt"""
+        if self.spec.condition not in ('on-failure', 'any'):
+            return False
+        if self.spec.max_attempts is None:
+            return True
+        while self.spec.window and self.restarts and self.restarts[0] < now - self.spec.window:
+            self.restarts.popleft()
+        return len(self.restarts) < int(self.spec.max_attempts)
+
+
+async def probe(host, port, path=None, timeout=10.0):
+    """HTTP GET (curl -f semantics) or plain TCP connect, raises on failure"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        if path is None:
+            return
+        writer.write("GET {} HTTP/1.0\r\nHost: {}\r\n\r\n".format(path, host).encode())
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        status = int(status_line.split()[1])
+        if status >= 400:
+            raise OSError("HTTP {}".format(status))
+    finally:
+        writer.close()
+
+
+class HealthChecker:
+    """
+    Concurrent Health Checks of all Service Instances
+
+    All probes run as coroutines on one event loop in a background thread,
+    so thousands of instances need no thread per check.
+    A semaphore bounds the number of probes in flight.
+    """
+
+    def __init__(self, concurrency=256, restart=None, probe=probe):
+        self._concurrency = concurrency
+        self._restart = restart or (lambda service: service.restart())
+        self._probe = probe
+        self._health = {}
+        self._tasks = {}
+        self._loop = None
+        self._semaphore = None
+        self._thread = None
+
+    def start(self):
+        """Run the event loop in a background thread"""
+        if self._thread is None:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run, name='health', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        self._loop.run_forever()
+
+    def stop(self):
+        """Cancel all checks and stop the event loop"""
+        if self._thread is None:
+            return
+
+        async def cancel():
+            for task in self._tasks.values():
+                task.cancel()
+
+        asyncio.run_coroutine_threadsafe(cancel(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def _call(self, coroutine, timeout=None):
+        """Run a coroutine on the checker's loop and wait for its result"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    def watch(self, services):
+        """Start checking service instances on their declared interval"""
+
+        async def add():
+            for service in services:
+                if service.id in self._health:
+                    continue
+                health = self._health[service.id] = Health(service, self._spec(service))
+                if health.spec.enabled:
+                    self._tasks[service.id] = asyncio.ensure_future(self._check_loop(health))
+
+        self._call(add())
+
+    @staticmethod
+    def _spec(service):
+        # Clouds without reachable instances (cloud.SimulatedCloud) opt out of probing
+        if getattr(service.cloud, 'health_checks', True):
+            return HealthSpec.from_template(service.template)
+        return HealthSpec()
+
+    def ready_timeout(self, services):
+        """Seconds to wait for service instances to become ready, from their health check specs"""
+        return max([self._spec(service).ready_timeout for service in services], default=0.0)
+
+    def unwatch(self, services):
+        """Stop checking removed service instances"""
+
+        async def remove():
+            for service in services:
+                task = self._tasks.pop(service.id, None)
+                if task:
+                    task.cancel()
+                self._health.pop(service.id, None)
+
+        self._call(remove())
+
+    def health(self, service):
+        """Health state of a watched service instance"""
+        return self._health.get(service.id)
+
+    def is_ready(self, service):
+        health = self.health(service)
+        return health is not None and health.is_ready
+
+    def is_alive(self, service):
+        health = self.health(service)
+        return health is not None and health.is_alive
+
+    def wait_ready(self, services, timeout=None):
+        """Block until all service instances responded once, False on timeout or failure
+
+        Without a timeout, the instances' ready_timeout applies. An instance whose probe keeps failing
+        would otherwise be restarted by its restart policy, and block the caller, without end.
+        """
+        if timeout is None:
+            timeout = self.ready_timeout(services)
+
+        async def all_ready():
+            healths = [self._health[service.id] for service in services]
+            waiting = [asyncio.ensure_future(health.settled.wait())
+                       for health in healths if not health.settled.is_set()]
+            pending = ()
+            if waiting:
+                _, pending = await asyncio.wait(waiting, timeout=timeout)
+                for task in pending:
+                    task.cancel()
+            return not pending and all(health.status != FAILED for health in healths)
+
+        self.watch(services)
+        return self._call(all_ready())
+
+    async def _check_loop(self, health):
+        """Probe one instance forever, apply its restart policy on failure"""
+        spec = health.spec
+        while True:
+            await asyncio.sleep(spec.interval if health.is_ready else spec.start_interval)
+            await self._check(health)
+
+            if health.status == UNHEALTHY:
+                if not health.can_restart(time.monotonic()):
+                    health.status = FAILED
+                    health.settled.set()
+                    logging.error("Service {} failed its health checks, giving up: {}".format(
+                        health.service.id, health.last_error))
+                    return
+                await self._restart_service(health)
+
+    async def _check(self, health):
+        spec = health.spec
+        async with self._semaphore:
+            health.last_check = time.monotonic()
+            try:
+                await self._probe(health.service.ip, health.service.port, spec.path, spec.timeout)
+            except (OSError, ValueError, IndexError, asyncio.TimeoutError) as e:
+                health.last_error = repr(e)
+                # Within the start period, failures only mean the instance is still starting
+                if health.is_ready or health.last_check - health.started >= spec.start_period:
+                    health.failures += 1
+                    if health.failures >= spec.retries:
+                        health.status = UNHEALTHY
+                return
+        health.failures = 0
+        health.status = HEALTHY
+        if not health.is_ready:
+            health.ready_at = time.monotonic()
+        health.ready.set()
+        health.settled.set()
+
+    async def _restart_service(self, health):
+        """Redeploy an unhealthy instance after the policy's delay"""
+        health.status = RESTARTING
+        health.restarts.append(time.monotonic())
+        logging.warning("Restarting service {} ({}. attempt): {}".format(
+            health.service.id, len(health.restarts), health.last_error))
+        await asyncio.sleep(health.spec.restart_delay)
+        try:
+            # Provider calls block, keep them off the event loop
+            await asyncio.get_event_loop().run_in_executor(None, self._restart, health.service)
+        except Exception as e:
+            health.last_error = repr(e)
+            logging.error("Restart of service {} failed: {}".format(health.service.id, e))
+        health.status = STARTING
+        health.started = time.monotonic()
+        health.failures = 0
+        health.ready_at = None
+        health.ready.clear()
+        health.settled.clear()
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.dummy import Pool
+
+from cloud import LABEL_APP, LABEL_IP, LABEL_PORT, LABEL_ROLE
+
+Instance = namedtuple('Instance', 'cloud name app_id role ip port labels')
+
+
+def _to_instance(cloud, name, labels):
+    """Instance from the broker labels (Docker) or metadata (OpenStack)"""
+    port = labels.get(LABEL_PORT)
+    return Instance(cloud=cloud,
+                    name=name,
+                    app_id=labels.get(LABEL_APP),
+                    role=labels.get(LABEL_ROLE),
+                    ip=labels.get(LABEL_IP),
+                    port=int(port) if port else None,
+                    labels=labels)
+
+
+class Inventory:
+    """
+    Indexed App Instances of all Clouds
+
+    Instances are indexed by (cloud id, name), by app id and role, and by cloud,
+    so all lookups are dictionary accesses. All clouds are asked at the same time.
+    After the first full listing, a refresh only fetches instances changed since
+    the previous one, if the cloud supports it (changed_instances).
+    """
+
+    # Changes are requested with some overlap, provider clocks are not exact
+    SLACK = 2
+
+    def __init__(self, clouds, concurrency=None):
+        self._clouds = [cloud for cloud in clouds if hasattr(cloud, 'list_instances')]
+        self._concurrency = concurrency or max(len(self._clouds), 1)
+        self._lock = threading.RLock()
+        self._instances = {}
+        self._by_app = {}
+        self._by_cloud = {}
+        self._since = {}
+
+    def refresh(self, full=False):
+        """Update the index from all clouds, returns errors by cloud id"""
+        if not self._clouds:
+            return {}
+        with Pool(min(self._concurrency, len(self._clouds))) as pool:
+            results = pool.map(lambda cloud: (cloud, self._refresh_cloud(cloud, full)), self._clouds)
+        errors = {cloud.id: error for cloud, error in results if error}
+        for cloud_id, error in errors.items():
+            logging.error("Inventory of {} failed, keeping the last known state: {}".format(cloud_id, error))
+        return errors
+
+    def _refresh_cloud(self, cloud, full):
+        started = time.time()
+        try:
+            if not full and cloud.id in self._since and hasattr(cloud, 'changed_instances'):
+                try:
+                    changed, removed = cloud.changed_instances(self._since[cloud.id] - self.SLACK)
+                except Exception as e:
+                    # Otherwise the same interval would fail again on every refresh
+                    logging.warning("Changes of {} unavailable, listing all instances: {}".format(cloud.id, e))
+                else:
+                    with self._lock:
+                        for name in removed:
+                            self._remove((cloud.id, name))
+                        for name, labels in changed:
+                            self._add(_to_instance(cloud, name, labels))
+                    self._since[cloud.id] = started
+                    return None
+
+            listed = cloud.list_instances()
+            with self._lock:
+                for key in list(self._by_cloud.get(cloud.id, ())):
+                    self._remove(key)
+                for name, labels in listed:
+                    self._add(_to_instance(cloud, name, labels))
+        except Exception as e:
+            return e
+        self._since[cloud.id] = started
+        return None
+
+    def _add(self, instance):
+        key = (instance.cloud.id, instance.name)
+        self._remove(key)
+        self._instances[key] = instance
+        self._by_app.setdefault(instance.app_id, {}).setdefault(instance.role, {})[key] = instance
+        self._by_cloud.setdefault(instance.cloud.id, {})[key] = instance
+
+    def _remove(self, key):
+        instance = self._instances.pop(key, None)
+        if instance is None:
+            return
+        roles = self._by_app[instance.app_id]
+        del roles[instance.role][key]
+        if not roles[instance.role]:
+            del roles[instance.role]
+        if not roles:
+            del self._by_app[instance.app_id]
+        del self._by_cloud[instance.cloud.id][key]
+
+    def get(self, cloud_id, name):
+        """Instance by Cloud and Name"""
+        return self._instances.get((cloud_id, name))
+
+    def apps(self):
+        """Ids of all Apps with Running Instances"""
+        with self._lock:
+            return list(self._by_app)
+
+    def roles(self, app_id):
+        """Instances of an App by Role"""
+        with self._lock:
+            return {role: list(instances.values()) for role, instances in self._by_app.get(app_id, {}).items()}
+
+    def instances(self, app_id=None, role=None, cloud_id=None):
+        """Instances, optionally of an App, Role and/or Cloud"""
+        with self._lock:
+            if app_id is not None:
+                roles = self._by_app.get(app_id, {})
+                found = roles.get(role, {}).values() if role is not None else \
+                    [instance for instances in roles.values() for instance in instances.values()]
+            elif cloud_id is not None:
+                found = self._by_cloud.get(cloud_id, {}).values()
+            else:
+                found = self._instances.values()
+            return [instance for instance in found
+                    if (role is None or instance.role == role) and
+                    (cloud_id is None or instance.cloud.id == cloud_id)]
+
+    def __len__(self):
+        return len(self._instances)
@@ -1,10 +1,17 @@
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
 
 def init(level='DEBUG'):
-    """Enable Readable Logging"""
+    """Enable Readable Logging and Global Exception and Exit Handlers"""
+    import atexit
     import coloredlogs
 
+    sys.excepthook = handle_exception
+    atexit.register(exit_handler)
+
     coloredlogs.install(
         level=level,
         level_styles={'info': {'color': 'green', 'bold': True},
@@ -21,11 +28,21 @@ def init(level='DEBUG'):
         fmt='%(asctime)s  [%(levelname)-5s] %(message)s')
 
 
+def _describe(arg, log_attr):
+    """Searches for object variable or dict item"""
+    if log_attr is None:
+        return arg
+    return getattr(arg, log_attr, arg.get(log_attr) if getattr(arg, 'get', False) else "")
+
+
 def traced(log_attr=None):
     """
     Print Function and Method Entry w/ Parameters and Exit w/ Return Values
 
     Use this function as a decorator for automatic tracing, based on log level.
+    All introspection happens once, when decorating. Messages are only formatted
+    if their level is enabled, so a traced call costs next to nothing otherwise.
+    While spans are recorded (see record_spans), each call also becomes a span.
 
     Inspiration
     - Parameters (w/ defaults):
@@ -39,48 +56,56 @@ def traced(log_attr=None):
 
     """
     import functools
+    import inspect
     import logging
     import pprint
-    import inspect
 
     def real_decorator(decorated_function):
 
+        params = list(inspect.signature(decorated_function).parameters)
+        is_method = bool(params) and params[0] == 'self'
+        arg_index = 1 if is_method else 0
+        arg_name = params[arg_index] if len(params) > arg_index else None
+        name_index = params.index('name') if 'name' in params else None
+        doc = decorated_function.__doc__
+        span_name = decorated_function.__qualname__
+        logger = logging.getLogger()
+
         @functools.wraps(decorated_function)
         def with_logging(*args, **kwargs):
 
-            is_method = inspect.getfullargspec(decorated_function).args[0] == 'self'
-            arg_index = 1 if is_method else 0
-
-            # TODO: Catch kwargs
-
-            if log_attr:
-                logging.info("{func.__doc__} {arg}".format(
-                    func=decorated_function,
-                    # Searches for object variable or dict item
-                    arg=getattr(args[arg_index], log_attr,
-                                args[arg_index].get(log_attr)
-                                if getattr(args[arg_index], 'get', False)
-                                else "")
-                    if len(args) > arg_index else ""
-                ))
-                logging.debug("{func.__name__}({args})".format(
-                    func=decorated_function,
-                    args=getattr(args[arg_index], log_attr,
-                                 args[arg_index].get(log_attr)
-                                 if getattr(args[arg_index], 'get', False)
-                                 else "")
-                    if len(args) > arg_index else ""))
+            if logger.isEnabledFor(logging.INFO):
+                if len(args) > arg_index:
+                    arg = _describe(args[arg_index], log_attr)
+                elif arg_name in kwargs:
+                    arg = _describe(kwargs[arg_name], log_attr)
+                else:
+                    arg = ""
+                logger.info("%s %s", doc, arg)
+                if logger.isEnabledFor(logging.DEBUG):
+                    if log_attr:
+                        logger.debug("%s(%s)", decorated_function.__name__, arg)
+                    else:
+                        logger.debug("%s%s", decorated_function.__name__,
+                                     pprint.pformat(args[arg_index:], compact=True, width=240, depth=1))
+
+            if not _recording:
+                wrapped_function = decorated_function(*args, **kwargs)
             else:
-                logging.info("{func.__doc__} {arg}".format(
-                    func=decorated_function,
-                    arg=args[arg_index] if len(args) > arg_index else ""))
-                logging.debug("{func.__name__}{args}".format(
-                    func=decorated_function,
-                    args="".join(pprint.pformat(args[arg_index:], compact=True, width=240, depth=1))))
-
-            wrapped_function = decorated_function(*args, **kwargs)
-            if wrapped_function:
-                logging.debug(pprint.pformat(wrapped_function, compact=True, width=120, depth=3))
+                service = None
+                if name_index is not None:
+                    service = args[name_index] if len(args) > name_index else kwargs.get('name')
+                cloud = getattr(args[0], 'id', None) if is_method else None
+                with span(span_name, cloud=cloud, service=service) as current:
+                    try:
+                        wrapped_function = decorated_function(*args, **kwargs)
+                    finally:
+                        # The cloud id of a constructor is only known afterwards
+                        if is_method and current['cloud'] is None:
+                            current['cloud'] = getattr(args[0], 'id', None)
+
+            if logger.isEnabledFor(logging.DEBUG) and wrapped_function:
+                logger.debug(pprint.pformat(wrapped_function, compact=True, width=120, depth=3))
             return wrapped_function
 
         return with_logging
@@ -88,7 +113,99 @@ def traced(log_attr=None):
     return real_decorator
 
 
-from contextlib import contextmanager
+##############################################################
+# Timing Spans                                               #
+##############################################################
+
+_recording = False
+_spans = []
+_spans_lock = threading.Lock()
+_context = threading.local()
+
+
+def record_spans(enabled=True):
+    """Start or Stop Recording Timing Spans of Traced Calls"""
+    global _recording
+    _recording = enabled
+
+
+def clear_spans():
+    """Drop all Recorded Spans"""
+    with _spans_lock:
+        del _spans[:]
+
+
+def spans():
+    """List Recorded Spans"""
+    with _spans_lock:
+        return list(_spans)
+
+
+@contextmanager
+def span(name, cloud=None, service=None):
+    """
+    Time a Block as Span
+
+    Nested spans inherit cloud and service id of the enclosing span in the same thread.
+    The outcome is 'ok' or the name of the raised exception.
+    """
+    stack = getattr(_context, 'stack', None)
+    if stack is None:
+        stack = _context.stack = []
+    parent = stack[-1] if stack else {}
+    current = {
+        'name': name,
+        'cloud': cloud if cloud is not None else parent.get('cloud'),
+        'service': service if service is not None else parent.get('service'),
+        'thread': threading.get_ident(),
+        'start': time.time(),
+        'duration': None,
+        'outcome': 'ok',
+    }
+    stack.append(current)
+    begin = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current['outcome'] = type(e).__name__
+        raise
+    finally:
+        current['duration'] = time.perf_counter() - begin
+        stack.pop()
+        if _recording:
+            with _spans_lock:
+                _spans.append(current)
+
+
+def export_spans(path, format='json'):
+    """
+    Write Recorded Spans to File
+
+    'json' writes a plain list of spans, durations in seconds.
+    'chrome' writes the Trace Event Format, to open in chrome://tracing or Perfetto.
+    """
+    import json
+    import os
+
+    recorded = spans()
+    if format == 'chrome':
+        data = {'traceEvents': [{
+            'name': s['name'],
+            'cat': s['cloud'] or 'broker',
+            'ph': 'X',
+            'ts': s['start'] * 1e6,
+            'dur': s['duration'] * 1e6,
+            'pid': os.getpid(),
+            'tid': s['thread'],
+            'args': {'cloud': s['cloud'], 'service': s['service'], 'outcome': s['outcome']},
+        } for s in recorded], 'displayTimeUnit': 'ms'}
+    elif format == 'json':
+        data = recorded
+    else:
+        raise ValueError("Unknown span format '{}'".format(format))
+
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
 
 
 @contextmanager
@@ -123,14 +240,6 @@ def handle_exception(*exc_info):
     logging.critical("".join(traceback.format_exception(*exc_info)))
 
 
-sys.excepthook = handle_exception
-
-import atexit
-
-
 def exit_handler():
     import logging
     logging.info("Exit")
-
-
-atexit.register(exit_handler)
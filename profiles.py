@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Metrics learned per cloud and instance size:
+#     throughput    Queries/s of one replica, from services/query_hyrise.benchmark
+#     ready         Seconds from deployment until the instance answered its health check (or ran, without one)
+THROUGHPUT = 'throughput'
+READY = 'ready'
+
+# Summary over all instance sizes of a cloud, as read by the scheduler
+ALL_SIZES = '*'
+
+
+def instance_size(srv_template):
+    """Instance size of a service template, from its reserved resources"""
+    reservations = srv_template.get('deploy', {}).get('resources', {}).get('reservations', {})
+    if not reservations:
+        return 'default'
+    return '{}cpu/{}'.format(reservations.get('cpus', 0), reservations.get('memory', 0))
+
+
+class Series:
+    """Smoothed Summary of one Metric, an EWMA and Percentiles over recent Samples"""
+
+    def __init__(self, alpha=0.2, window=256):
+        self._alpha = alpha
+        self._samples = deque(maxlen=window)
+        self.ewma = None
+        self.count = 0
+        self.updated = None
+
+    def add(self, value, at=None):
+        self.ewma = value if self.ewma is None else self._alpha * value + (1 - self._alpha) * self.ewma
+        self._samples.append(value)
+        self.count += 1
+        self.updated = at or time.time()
+
+    def percentile(self, percent):
+        return float(np.percentile(self._samples, percent)) if self._samples else float('nan')
+
+    def summary(self):
+        return {'count': self.count, 'ewma': self.ewma, 'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'updated': self.updated}
+
+
+class Profiles:
+    """
+    Learned Performance of Clouds and Instance Sizes
+
+    Samples are appended to the state store (if given), summaries are kept in memory.
+    On start, the most recent samples are replayed, older ones are dropped from the store.
+    The scheduler reads them as throughput per cost and time to ready (see scheduler.Offers).
+    """
+
+    def __init__(self, store=None, alpha=0.2, window=256):
+        self._store = store
+        self._alpha = alpha
+        self._window = window
+        self._series = {}
+        self._lock = threading.Lock()
+        if store is not None:
+            store.trim_samples(window)
+            self._add(store.samples(), persist=False)
+
+    def record(self, cloud_id, size, metric, value):
+        """Add a single sample"""
+        self._add([(cloud_id, size, metric, value, time.time())])
+
+    def _add(self, samples, persist=True):
+        samples = list(samples)
+        with self._lock:
+            for cloud_id, size, metric, value, at in samples:
+                for key in ((cloud_id, size, metric), (cloud_id, ALL_SIZES, metric)):
+                    series = self._series.get(key)
+                    if series is None:
+                        series = self._series[key] = Series(self._alpha, self._window)
+                    series.add(value, at)
+        if persist and self._store is not None and samples:
+            # The store keeps as many samples per series as are replayed on start
+            self._store.add_samples(samples, keep=self._window)
+
+    def record_benchmark(self, app, result, role='replica'):
+        """Credit a valid benchmark result of an app to the cloud of its replicas, if they all run on one"""
+        # The dispatcher balances queries evenly, so every replica serves the same share.
+        # With replicas on several clouds, the share tells nothing about any single cloud.
+        replicas = [service for service in app.services if service.role == role]
+        if not replicas or not result.valid or len({service.cloud.id for service in replicas}) > 1:
+            return
+        share = result.throughput / len(replicas)
+        now = time.time()
+        self._add([(service.cloud.id, instance_size(service.template), THROUGHPUT, share, now)
+                   for service in replicas])
+
+    def record_ready(self, services, seconds):
+        """Record the time to ready of deployed service instances ({service id: seconds})"""
+        now = time.time()
+        self._add([(service.cloud.id, instance_size(service.template), READY, seconds[service.id], now)
+                   for service in services if service.id in seconds])
+
+    def summary(self, cloud_id, metric, size=ALL_SIZES):
+        """EWMA and percentiles of a metric, None without samples"""
+        with self._lock:
+            series = self._series.get((cloud_id, size, metric))
+            return series.summary() if series else None
+
+    def ewma(self, cloud_id, metric, size=ALL_SIZES):
+        """Smoothed value of a metric, NaN without samples"""
+        summary = self.summary(cloud_id, metric, size)
+        return summary['ewma'] if summary else float('nan')
+
+    def throughput_per_cost(self, cloud, size=ALL_SIZES):
+        """Replica throughput per unit of cost, NaN if either is unknown"""
+        try:
+            cost = float(cloud.cost)
+        except (TypeError, ValueError):
+            return float('nan')
+        throughput = self.ewma(cloud.id, THROUGHPUT, size)
+        return throughput / cost if cost > 0 else float('nan')
+
+    def time_to_ready(self, cloud, size=ALL_SIZES):
+        """Smoothed seconds until a new instance is ready, NaN if unknown"""
+        return self.ewma(cloud.id, READY, size)
@@ -2,24 +2,501 @@
 #         - Service Dependencies -> Handled by the app itself
 #         - Hard Constraints (Geo-Location, Technology, Resources, Features) -> Scheduler
 #         - Soft Constraints (Availability, Performance, Price) -> Scheduler
+#
+#     SLA keys (all optional):
+#         locations:     [de, ...]  Allowed cloud locations (country)
+#         availability:  0.95       Minimum availability of a single cloud
+#         max_cost:      2          Maximum cost of a single cloud
+#         weights:       {cost: 1, availability: 1, performance: 1, ready: 1}
+#                        performance and ready (time to ready) are learned if profiles are given
+#         replica_availability: 0.999   Minimum combined availability of a replicated role
+#         colocation:    cloud | location   Place services with their dependencies
+
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_WEIGHTS = {'cost': 1.0, 'availability': 1.0, 'performance': 1.0, 'ready': 1.0}
+
+
+class SchedulerError(Exception):
+    pass
+
+
+def _float(value):
+    """Numeric config value, NaN if unset"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def _memory_mb(value):
+    """Docker-style memory size (50M, 2G) in MB"""
+    if value is None:
+        return 0.0
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value) / (1024 * 1024)
+
+
+def _normalized(values, higher_is_better=True):
+    """Scale to [0, 1] over all clouds, unknown values score neutral"""
+    known = ~np.isnan(values)
+    if not known.any():
+        return np.full(values.shape, 0.5)
+    low, high = np.nanmin(values), np.nanmax(values)
+    scaled = np.ones(values.shape) if high == low else (values - low) / (high - low)
+    if not higher_is_better:
+        scaled = 1 - scaled
+    return np.where(known, scaled, 0.5)
+
+
+class Offers:
+    """Cloud attributes as vectors, built once per scheduling run
+
+    With learned profiles (profiles.Profiles), performance is the measured throughput
+    per cost instead of the configured hint, and ready the time until new instances answer.
+    """
+
+    def __init__(self, clouds, profiles=None):
+        self.clouds = list(clouds)
+        self.providers = [c.provider for c in self.clouds]
+        self.locations = np.array([getattr(c, 'location', None) for c in self.clouds], dtype=object)
+        self.cost = np.array([_float(c.cost) for c in self.clouds])
+        self.availability = np.array([_float(c.availability) for c in self.clouds])
+        self.performance = np.array([_float(getattr(c, 'performance', None)) for c in self.clouds])
+        self.throughput = np.full(len(self.clouds), np.nan)
+        self.ready = np.full(len(self.clouds), np.nan)
+        if profiles is not None:
+            self.throughput = np.array([profiles.ewma(c.id, 'throughput') for c in self.clouds])
+            self.ready = np.array([profiles.time_to_ready(c) for c in self.clouds])
+            # Measurements and configured hints are not comparable, so any measurement replaces all hints
+            if (~np.isnan(self.throughput)).any():
+                self.performance = np.array([profiles.throughput_per_cost(c) for c in self.clouds])
+        # Unknown capacity does not constrain placement
+        capacity = [getattr(c, 'capacity', None) or {} for c in self.clouds]
+        self.capacity = np.array([[_float(cap.get('cpus', 'inf')), _memory_mb(cap.get('memory', 'inf'))]
+                                  for cap in capacity]).reshape(len(self.clouds), 2)
+        self.capacity[np.isnan(self.capacity)] = np.inf
+
+    def __len__(self):
+        return len(self.clouds)
+
+
+def _demands(srv_templates):
+    """Reserved resources per service as a service x (cpus, memory) matrix"""
+    demands = []
+    for srv in srv_templates:
+        reservations = srv.get('deploy', {}).get('resources', {}).get('reservations', {})
+        demands.append([_float(reservations.get('cpus', 0)), _memory_mb(reservations.get('memory'))])
+    demands = np.array(demands).reshape(len(demands), 2)
+    demands[np.isnan(demands)] = 0
+    return demands
+
+
+def feasibility(offers, srv_templates, sla):
+    """Hard constraints as a cloud x service mask"""
+    # Provider support via one-hot vectors over all known providers
+    vocabulary = sorted(set(offers.providers) | {p for srv in srv_templates for p in srv['provider']})
+    index = {provider: i for i, provider in enumerate(vocabulary)}
+    cloud_providers = np.zeros((len(offers), len(vocabulary)), dtype=bool)
+    cloud_providers[np.arange(len(offers)), [index[p] for p in offers.providers]] = True
+    srv_providers = np.zeros((len(srv_templates), len(vocabulary)), dtype=bool)
+    for row, srv in enumerate(srv_templates):
+        srv_providers[row, [index[p] for p in srv['provider']]] = True
+    mask = (cloud_providers.astype(np.uint8) @ srv_providers.T.astype(np.uint8)) > 0
+
+    # Per-cloud SLA constraints
+    cloud_mask = np.ones(len(offers), dtype=bool)
+    if sla.get('locations'):
+        cloud_mask &= np.isin(offers.locations, list(sla['locations']))
+    if sla.get('availability') is not None:
+        cloud_mask &= offers.availability >= float(sla['availability'])
+    if sla.get('max_cost') is not None:
+        cloud_mask &= offers.cost <= float(sla['max_cost'])
+
+    # Resources
+    fits = (offers.capacity[:, None, :] >= _demands(srv_templates)[None, :, :]).all(axis=2)
+
+    return mask & cloud_mask[:, None] & fits
+
+
+def weight(offers, sla):
+    """Weighted soft score per cloud, higher is better"""
+    weights = dict(DEFAULT_WEIGHTS, **sla.get('weights', {}))
+    return (weights['cost'] * _normalized(offers.cost, higher_is_better=False) +
+            weights['availability'] * _normalized(offers.availability) +
+            weights['performance'] * _normalized(offers.performance) +
+            weights['ready'] * _normalized(offers.ready, higher_is_better=False))
+
+
+def _distinct(srv_templates):
+    """Distinct templates and the column of each service within them"""
+    # Replicas share their template, so it is evaluated only once
+    distinct = {}
+    columns = [distinct.setdefault(id(srv), (len(distinct), srv))[0] for srv in srv_templates]
+    return [srv for _, srv in distinct.values()], np.array(columns, dtype=int)
+
+
+def score(offers, srv_templates, sla):
+    """Cloud x service scores, -inf where a hard constraint fails"""
+    mask = feasibility(offers, srv_templates, sla)
+    return np.where(mask, weight(offers, sla)[:, None], -np.inf)
+
+
+def rank_indices(offers, srv_templates, sla):
+    """Cloud indices ranked per service (cloud x service) and the number of feasible clouds per service"""
+    distinct, columns = _distinct(srv_templates)
+    scores = score(offers, distinct, sla)
+    # A stable sort keeps the configuration order for equal scores
+    order = np.argsort(-scores, axis=0, kind='mergesort')
+    return order[:, columns], np.isfinite(scores).sum(axis=0)[columns]
+
+
+def rank(clouds, srv_templates, sla):
+    """Ranked candidate clouds for each service template, best first"""
+    offers = clouds if isinstance(clouds, Offers) else Offers(clouds)
+    order, feasible = rank_indices(offers, srv_templates, sla)
+    return [[offers.clouds[c] for c in order[:feasible[s], s]] for s in range(len(srv_templates))]
+
+
+def candidates(clouds, srv_template, sla):
+    """Ranked candidate clouds for a single service template"""
+    return rank(clouds, [srv_template], sla)[0]
 
 
 def place(clouds, srv_template, sla):
     # Should SLAs only be considered at this level?
     # Combining several less reliable clouds might still be suitable?
-    # TODO: Take a list of templates and optimize a whole app at once
-    # Currently returning the first cloud offering a supported provider.
-    return list(filter(lambda c: c.provider in srv_template['provider'], clouds))[0]
+    # This places a single service greedily, see optimize() for a whole app.
+    ranked = candidates(clouds, srv_template, sla)
+    if not ranked:
+        raise SchedulerError("No match for role '{}'. Check cloud resources or change SLA.".format(
+            srv_template['role']))
+    return ranked[0]
 
 
-def filter_provider(cloud, srv_template):
-    """Remove non-supported clouds"""
-    pass
+class Placement:
+    """Clouds for every instance of every role of an app"""
 
+    def __init__(self, clouds_by_role, cost, optimal, elapsed, nodes=0):
+        self._clouds_by_role = clouds_by_role
+        self.cost = cost
+        self.optimal = optimal
+        self.elapsed = elapsed
+        self.nodes = nodes
 
-def weight():
-    """Find the most suitable cloud"""
-    pass
+    def clouds(self, role):
+        """Scheduled clouds for all instances of a role"""
+        return self._clouds_by_role.get(role, [])
+
+    def availability(self, role):
+        """Combined availability of a role's instances"""
+        return combined_availability(self.clouds(role))
+
+    def __repr__(self):
+        return "<{name}: cost={cost} optimal={optimal}>".format(name=__name__, cost=self.cost, optimal=self.optimal)
+
+
+def combined_availability(clouds):
+    """Probability that at least one of the given clouds is available"""
+    failure = 1.0
+    for cloud in clouds:
+        availability = _float(cloud.availability)
+        failure *= 1 - (0.0 if np.isnan(availability) else availability)
+    return 1 - failure
+
+
+def instance_count(srv_template):
+    """Number of instances a service template asks for"""
+    if srv_template['deploy']['mode'] == 'global':
+        return 1
+    return srv_template['deploy']['replicas']
+
+
+def dependency_waves(srv_templates):
+    """Service templates grouped into waves, every dependency in an earlier wave than its dependents"""
+    roles = {srv['role'] for srv in srv_templates}
+    waves, done, pending = [], set(), list(srv_templates)
+    while pending:
+        ready = [srv for srv in pending if all(dep in done or dep not in roles for dep in srv['depends_on'])]
+        if not ready:
+            raise SchedulerError("Circular service dependencies: {}".format([srv['role'] for srv in pending]))
+        waves.append(ready)
+        done.update(srv['role'] for srv in ready)
+        pending = [srv for srv in pending if all(srv is not r for r in ready)]
+    return waves
+
+
+def greedy(clouds, srv_templates, sla):
+    """Place every instance independently with place(), for comparison with optimize()"""
+    start = time.perf_counter()
+    clouds_by_role = {srv['role']: [place(clouds, srv, sla)] * instance_count(srv) for srv in srv_templates}
+    cost = sum(_float(c.cost) for placed in clouds_by_role.values() for c in placed)
+    return Placement(clouds_by_role, cost, optimal=False, elapsed=time.perf_counter() - start)
+
+
+def optimize(clouds, srv_templates, sla, time_budget=1.0, fixed=None, used=None, profiles=None):
+    """
+    Place all instances of an app jointly at minimum total cost
+
+    Hard constraints are those of feasibility() plus the capacity shared by all
+    instances on a cloud, the combined replica availability and the dependency
+    co-location of the SLA. Depth-first branch-and-bound over the instances in
+    dependency order: candidates are tried cheapest first, so the first complete
+    placement is the greedy one, and branches are cut by a cost lower bound.
+    Replicas of a role are interchangeable, so only non-decreasing candidate
+    sequences are explored. When the time budget runs out, the best placement
+    found so far is returned with optimal=False.
+
+    fixed pins already deployed instances ({role: [cloud, ...]}),
+    used is resource usage (cloud x (cpus, memory)) already taken by others,
+    profiles (profiles.Profiles) price each replica by its measured throughput.
+    """
+    start = time.perf_counter()
+    offers = clouds if isinstance(clouds, Offers) else Offers(clouds, profiles)
+    templates = [srv for wave in dependency_waves(srv_templates) for srv in wave]
+    fixed = fixed or {}
+
+    # Unknown costs are assumed to be the most expensive known cost
+    cost = offers.cost.copy()
+    cost[np.isnan(cost)] = np.nanmax(cost) if (~np.isnan(cost)).any() else 0.0
+    # A replica with half the measured throughput costs twice as much per query,
+    # clouds without measurements are assumed to be as fast as the best one
+    effective = cost.copy()
+    best_throughput = np.nanmax(offers.throughput) if (~np.isnan(offers.throughput)).any() else 0.0
+    if best_throughput > 0:
+        # At most 1000 times, a cloud without throughput stays a last resort
+        slowdown = best_throughput / np.maximum(offers.throughput, best_throughput * 1e-3)
+        effective *= np.where(np.isnan(slowdown), 1.0, slowdown)
+    # The soft score breaks ties between equally priced clouds
+    soft = weight(offers, sla)
+    unit = (effective + 1e-6 * (soft.max() - soft)).tolist()
+    availability = np.nan_to_num(offers.availability).tolist()
+
+    mask = feasibility(offers, templates, sla)
+    demands = _demands(templates).tolist()
+    capacity = (offers.capacity - (used if used is not None else 0)).tolist()
+    load = [[0.0, 0.0] for _ in range(len(offers))]
+
+    colocation = sla.get('colocation')
+    if colocation == 'location':
+        key = [c.location for c in offers.clouds]
+    else:
+        key = list(range(len(offers)))
+    target = sla.get('replica_availability')
+
+    # One slot per instance, pinned instances first within their role
+    cloud_index = {id(c): i for i, c in enumerate(offers.clouds)}
+    role_index = {srv['role']: r for r, srv in enumerate(templates)}
+    slots, ranges = [], []
+    for r, srv in enumerate(templates):
+        pinned = [cloud_index[id(c)] for c in fixed.get(srv['role'], [])]
+        first = len(slots)
+        for k in range(max(instance_count(srv), len(pinned))):
+            slots.append((r, pinned[k] if k < len(pinned) else None))
+        ranges.append((first, len(slots)))
+    deps = [[role_index[d] for d in srv['depends_on'] if d in role_index] for srv in templates]
+    check_availability = [target is not None and srv['deploy']['mode'] != 'global' for srv in templates]
+
+    candidates = [sorted(np.flatnonzero(mask[:, r]).tolist(), key=lambda c: unit[c]) for r in range(len(templates))]
+    # Best availability among candidates from a position onwards, for pruning
+    best_availability = [[max([availability[c] for c in cands[p:]] or [0.0]) for p in range(len(cands) + 1)]
+                         for cands in candidates]
+
+    def free_slots(r, c):
+        """Instances of a role that still fit on a cloud"""
+        free = np.inf
+        for k in (0, 1):
+            if demands[r][k] > 0:
+                free = min(free, (capacity[c][k] - load[c][k]) // demands[r][k])
+        return free
+
+    def fill(r, p, count, taken=None):
+        """Lower bound: cheapest cost of count instances of a role on its candidates from position p"""
+        total = 0.0
+        for c in candidates[r][p:]:
+            if not count:
+                break
+            placed = min(count, free_slots(r, c) - (1 if c == taken else 0))
+            if placed > 0:
+                total += placed * unit[c]
+                count -= placed
+        return total if not count else np.inf
+
+    # Lower bound of the cost of all roles after a role, each on its own
+    later = [0.0] * (len(templates) + 1)
+    for r in range(len(templates) - 1, -1, -1):
+        pinned = [c for _, c in slots[ranges[r][0]:ranges[r][1]] if c is not None]
+        own = sum(unit[c] for c in pinned) + fill(r, 0, ranges[r][1] - ranges[r][0] - len(pinned))
+        if own == np.inf:
+            raise SchedulerError("No match for role '{}'. Check cloud resources or change SLA.".format(
+                templates[r]['role']))
+        later[r] = later[r + 1] + own
+    later = later[1:]
+
+    n = len(slots)
+    assign, position, trial = [None] * n, [0] * n, [0] * (n + 1)
+    spent, failure = [0.0] * (n + 1), [1.0] * (n + 1)
+    best, best_cost, complete, nodes = None, np.inf, True, 0
+
+    def first_position(d):
+        r, pinned = slots[d]
+        if pinned is None and d > 0 and slots[d - 1][0] == r and slots[d - 1][1] is None:
+            return position[d - 1]
+        return 0
+
+    def colocated(d, c):
+        for q in deps[slots[d][0]]:
+            for j in range(*ranges[q]):
+                if key[assign[j]] != key[c]:
+                    return False
+        return True
+
+    def fits(d, c):
+        demand = demands[slots[d][0]]
+        return load[c][0] + demand[0] <= capacity[c][0] and load[c][1] + demand[1] <= capacity[c][1]
+
+    def take(d, c, p):
+        r = slots[d][0]
+        assign[d], position[d], trial[d] = c, p, p + 1
+        load[c][0] += demands[r][0]
+        load[c][1] += demands[r][1]
+        spent[d + 1] = spent[d] + unit[c]
+        previous = failure[d] if d > 0 and slots[d - 1][0] == r else 1.0
+        failure[d + 1] = previous * (1 - availability[c])
+
+    def release(d):
+        c, r = assign[d], slots[d][0]
+        load[c][0] -= demands[r][0]
+        load[c][1] -= demands[r][1]
+
+    d = 0
+    trial[0] = first_position(0) if n else 0
+    while d >= 0:
+        nodes += 1
+        if nodes % 256 == 0 and time.perf_counter() - start > time_budget:
+            complete = False
+            break
+
+        if d == n:
+            if spent[n] < best_cost:
+                best, best_cost = list(assign), spent[n]
+            d -= 1
+            if d >= 0:
+                release(d)
+            continue
+
+        r, pinned = slots[d]
+        last = d == ranges[r][1] - 1
+        chosen = None
+        if pinned is not None:
+            if trial[d] == 0:
+                chosen = (pinned, 0)
+        else:
+            cands = candidates[r]
+            for p in range(trial[d], len(cands)):
+                c = cands[p]
+                if not fits(d, c):
+                    continue
+                bound = spent[d] + unit[c] + fill(r, p, ranges[r][1] - d - 1, taken=c) + later[r]
+                if bound >= best_cost:
+                    # Candidates are sorted by cost, later positions cannot do better
+                    break
+                if colocation and not colocated(d, c):
+                    continue
+                if check_availability[r]:
+                    previous = failure[d] if d > ranges[r][0] else 1.0
+                    optimistic = previous * (1 - availability[c]) * \
+                        (1 - best_availability[r][p]) ** (ranges[r][1] - d - 1)
+                    if optimistic > 1 - target + 1e-12:
+                        continue
+                chosen = (c, p)
+                break
+
+        if chosen is None or (last and check_availability[r] and pinned is not None and
+                              (failure[d] if d > ranges[r][0] else 1.0) * (1 - availability[pinned]) > 1 - target + 1e-12):
+            if chosen is not None:
+                trial[d] = 1
+            d -= 1
+            if d >= 0:
+                release(d)
+            continue
+
+        take(d, *chosen)
+        d += 1
+        if d < n:
+            trial[d] = first_position(d)
+
+    if best is None:
+        raise SchedulerError("No placement satisfies the SLA{}".format(
+            "" if complete else " within {}s".format(time_budget)))
+
+    clouds_by_role = {srv['role']: [offers.clouds[best[j]] for j in range(*ranges[r])]
+                      for r, srv in enumerate(templates)}
+    total = float(sum(cost[c] for c in best))
+    return Placement(clouds_by_role, total, optimal=complete, elapsed=time.perf_counter() - start, nodes=nodes)
+
+
+def usage(clouds, srv_templates, clouds_by_role):
+    """Resources reserved by instances ({role: [cloud, ...]}) as cloud x (cpus, memory) matrix"""
+    index = {id(c): i for i, c in enumerate(clouds)}
+    demands = _demands(srv_templates)
+    used = np.zeros((len(clouds), 2))
+    for s, srv in enumerate(srv_templates):
+        for cloud in clouds_by_role.get(srv['role'], []):
+            used[index[id(cloud)]] += demands[s]
+    return used
+
+
+class CapacityLedger:
+    """
+    Resources Reserved by several Apps on Shared Clouds
+
+    Apps plan one at a time against what all other apps already reserved,
+    planning is quick compared to deploying, which then runs concurrently.
+    """
+
+    def __init__(self, clouds):
+        self.clouds = list(clouds)
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def _others(self, app_id):
+        return sum((used for other, used in self._used.items() if other != app_id), np.zeros((len(self.clouds), 2)))
+
+    def used(self, exclude=None):
+        """Resources reserved by all apps, optionally except one"""
+        with self._lock:
+            return self._others(exclude)
+
+    def plan(self, app_id, srv_templates, sla, time_budget=1.0, fixed=None, profiles=None):
+        """Optimize an app's placement within the capacity left by the others and reserve it"""
+        with self._lock:
+            placement = optimize(self.clouds, srv_templates, sla, time_budget, fixed=fixed,
+                                 used=self._others(app_id), profiles=profiles)
+            self._used[app_id] = usage(self.clouds, srv_templates,
+                                       {srv['role']: placement.clouds(srv['role']) for srv in srv_templates})
+            return placement
+
+    def update(self, app_id, srv_templates, clouds_by_role):
+        """Reserve what an app actually runs, e.g. after scaling in"""
+        with self._lock:
+            self._used[app_id] = usage(self.clouds, srv_templates, clouds_by_role)
+
+    def release(self, app_id):
+        """Free all resources of a removed app"""
+        with self._lock:
+            self._used.pop(app_id, None)
+
+
+def filter_provider(cloud, srv_template):
+    """Remove non-supported clouds"""
+    return cloud.provider in srv_template['provider']
 
 
 def check(clouds, srv_template, sla):
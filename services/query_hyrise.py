@@ -1,8 +1,13 @@
 import argparse
+import asyncio
+import bisect
+import csv
+import json
 import logging
-import multiprocessing.dummy
+import os
 import pprint
-import time
+import random
+from array import array
 
 import requests
 import tableprint
@@ -12,58 +17,539 @@ def contains_table(data):
     return 'header' in data and 'rows' in data
 
 
+def print_query_result(result, print_result=True):
+    if print_result and contains_table(result):
+        tableprint.table(result['rows'], result['header'])
+    else:
+        logging.warning(pprint.pformat(result, indent=20, width=120, compact=True))
+
+
 def query_hyrise(host, port, query, print_result=True):
     try:
         url = "http://{host}:{port}/query".format(host=host, port=port)
         data = "query={data}".format(data=query)
-        result = requests.post(url, data).json()
-        if print_result and contains_table(result):
-            tableprint.table(result['rows'], result['header'])
-        else:
-            logging.warning(pprint.pformat(result, indent=20, width=120, compact=True))
+        print_query_result(requests.post(url, data).json(), print_result)
     except requests.RequestException as e:
         logging.error(e)
 
 
-def benchmark(host, port, query_file, num_threads, num_queries):
-    # TODO: Ignore errors in preparation phase and invalidate benchmark on error during actual run
-    with open(query_file) as query_f:
-        query = query_f.read()
+def encode_query(host, port, query):
+    """Build a ready-to-send HTTP/1.1 keep-alive request for a query"""
+    body = "query={data}".format(data=query).encode()
+    head = ("POST /query HTTP/1.1\r\n"
+            "Host: {host}:{port}\r\n"
+            "Connection: keep-alive\r\n"
+            "Content-Length: {length}\r\n"
+            "\r\n").format(host=host, port=port, length=len(body))
+    return head.encode() + body
+
+
+class Workload:
+    """Weighted mix of queries, each encoded once into a ready-to-send request
+
+    A workload is either a single query file (JSON plan) or a mix spec (YAML):
+
+        queries:
+          - file: q1.json       # relative to the spec file
+            weight: 1
+    """
+
+    def __init__(self, host, port, queries):
+        self.names = [name for name, _, _ in queries]
+        self._payloads = [encode_query(host, port, query) for _, query, _ in queries]
+        self._cum_weights = []
+        total = 0.0
+        for _, _, weight in queries:
+            total += weight
+            self._cum_weights.append(total)
+
+    @classmethod
+    def from_file(cls, host, port, path):
+        if not path.endswith(('.yaml', '.yml')):
+            with open(path) as query_f:
+                return cls(host, port, [(os.path.basename(path), query_f.read(), 1)])
+
+        import ruamel.yaml as yaml
+
+        with open(path) as stream:
+            spec = yaml.YAML(typ='safe').load(stream)
+        queries = []
+        for entry in spec['queries']:
+            query_path = os.path.join(os.path.dirname(path), entry['file'])
+            with open(query_path) as query_f:
+                queries.append((entry.get('name', entry['file']), query_f.read(), entry.get('weight', 1)))
+        return cls(host, port, queries)
+
+    def stream(self, num_queries, seed=None):
+        """Generate (name, payload) pairs in constant memory"""
+        if len(self._payloads) == 1:
+            job = (self.names[0], self._payloads[0])
+            for _ in range(num_queries):
+                yield job
+            return
+
+        rnd = random.Random(seed)
+        total = self._cum_weights[-1]
+        jobs = list(zip(self.names, self._payloads))
+        for _ in range(num_queries):
+            yield jobs[bisect.bisect(self._cum_weights, rnd.random() * total)]
+
+
+class HttpError(Exception):
+    pass
+
+
+class Connection:
+    """Persistent HTTP/1.1 connection to a Hyrise-R dispatcher
+
+    A minimal asyncio client: requests are pre-encoded bytes and
+    the connection is kept open between queries.
+    """
+
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+        self._reader = None
+        self._writer = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def request(self, payload):
+        """Send a pre-encoded request and return status and body"""
+        reused = self._writer is not None
+        if not reused:
+            await self._connect()
+        try:
+            return await self._exchange(payload)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.close()
+            if not reused:
+                raise
+        # The server may have closed an idle keep-alive connection, retry once on a fresh one
+        await self._connect()
+        return await self._exchange(payload)
+
+    async def _exchange(self, payload):
+        self._writer.write(payload)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(status_line, None)
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        if headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int((await self._reader.readline()).split(b';')[0], 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if not size:
+                    break
+                body += chunk[:-2]
+        elif 'content-length' in headers:
+            body = await self._reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self._reader.read()
+            headers['connection'] = 'close'
+
+        if headers.get('connection') == 'close':
+            self.close()
+        return status, body
+
+
+class LatencyHistogram:
+    """Fixed-Memory Log-Linear Latency Histogram (HDR-style)
+
+    Latencies are kept in microseconds. Values below 2^precision_bits are exact,
+    larger values share buckets with a relative error below 2^-(precision_bits - 1).
+    """
+
+    def __init__(self, max_value=3600.0, precision_bits=7):
+        self._bits = precision_bits
+        self._sub_buckets = 1 << precision_bits
+        self._half = self._sub_buckets >> 1
+        self._max_shift = max(1, int(max_value * 1e6).bit_length() - precision_bits)
+        self._counts = array('Q', [0]) * (self._sub_buckets + self._max_shift * self._half)
+        self.count = 0
+        self.max = 0
+        self._sum = 0
+
+    def _index(self, value):
+        if value < self._sub_buckets:
+            return value
+        shift = min(value.bit_length() - self._bits, self._max_shift)
+        top = min(value >> shift, self._sub_buckets - 1)
+        return self._sub_buckets + (shift - 1) * self._half + top - self._half
+
+    def _upper_value(self, index):
+        if index < self._sub_buckets:
+            return index
+        shift, top = divmod(index - self._sub_buckets, self._half)
+        shift += 1
+        return ((top + self._half + 1) << shift) - 1
+
+    def record(self, seconds):
+        """Record a latency in seconds"""
+        value = max(0, int(seconds * 1e6))
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self._sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add all values of another histogram with the same layout"""
+        for index, count in enumerate(other._counts):
+            self._counts[index] += count
+        self.count += other.count
+        self._sum += other._sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Latency in seconds below which the given percentage of values fall"""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(percent / 100.0 * self.count + 0.5))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return min(self._upper_value(index), self.max) / 1e6
+        return self.max / 1e6
+
+    @property
+    def mean(self):
+        return self._sum / self.count / 1e6 if self.count else 0.0
+
+    def summary(self):
+        """Latency summary in milliseconds"""
+        return {
+            'mean': self.mean * 1e3,
+            'p50': self.percentile(50) * 1e3,
+            'p90': self.percentile(90) * 1e3,
+            'p99': self.percentile(99) * 1e3,
+            'p99.9': self.percentile(99.9) * 1e3,
+            'max': self.max / 1e3,
+        }
+
+
+class BenchmarkResult:
+    """Latencies, error counts and throughput over time of one benchmark run"""
+
+    CSV_FIELDS = ['host', 'port', 'concurrency', 'rate', 'completed', 'errors', 'timeouts', 'valid', 'duration',
+                  'throughput', 'mean', 'p50', 'p90', 'p99', 'p99.9', 'max']
 
-    queries = [(host, port, query)] * num_queries
+    def __init__(self, host, port, concurrency, rate=None, bucket_width=1.0):
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.rate = rate
+        self.histogram = LatencyHistogram()
+        self.by_query = {}
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.start = None
+        self.end = None
+        self.sample = None
+        self._bucket_width = bucket_width
+        self._buckets = array('L')
+
+    def begin(self, now):
+        self.start = self.end = now
+
+    def _count(self, now):
+        bucket = int((now - self.start) / self._bucket_width)
+        while len(self._buckets) <= bucket:
+            self._buckets.append(0)
+        self._buckets[bucket] += 1
+        self.end = max(self.end, now)
+
+    def record(self, latency, now, body=None, name=None):
+        """Record a successful query"""
+        self.histogram.record(latency)
+        if name is not None:
+            if name not in self.by_query:
+                self.by_query[name] = LatencyHistogram()
+            self.by_query[name].record(latency)
+        self.completed += 1
+        self._count(now)
+        if self.sample is None:
+            self.sample = body
+
+    def record_error(self, now):
+        self.errors += 1
+        self.end = max(self.end, now)
+
+    def record_timeout(self, now):
+        self.timeouts += 1
+        self.end = max(self.end, now)
+
+    @property
+    def valid(self):
+        """A run with errors or timeouts during measurement is invalid"""
+        return not self.errors and not self.timeouts
+
+    @property
+    def duration(self):
+        return (self.end - self.start) if self.start is not None else 0.0
+
+    @property
+    def throughput(self):
+        """Successful queries per second"""
+        return self.completed / self.duration if self.duration else 0.0
+
+    @property
+    def throughput_over_time(self):
+        """Successful queries per second for each time bucket"""
+        return [count / self._bucket_width for count in self._buckets]
+
+    def __float__(self):
+        return float(self.throughput)
+
+    def to_dict(self):
+        summary = {
+            'host': self.host,
+            'port': self.port,
+            'concurrency': self.concurrency,
+            'rate': self.rate,
+            'completed': self.completed,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'valid': self.valid,
+            'duration': self.duration,
+            'throughput': self.throughput,
+        }
+        summary.update(self.histogram.summary())
+        summary['queries'] = {name: dict(histogram.summary(), completed=histogram.count)
+                              for name, histogram in self.by_query.items()}
+        summary['throughput_over_time'] = self.throughput_over_time
+        return summary
+
+    def to_json(self, path):
+        """Export the run including throughput over time"""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def to_csv(self, path):
+        """Append the run summary as one row, so several runs can be compared"""
+        is_new = not os.path.exists(path) or not os.path.getsize(path)
+        with open(path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.CSV_FIELDS, extrasaction='ignore')
+            if is_new:
+                writer.writeheader()
+            writer.writerow(self.to_dict())
+
+
+async def _send(connection, job, started, result, timeout):
+    """Send one query and record its latency relative to the given start time"""
+    loop = asyncio.get_event_loop()
+    name, payload = job
+    try:
+        status, body = await asyncio.wait_for(connection.request(payload), timeout)
+        if status != 200:
+            raise HttpError("HTTP {}".format(status))
+        now = loop.time()
+        result.record(now - started, now, body, name)
+    except asyncio.TimeoutError:
+        connection.close()
+        result.record_timeout(loop.time())
+    except (OSError, asyncio.IncompleteReadError, HttpError, ValueError) as e:
+        connection.close()
+        result.record_error(loop.time())
+        logging.debug(e)
+
+
+async def _query_worker(connection, jobs, result, timeout):
+    """Send queries over one persistent connection until the workload is exhausted"""
+    loop = asyncio.get_event_loop()
+    try:
+        # All workers share one job iterator, which is safe within a single event loop
+        for job in jobs:
+            await _send(connection, job, loop.time(), result, timeout)
+    finally:
+        connection.close()
+
+
+async def _run_queries(host, port, jobs, concurrency, timeout):
+    result = BenchmarkResult(host, port, concurrency)
+    result.begin(asyncio.get_event_loop().time())
+    jobs = iter(jobs)
+    await asyncio.gather(*(_query_worker(Connection(host, port), jobs, result, timeout)
+                           for _ in range(concurrency)))
+    return result
+
+
+def arrival_schedule(rate, arrival='fixed', seed=None):
+    """Intended send offsets in seconds for a target rate of queries per second"""
+    if arrival == 'poisson':
+        rnd = random.Random(seed)
+        offset = 0.0
+        while True:
+            offset += rnd.expovariate(rate)
+            yield offset
+    elif arrival == 'fixed':
+        index = 0
+        while True:
+            yield index / rate
+            index += 1
+    else:
+        raise ValueError("Unknown arrival process '{}'".format(arrival))
+
+
+async def _open_loop_sender(connection, queue, result, timeout):
+    """Send scheduled queries over one persistent connection"""
+    try:
+        while True:
+            job = await queue.get()
+            if job is None:
+                break
+            intended, job = job
+            # Latency counts from the intended send time, so queueing delay is not omitted
+            await _send(connection, job, intended, result, timeout)
+    finally:
+        connection.close()
+
+
+async def _run_open_loop(host, port, jobs, concurrency, timeout, rate, arrival, seed):
+    loop = asyncio.get_event_loop()
+    result = BenchmarkResult(host, port, concurrency, rate=rate)
+    queue = asyncio.Queue()
+    senders = [asyncio.ensure_future(_open_loop_sender(Connection(host, port), queue, result, timeout))
+               for _ in range(concurrency)]
+
+    start = loop.time()
+    result.begin(start)
+    for offset, job in zip(arrival_schedule(rate, arrival, seed), jobs):
+        intended = start + offset
+        delay = intended - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        queue.put_nowait((intended, job))
+    for _ in senders:
+        queue.put_nowait(None)
+
+    await asyncio.gather(*senders)
+    return result
+
+
+def run_queries(host, port, jobs, concurrency, timeout=10.0, rate=None, arrival='fixed', seed=None):
+    """Send all (name, payload) jobs with a given number of concurrent keep-alive connections
+
+    Without a rate, each connection sends its next query as soon as the previous one returns (closed loop).
+    With a rate in queries per second, queries are sent on a fixed or Poisson schedule (open loop).
+    If all connections are busy, scheduled queries wait and their latency grows accordingly.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        if rate is None:
+            return loop.run_until_complete(_run_queries(host, port, jobs, concurrency, timeout))
+        return loop.run_until_complete(
+            _run_open_loop(host, port, jobs, concurrency, timeout, rate, arrival, seed))
+    finally:
+        loop.close()
+
+
+def benchmark(host, port, query_file, num_threads, num_queries, print_result=True, timeout=10.0,
+              rate=None, arrival='fixed', prepare=True, seed=None):
+    # num_threads keeps its name for existing callers, it is the number of concurrent keep-alive connections
+    concurrency = num_threads
+    # Encode once, send many times
+    workload = Workload.from_file(host, port, query_file)
 
     # Because of reasons, the first query on each node is executed with lower throughput.
     # So for accurate measurements, we need the query to be executed on every node at lest once.
     # As we don't know anything about the cluster structure at this point,
     # this benchmark may return lower throughput if num_queries < number of cluster nodes.
-    logging.info("Benchmark {0}:{1} preparation...".format(host, port, num_queries, num_threads))
-    with multiprocessing.dummy.Pool(num_threads) as pool:
-        pool.starmap(query_hyrise, queries)
-    logging.info("Benchmark {0}:{1} with {2} queries in {3} threads...".format(host, port, num_queries, num_threads))
-    start = time.time()
-    with multiprocessing.dummy.Pool(num_threads) as pool:
-        pool.starmap(query_hyrise, queries)
-    queries_second = num_queries / (time.time() - start)
-    logging.info("Benchmark finished with {throughput} queries/s".format(throughput=queries_second))
-    return queries_second
+    # Errors during preparation are expected (nodes still starting) and ignored.
+    if prepare:
+        logging.info("Benchmark {0}:{1} preparation...".format(host, port))
+        preparation = run_queries(host, port, workload.stream(num_queries, seed), concurrency, timeout)
+        if not preparation.valid:
+            logging.warning("Benchmark preparation: {0} errors, {1} timeouts (ignored)".format(
+                preparation.errors, preparation.timeouts))
+        if preparation.sample is not None:
+            first_response = preparation.sample.decode(errors='replace')
+            try:
+                print_query_result(json.loads(first_response), print_result)
+            except ValueError:
+                logging.warning(first_response)
+
+    logging.info("Benchmark {0}:{1} with {2} queries on {3} connections{4}...".format(
+        host, port, num_queries, concurrency, " at {0} queries/s ({1})".format(rate, arrival) if rate else ""))
+    result = run_queries(host, port, workload.stream(num_queries, seed), concurrency, timeout, rate, arrival, seed)
+    if not result.valid:
+        logging.error("Benchmark invalid: {0} errors, {1} timeouts".format(result.errors, result.timeouts))
+    logging.info("Benchmark finished with {throughput} queries/s".format(throughput=result.throughput))
+    logging.info("Latency [ms] " + " ".join(
+        "{0}={1:.2f}".format(name, value) for name, value in result.histogram.summary().items()))
+    return result
+
+
+def sweep(host, port, query_file, concurrency, rates, duration=10.0, timeout=10.0, arrival='fixed'):
+    """Throughput/latency curve with one open-loop run of the given duration per target rate"""
+    results = []
+    for index, rate in enumerate(rates):
+        results.append(benchmark(host, port, query_file, concurrency, max(1, int(rate * duration)),
+                                 print_result=False, timeout=timeout, rate=rate, arrival=arrival,
+                                 prepare=index == 0))
+
+    header = ['target q/s', 'achieved q/s', 'p50 ms', 'p99 ms', 'p99.9 ms', 'valid']
+    rows = [[r.rate, round(r.throughput, 1), round(r.histogram.percentile(50) * 1e3, 2),
+             round(r.histogram.percentile(99) * 1e3, 2), round(r.histogram.percentile(99.9) * 1e3, 2),
+             r.valid] for r in results]
+    tableprint.table(rows, header)
+    return results
 
 
 def main():
     parser = argparse.ArgumentParser(description='Query Hyrise')
-    parser.add_argument('query_file')
+    parser.add_argument('query_file', help='Query plan (JSON) or weighted workload mix (YAML)')
     parser.add_argument('--host', default='127.0.0.1', type=str, help='Hyrise IP address')
     parser.add_argument('--port', default=5000, type=int, help='Hyrise port')
-    parser.add_argument('--threads', default=1, type=int, help='Threads')
+    parser.add_argument('--concurrency', '--threads', default=1, type=int, dest='concurrency',
+                        help='Concurrent keep-alive connections')
     parser.add_argument('--queries', default=1, type=int, help='Queries')
+    parser.add_argument('--timeout', default=10.0, type=float, help='Query timeout in seconds')
+    parser.add_argument('--rate', nargs='+', type=float,
+                        help='Open loop: target queries/s, several rates give a throughput/latency curve')
+    parser.add_argument('--duration', default=10.0, type=float, help='Open loop: seconds per rate')
+    parser.add_argument('--arrival', default='fixed', choices=['fixed', 'poisson'],
+                        help='Open loop: arrival schedule')
+    parser.add_argument('--json', help='Export the run as JSON')
+    parser.add_argument('--csv', help='Append the run summary to a CSV file')
     args = parser.parse_args()
 
     query_file = args.query_file
     host = args.host
     port = args.port
-    threads = args.threads
+    concurrency = args.concurrency
     num_queries = args.queries
 
-    benchmark(host, port, query_file, threads, num_queries)
+    if args.rate:
+        results = sweep(host, port, query_file, concurrency, args.rate, args.duration, args.timeout, args.arrival)
+    else:
+        results = [benchmark(host, port, query_file, concurrency, num_queries, timeout=args.timeout)]
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([result.to_dict() for result in results], f, indent=2)
+    if args.csv:
+        for result in results:
+            result.to_csv(args.csv)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+import glob
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import ruamel.yaml as yaml
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS apps (
+    id       TEXT PRIMARY KEY,
+    name     TEXT,
+    template TEXT NOT NULL,
+    updated  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS services (
+    id       TEXT PRIMARY KEY,
+    app_id   TEXT NOT NULL,
+    role     TEXT NOT NULL,
+    cloud_id TEXT NOT NULL,
+    ip       TEXT,
+    port     INTEGER,
+    created  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS services_by_app ON services (app_id, role, cloud_id);
+CREATE INDEX IF NOT EXISTS services_by_cloud ON services (cloud_id);
+CREATE TABLE IF NOT EXISTS allocations (
+    cloud_id   TEXT NOT NULL,
+    kind       TEXT NOT NULL,
+    value      TEXT NOT NULL,
+    service_id TEXT NOT NULL,
+    PRIMARY KEY (cloud_id, kind, service_id)
+);
+CREATE INDEX IF NOT EXISTS allocations_by_service ON allocations (service_id);
+CREATE TABLE IF NOT EXISTS samples (
+    cloud_id TEXT NOT NULL,
+    size     TEXT NOT NULL,
+    metric   TEXT NOT NULL,
+    value    REAL NOT NULL,
+    time     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_by_series ON samples (cloud_id, size, metric, time);
+"""
+
+
+def _dump_yaml(data):
+    stream = io.StringIO()
+    yaml.YAML().dump(data, stream)
+    return stream.getvalue()
+
+
+class StateStore:
+    """
+    Broker State in an Embedded SQLite Database
+
+    Apps with their rendered templates, service instances,
+    port/ip allocations and performance samples are kept in indexed tables.
+    WAL mode lets readers continue while a batch is written.
+    Writes within transaction() are committed together, or not at all.
+    """
+
+    def __init__(self, path='./deployments/state.db'):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        # One connection shared by all broker threads, serialized by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Batch all writes of the block into one transaction, nested blocks join the outer one"""
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute('BEGIN IMMEDIATE')
+            self._depth += 1
+            try:
+                yield self._conn
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute('ROLLBACK')
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute('COMMIT')
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # Apps
+
+    def save_template(self, app_id, rendered):
+        """Store the rendered template of an app"""
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO apps (id, name, template, updated) VALUES (?, ?, ?, ?)',
+                         (app_id, rendered.get('name'), _dump_yaml(rendered), time.time()))
+
+    def load_template(self, app_id):
+        """Rendered template of an app, None if unknown"""
+        rows = self._query('SELECT template FROM apps WHERE id = ?', (app_id,))
+        return yaml.YAML().load(rows[0][0]) if rows else None
+
+    def apps(self):
+        """Ids of all stored apps"""
+        return [row[0] for row in self._query('SELECT id FROM apps ORDER BY updated')]
+
+    def remove_app(self, app_id):
+        """Forget an app with its services and allocations"""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM allocations WHERE service_id IN (SELECT id FROM services WHERE app_id = ?)',
+                         (app_id,))
+            conn.execute('DELETE FROM services WHERE app_id = ?', (app_id,))
+            conn.execute('DELETE FROM apps WHERE id = ?', (app_id,))
+
+    # Services and their allocations
+
+    def add_services(self, app_id, services):
+        """Record deployed service instances and their port/ip allocations"""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO services (id, app_id, role, cloud_id, ip, port, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(s.id, app_id, s.role, s.cloud.id, s.ip, s.port, now) for s in services])
+            conn.executemany(
+                'INSERT OR REPLACE INTO allocations (cloud_id, kind, value, service_id) VALUES (?, ?, ?, ?)',
+                [(s.cloud.id, kind, str(value), s.id) for s in services
+                 for kind, value in (('ip', s.ip), ('port', s.port)) if value is not None])
+
+    def remove_services(self, service_ids):
+        """Forget removed service instances and release their allocations"""
+        service_ids = [(service_id,) for service_id in service_ids]
+        with self.transaction() as conn:
+            conn.executemany('DELETE FROM allocations WHERE service_id = ?', service_ids)
+            conn.executemany('DELETE FROM services WHERE id = ?', service_ids)
+
+    def services(self, app_id=None, role=None, cloud_id=None):
+        """Service rows as dictionaries, e.g. all replicas of an app on one cloud"""
+        conditions, params = [], []
+        for column, value in (('app_id', app_id), ('role', role), ('cloud_id', cloud_id)):
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                params.append(value)
+        sql = 'SELECT id, app_id, role, cloud_id, ip, port, created FROM services'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        columns = ('id', 'app_id', 'role', 'cloud_id', 'ip', 'port', 'created')
+        return [dict(zip(columns, row)) for row in self._query(sql + ' ORDER BY created', params)]
+
+    def allocations(self, cloud_id, kind):
+        """Allocated values (ports, ips) of a cloud, each once"""
+        return [row[0] for row in self._query('SELECT DISTINCT value FROM allocations WHERE cloud_id = ? AND kind = ?',
+                                              (cloud_id, kind))]
+
+    # Performance samples (see profiles.Profiles)
+
+    def add_samples(self, samples, keep=None):
+        """Append (cloud id, size, metric, value, time) samples, then keep only the most recent of their series"""
+        with self.transaction() as conn:
+            conn.executemany('INSERT INTO samples (cloud_id, size, metric, value, time) VALUES (?, ?, ?, ?, ?)',
+                             samples)
+            if keep is not None:
+                # Only the series just appended to can have grown, each is trimmed along its index
+                conn.executemany(
+                    'DELETE FROM samples WHERE cloud_id = ? AND size = ? AND metric = ? AND rowid NOT IN ('
+                    'SELECT rowid FROM samples WHERE cloud_id = ? AND size = ? AND metric = ? '
+                    'ORDER BY time DESC LIMIT ?)',
+                    [series + series + (keep,) for series in {tuple(sample[:3]) for sample in samples}])
+
+    def samples(self):
+        """All samples, oldest first"""
+        return self._query('SELECT cloud_id, size, metric, value, time FROM samples ORDER BY time')
+
+    def trim_samples(self, keep):
+        """Keep only the most recent samples of each cloud, size and metric"""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM samples WHERE rowid IN ('
+                         'SELECT rowid FROM (SELECT rowid, ROW_NUMBER() OVER ('
+                         'PARTITION BY cloud_id, size, metric ORDER BY time DESC) AS n FROM samples) '
+                         'WHERE n > ?)', (keep,))
+
+    # Migration
+
+    def migrate_yaml(self, directory='./deployments'):
+        """Import templates persisted as {id}.yaml files, returns the number of imported apps"""
+        known = set(self.apps())
+        imported = 0
+        with self.transaction():
+            for path in sorted(glob.glob(os.path.join(directory, '*.yaml'))):
+                app_id = os.path.splitext(os.path.basename(path))[0]
+                if app_id in known:
+                    continue
+                with open(path) as stream:
+                    rendered = yaml.YAML().load(stream)
+                if not rendered or 'services' not in rendered:
+                    logging.warning("Skipping {}, not an app template".format(path))
+                    continue
+                self.save_template(app_id, rendered)
+                imported += 1
+        return imported
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+import ruamel.yaml as yaml
+
+from app import App
+from cloud import SimulatedCloud, SimulatedFailure
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'services', 'hyrise.yaml')
+
+
+def _template():
+    with open(TEMPLATE) as stream:
+        return yaml.YAML().load(stream)
+
+
+class FailingCloud(SimulatedCloud):
+    """Simulated cloud whose deployments fail from the given (0-based) one on"""
+
+    def __init__(self, cfg, fail_from):
+        super().__init__(cfg)
+        self.fail_from = fail_from
+        self.deployments = 0
+
+    def deploy(self, name, image, command=None, labels=None, remove_existing=True, boot=True):
+        self.deployments += 1
+        if self.deployments > self.fail_from:
+            raise SimulatedFailure("Simulated create failure on {}".format(self.id))
+        return super().deploy(name, image, command, labels, remove_existing, boot)
+
+
+def _cloud(fail_from=None, batch=False):
+    cfg = {'id': 'sim', 'availability': 0.99, 'cost': 1, 'location': {'country': 'de'},
+           'simulation': {'batch': batch}}
+    return SimulatedCloud(cfg) if fail_from is None else FailingCloud(cfg, fail_from)
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_failed_wave_leaves_no_instances_or_allocations(tmp_path, monkeypatch, batch):
+    monkeypatch.chdir(tmp_path)
+    # Dispatcher and master deploy, the second of three replicas fails
+    cloud = _cloud(fail_from=3, batch=batch)
+    hyrise = App(_template(), {}, [cloud], deploy=False)
+
+    with pytest.raises(SimulatedFailure):
+        hyrise._deploy_services()
+    assert sorted(i.name.split('-')[0] for i in cloud.instances) == ['dispatcher', 'master']
+    assert sorted(s.role for s in hyrise.services) == ['dispatcher', 'master']
+    assert len(cloud._ports) == 2
+
+
+def test_scale_in_keeps_going_after_a_failed_removal(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cloud = _cloud()
+    hyrise = App(_template(), {}, [cloud])
+    replicas = [s for s in hyrise.services if s.role == 'replica']
+    stuck = replicas[-1]
+    destroy = cloud.destroy
+
+    def failing_destroy(instance, run_config=None):
+        if instance.name == stuck.id:
+            raise SimulatedFailure("Simulated destroy failure")
+        return destroy(instance, run_config)
+
+    monkeypatch.setattr(cloud, 'destroy', failing_destroy)
+    errors = hyrise.scale('replica', 1)
+    assert list(errors) == [stuck.id]
+    # The other surplus replica is gone, the stuck one is still known and still running
+    assert [s.id for s in hyrise.services if s.role == 'replica'] == [replicas[0].id, stuck.id]
+    assert sorted(i.name for i in cloud.instances if i.name.startswith('replica')) == sorted(
+        [replicas[0].id, stuck.id])
+
+
+def test_removed_service_is_not_restarted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cloud = _cloud()
+    hyrise = App(_template(), {}, [cloud])
+    replica = next(s for s in hyrise.services if s.role == 'replica')
+    hyrise.scale('replica', 2, healthy={s.id for s in hyrise.services if s is not replica})
+    assert replica not in hyrise.services
+    replica.restart()
+    assert cloud.get_instance(replica.id) is None
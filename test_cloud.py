@@ -0,0 +1,137 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from libcloud.compute.types import NodeState
+
+from cloud import LABEL_APP, LABEL_ROLE, Cloud, PowerVcCloud, parse_events
+from inventory import Inventory
+
+EVENTS = b'\n'.join(json.dumps(event).encode() for event in [
+    {'Type': 'container', 'Action': 'create', 'Actor': {'ID': 'c1', 'Attributes': {'name': 'replica-1'}}},
+    {'Type': 'container', 'Action': 'start', 'Actor': {'ID': 'c1', 'Attributes': {'name': 'replica-1'}}},
+    {'Type': 'container', 'Action': 'destroy', 'Actor': {'ID': 'c0', 'Attributes': {'name': 'replica-0'}}},
+]) + b'\n'
+
+
+class FakeDockerConnection:
+    """Answers the raw Docker API requests of Cloud"""
+
+    def __init__(self, events):
+        self.events = events
+        self.requests = []
+        self.running = {'c1'}
+
+    def request(self, action, params=None, data=None, headers=None, method='GET', raw=False):
+        self.requests.append((action, raw))
+        if method == 'DELETE':
+            container_id = action.rsplit('/', 1)[-1]
+            if container_id in self.running and not (params or {}).get('force'):
+                raise Exception("409 Conflict: You cannot remove a running container {}".format(container_id))
+            self.running.discard(container_id)
+            return SimpleNamespace(status=204)
+        if action.endswith('/events'):
+            if not raw:
+                # As libcloud's DockerResponse, which parses the whole body as one JSON document
+                return SimpleNamespace(object=json.loads(self.events))
+            return SimpleNamespace(body=self.events)
+        if action.endswith('/containers/json'):
+            return SimpleNamespace(object=[{'Id': 'c1', 'Names': ['/replica-1'],
+                                            'Labels': {LABEL_APP: 'app', LABEL_ROLE: 'replica'}}])
+        raise AssertionError(action)
+
+
+def _docker_cloud(events=EVENTS):
+    cloud = Cloud({'id': 'docker', 'availability': 0.99, 'cost': 1, 'location': {'country': 'de'},
+                   'auth': {'host': '127.0.0.1', 'port': 2375}})
+    cloud._driver = SimpleNamespace(version='1.24', connection=FakeDockerConnection(events))
+    return cloud
+
+
+def test_parse_events_with_several_events():
+    events = parse_events(EVENTS)
+    assert [event['Action'] for event in events] == ['create', 'start', 'destroy']
+    assert parse_events(EVENTS.decode()) == events
+    assert parse_events(b'') == []
+
+
+def test_changed_instances_reads_newline_delimited_events():
+    changed, removed = _docker_cloud().changed_instances(0)
+    assert [name for name, _ in changed] == ['replica-1']
+    assert removed == ['replica-0']
+
+
+def test_destroy_removes_a_running_container():
+    cloud = _docker_cloud()
+    port = cloud._ports.reserve()
+    container = SimpleNamespace(id='c1', name='replica-1')
+    cloud.destroy(container, {'ip': '127.0.0.1', 'port': port})
+    assert not cloud._driver.connection.running
+    assert port not in cloud._ports
+
+
+def test_inventory_falls_back_to_full_listing():
+    class FailingChanges:
+        id = 'failing'
+
+        def __init__(self):
+            self.listings = 0
+
+        def list_instances(self):
+            self.listings += 1
+            return [('replica-1', {LABEL_APP: 'app', LABEL_ROLE: 'replica'})]
+
+        def changed_instances(self, since):
+            raise ValueError("Failed to parse JSON response")
+
+    cloud = FailingChanges()
+    inventory = Inventory([cloud])
+    assert inventory.refresh() == {}
+    since = inventory._since[cloud.id]
+    assert inventory.refresh() == {}
+    assert cloud.listings == 2
+    assert inventory._since[cloud.id] >= since
+    assert [instance.name for instance in inventory.instances(app_id='app')] == ['replica-1']
+
+
+class FakeNodeDriver:
+    """Nodes of an OpenStack driver, the one named 'broken' fails to boot"""
+
+    def __init__(self):
+        self.nodes = []
+        self.destroyed = []
+
+    def create_node(self, name, **kwargs):
+        node = SimpleNamespace(id=name, name=name, state=NodeState.PENDING, extra={})
+        self.nodes.append(node)
+        return node
+
+    def list_nodes(self):
+        return [SimpleNamespace(id=node.id, name=node.name, extra={},
+                                state=NodeState.ERROR if node.name == 'broken' else NodeState.RUNNING)
+                for node in self.nodes]
+
+    def ex_list_floating_ips(self):
+        return [SimpleNamespace(ip_address=ip, node_id=None) for ip in ('10.0.0.1', '10.0.0.2')]
+
+    def ex_attach_floating_ip_to_node(self, node, ip):
+        pass
+
+    def destroy_node(self, node):
+        self.destroyed.append(node.name)
+
+
+def test_failed_wave_removes_its_nodes_and_floating_ips():
+    cloud = PowerVcCloud({'id': 'powervc', 'availability': 0.99, 'cost': 1, 'location': {'country': 'de'},
+                          'auth': {}, 'poll_interval': 0.01})
+    driver = FakeNodeDriver()
+    cloud._driver = driver
+    cloud._get_network = lambda name: None
+    cloud._template_args = lambda name, template, run_config: {'image': None, 'size': None, 'command': None,
+                                                               'ip': run_config['ip'], 'labels': {}}
+    jobs = [(name, {}, {'ip': cloud.request_ip()}) for name in ('healthy', 'broken')]
+
+    with pytest.raises(RuntimeError):
+        cloud.deploy_templates(jobs)
+    assert sorted(driver.destroyed) == ['broken', 'healthy']
+    assert sorted(cloud.request_ip() for _ in jobs) == ['10.0.0.1', '10.0.0.2']
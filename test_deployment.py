@@ -0,0 +1,54 @@
+import os
+
+import pytest
+import ruamel.yaml as yaml
+
+import deployment
+from cloud import SimulatedCloud, SimulatedFailure
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'services', 'hyrise.yaml')
+
+
+class BrokenImageCloud(SimulatedCloud):
+    """Simulated cloud that cannot create instances of one image"""
+
+    def deploy(self, name, image, command=None, labels=None, remove_existing=True, boot=True):
+        if image == 'broken/replica':
+            raise SimulatedFailure("Simulated create failure of {}".format(image))
+        return super().deploy(name, image, command, labels, remove_existing, boot)
+
+
+@pytest.fixture
+def shared_cloud(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Capacity for two Hyrise-R apps (dispatcher 20M, master and 3 replicas 2000M each)
+    cloud = BrokenImageCloud({'id': 'sim', 'availability': 0.99, 'cost': 1, 'location': {'country': 'de'},
+                              'capacity': {'cpus': 1, 'memory': '16100M'}})
+    monkeypatch.setattr(deployment, '_clouds', [cloud])
+    monkeypatch.setattr(deployment, '_apps', [])
+    monkeypatch.setattr(deployment, '_ledger', None)
+    deployment.open_state(':memory:')
+    yield cloud
+    deployment._store.close()
+    monkeypatch.setattr(deployment, '_store', None)
+    monkeypatch.setattr(deployment, '_profiles', None)
+
+
+def _template(broken=False):
+    with open(TEMPLATE) as stream:
+        template = yaml.YAML().load(stream)
+    if broken:
+        replica = next(srv for srv in template['services'] if srv['role'] == 'replica')
+        replica['provider']['docker']['image'] = 'broken/replica'
+    return template
+
+
+def test_failed_app_of_a_batch_frees_its_capacity(shared_cloud):
+    report = deployment.deploy_apps([(_template(), {}), (_template(broken=True), {})])
+    assert len(report['apps']) == 1 and list(report['errors']) == [1]
+    # Dispatcher and master of the failed app were removed again
+    deployed = {s.id for s in report['apps'][0].services}
+    assert {i.name for i in shared_cloud.instances} == deployed
+
+    report = deployment.deploy_apps([(_template(), {})])
+    assert len(report['apps']) == 1 and not report['errors']
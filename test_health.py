@@ -0,0 +1,51 @@
+import os
+import time
+
+import pytest
+import ruamel.yaml as yaml
+
+from app import App
+from cloud import SimulatedCloud
+from health import HealthChecker, HealthSpec
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'services', 'hyrise.yaml')
+
+
+class ProbedCloud(SimulatedCloud):
+    """Simulated cloud whose instances are probed like real ones"""
+    health_checks = True
+
+
+async def refuse(host, port, path=None, timeout=10.0):
+    raise OSError("Connection refused")
+
+
+def test_ready_timeout_follows_the_spec():
+    spec = HealthSpec({'test': ['CMD', 'curl', '-f', 'http://localhost'], 'interval': '1m30s', 'timeout': '10s',
+                       'retries': 3})
+    # Start period defaults to interval * retries
+    assert spec.ready_timeout == 270 + 270 + 10
+    assert HealthSpec({'test': ['NONE']}).ready_timeout == 0
+
+
+def test_failing_probe_does_not_block_the_wave_forever(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(TEMPLATE) as stream:
+        template = yaml.YAML().load(stream)
+    for srv in template['services']:
+        srv['healthcheck'] = {'test': ['CMD', 'curl', '-f', 'http://localhost'], 'interval': '50ms',
+                              'timeout': '10ms', 'retries': 2, 'start_interval': '10ms', 'start_period': '100ms'}
+        # Restarted without limit, so only the ready timeout ends the wait
+        srv['restart_policy'] = {'condition': 'any', 'delay': '0s'}
+    cloud = ProbedCloud({'id': 'sim', 'availability': 0.99, 'cost': 1, 'location': {'country': 'de'}})
+    health = HealthChecker(probe=refuse)
+
+    started = time.monotonic()
+    try:
+        with pytest.raises(RuntimeError, match='did not become healthy within'):
+            App(template, {}, [cloud], health=health)
+    finally:
+        health.stop()
+    assert time.monotonic() - started < 5
+    # The failed app removed its instances again
+    assert not cloud.instances
@@ -0,0 +1,32 @@
+from types import SimpleNamespace
+
+from profiles import THROUGHPUT, Profiles
+from state import StateStore
+
+
+def _replica(cloud_id):
+    return SimpleNamespace(role='replica', cloud=SimpleNamespace(id=cloud_id), template={})
+
+
+def test_store_keeps_a_window_per_series():
+    store = StateStore(':memory:')
+    profiles = Profiles(store, window=4)
+    for value in range(10):
+        profiles.record('a', 'default', THROUGHPUT, value)
+    profiles.record('b', 'default', THROUGHPUT, 1.0)
+    assert sorted(value for cloud_id, _, _, value, _ in store.samples() if cloud_id == 'a') == [6, 7, 8, 9]
+
+    # Older samples, e.g. of an earlier broker, are dropped on the next start
+    store.add_samples([('a', 'default', THROUGHPUT, -1.0, 0.0)] * 10)
+    store.trim_samples(2)
+    assert sorted((cloud_id, value) for cloud_id, _, _, value, _ in store.samples()) == [
+        ('a', 8.0), ('a', 9.0), ('b', 1.0)]
+
+
+def test_benchmark_is_only_credited_to_a_single_cloud():
+    profiles = Profiles()
+    result = SimpleNamespace(valid=True, throughput=90.0)
+    profiles.record_benchmark(SimpleNamespace(services=[_replica('a'), _replica('b')]), result)
+    assert profiles.summary('a', THROUGHPUT) is None
+    profiles.record_benchmark(SimpleNamespace(services=[_replica('a'), _replica('a'), _replica('a')]), result)
+    assert profiles.ewma('a', THROUGHPUT) == 30.0
@@ -7,3 +7,18 @@ def create_uuid(start=None):
         return "{text}-{uuid}".format(text=start, uuid=uuid.uuid4())
     else:
         return uuid.uuid4()
+
+
+def fingerprint(template):
+    """Stable hash of a rendered (service) template, independent of key order"""
+
+    import hashlib
+    import json
+
+    # The replica count of a role does not change what a single instance runs
+    deploy = template.get('deploy') or {}
+    if 'replicas' in deploy:
+        template = dict(template, deploy={key: value for key, value in deploy.items() if key != 'replicas'})
+
+    canonical = json.dumps(template, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]